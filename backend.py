@@ -0,0 +1,600 @@
+# coding: utf8
+"""
+History backends of repositories. SubprocessBackend runs git commands, ObjectBackend reads git
+objects in process and diffs files itself, see conf.history_backend.
+
+A backend yields commits as records of (fields, numstat entries): fields are formatted like
+const.GIT_LOG_FIELDS, numstat entries are (insertions, deletions, path) strings of git log
+--numstat, binary files have '-' as insertions and deletions.
+"""
+import argparse
+import fnmatch
+import heapq
+import os
+from itertools import count
+from typing import List, Dict, Tuple, Iterator, Optional
+
+import conf
+import const
+import gitdiff
+import gitobjects
+import util
+
+Record = Tuple[List[str], List[Tuple[str, str, str]]]
+
+# Revisions to walk are given on stdin, there may be too many branches for the command line
+git_log_tmpl = 'git log --stdin --since="{begin}" --until="{end}" -z --format="{fmt}" --numstat'
+git_rev_parse_tmpl = 'git rev-parse --verify -q {rev}'
+git_for_each_ref_tmpl = 'git for-each-ref --format="%(objectname)" {patterns}'
+git_all_branches = ['refs/heads', 'refs/remotes']
+# The first commit reachable from revisions on stdin
+git_rev_list_cmd = 'git rev-list --max-count=1 --stdin'
+git_ls_tree_cmd = 'git ls-tree -r -z --name-only HEAD'
+# Resolve commits whose ids are given on stdin in one process, unknown ids are skipped
+git_resolve_tmpl = 'git log --no-walk=unsorted --ignore-missing --stdin -z --format="{fmt}"'
+
+tree_mode = 0o40000
+gitlink_mode = 0o160000
+
+
+class SubprocessBackend:
+    """ Read history by git commands, the default backend. """
+
+    def __init__(self, repo_dir: str):
+        self.directory = repo_dir
+
+    def get_remote_url(self) -> str:
+        return util.run(const.GIT_REMOTE_URL_CMD, check=False, cwd=self.directory)
+
+    def get_tips(self, branches: str) -> List[str]:
+        """ Sorted ids of commits the branches point to, see conf.branches. """
+        if branches:
+            patterns = git_all_branches if branches == 'all' else branches.split()
+            cmd = git_for_each_ref_tmpl.format(patterns=' '.join(patterns))
+            return sorted(set(util.run(cmd, check=False, cwd=self.directory).split()))
+        # Use master branch if it exists
+        branch = 'HEAD'
+        for line in util.run(const.GIT_BRANCH_CMD, cwd=self.directory).split('\n'):
+            if line.strip() == 'master':
+                branch = 'master'
+                break
+        tip = util.run(git_rev_parse_tmpl.format(rev=branch), check=False, cwd=self.directory)
+        return [tip] if tip else []
+
+    def is_reachable(self, commit_ids: List[str], tips: List[str]) -> bool:
+        """ Check if all commits are reachable from tips, false if any of them no longer exists. """
+        revs = commit_ids + ['^' + tip for tip in tips]
+        try:
+            res = util.run(git_rev_list_cmd, cwd=self.directory, input='\n'.join(revs).encode())
+        except Exception:
+            return False
+        return not res
+
+    def iter_log(self, revs: List[str], begin: int, end: int) -> Iterator[Record]:
+        """ Commits reachable from revs and committed in [begin, end], like git log. """
+        cmd = git_log_tmpl.format(begin=begin, end=end, fmt=const.GIT_LOG_FORMAT)
+        return self.iter_records(cmd, '\n'.join(revs).encode('utf8'))
+
+    def iter_commits(self, commit_ids: List[str]) -> Iterator[Record]:
+        """ Commits of the ids in order without numstat, unknown ids are skipped. """
+        cmd = git_resolve_tmpl.format(fmt=const.GIT_LOG_FORMAT)
+        return self.iter_records(cmd, '\n'.join(commit_ids).encode('utf8'))
+
+    def iter_records(self, git_cmd: str, input: bytes) -> Iterator[Record]:
+        """
+        Parse the NUL delimited output of git log -z incrementally, each record is yielded as
+        soon as it completes, so the whole log is never held in memory.
+        """
+        fields, num_stat, rename = [], [], None
+        for token in util.iter_split(git_cmd, cwd=self.directory, input=input):
+            if len(fields) < len(const.GIT_LOG_FIELDS):
+                fields.append(token)
+                continue
+            # A renamed file is followed by two tokens: the source path and the destination path
+            if rename is not None:
+                rename.append(token)
+                if len(rename) == 4:
+                    num_stat.append((rename[0], rename[1], rename[3]))
+                    rename = None
+                continue
+            stat = token.lstrip('\n').split('\t', maxsplit=2)
+            if len(stat) == 3:
+                if stat[2]:
+                    num_stat.append(tuple(stat))
+                else:
+                    rename = stat[:2]
+                continue
+            # Not a numstat entry, so it is the first field of next commit
+            yield fields, num_stat
+            fields, num_stat = [token], []
+        if len(fields) == len(const.GIT_LOG_FIELDS):
+            yield fields, num_stat
+
+    def get_head_tree(self) -> str:
+        return util.run(git_rev_parse_tmpl.format(rev='HEAD^{tree}'), check=False,
+                        cwd=self.directory)
+
+    def get_head_files(self) -> List[str]:
+        return util.run(git_ls_tree_cmd, check=False, cwd=self.directory).split('\0')
+
+
+class ObjectBackend:
+    """
+    Read history from git objects in process, no git process is spawned. Commits are walked in
+    the order of git log with the same --since and --until rules, numstat entries are computed
+    by gitdiff with the default rename detection of git log.
+    """
+
+    def __init__(self, repo_dir: str):
+        self.directory = repo_dir
+        self.git_dir, self.common_dir = find_git_dirs(repo_dir)
+        self.config = read_config(os.path.join(self.common_dir, 'config'))
+        self.check_supported()
+        objects_dir = os.path.join(self.common_dir, 'objects')
+        self.objects = gitobjects.ObjectStore(objects_dir)
+        self.graph = gitobjects.CommitGraph(objects_dir)
+        # Parents of commits at the boundary of a shallow clone are cut off
+        self.shallow = set()
+        try:
+            with open(os.path.join(self.common_dir, 'shallow'), encoding='utf8') as f:
+                self.shallow = {bytes.fromhex(line) for line in f.read().split()}
+        except FileNotFoundError:
+            pass
+
+    def check_supported(self):
+        """ Raise ValueError for repos whose history only git can read correctly. """
+        object_format = self.config.get('extensions.objectformat', 'sha1').lower()
+        if object_format != 'sha1':
+            raise ValueError('{0} object format is not supported'.format(object_format))
+        if 'extensions.refstorage' in self.config:
+            raise ValueError('reftable is not supported')
+        # Objects of partial clones are fetched by git when they are needed
+        if 'extensions.partialclone' in self.config or any(
+                key.endswith('.promisor') and value.lower() == 'true'
+                for key, value in self.config.items()):
+            raise ValueError('partial clone is not supported')
+        if os.path.exists(os.path.join(self.common_dir, 'info', 'grafts')):
+            raise ValueError('grafts are not supported')
+        if any(name.startswith('refs/replace/') for name in gitobjects.read_refs(self.common_dir)):
+            raise ValueError('replace refs are not supported')
+
+    def get_remote_url(self) -> str:
+        return self.config.get('remote.origin.url', '')
+
+    def read_refs(self) -> Dict[str, str]:
+        refs = gitobjects.read_refs(self.common_dir)
+        try:
+            with open(os.path.join(self.git_dir, 'HEAD'), encoding='utf8') as f:
+                refs['HEAD'] = f.read().strip()
+        except FileNotFoundError:
+            pass
+        return refs
+
+    @staticmethod
+    def resolve_ref(refs: Dict[str, str], name: str) -> str:
+        """ Id the ref points to with symbolic refs followed, empty if it's broken. """
+        target = refs.get(name, '')
+        for _ in range(5):
+            if not target.startswith('ref:'):
+                break
+            target = refs.get(target[4:].strip(), '')
+        return target if len(target) == 40 else ''
+
+    def get_tips(self, branches: str) -> List[str]:
+        """ Sorted ids of commits the branches point to, see conf.branches. """
+        refs = self.read_refs()
+        if branches:
+            patterns = git_all_branches if branches == 'all' else branches.split()
+            tips = {self.resolve_ref(refs, name) for name in refs
+                    if name != 'HEAD' and any(match_ref(pattern, name) for pattern in patterns)}
+            return sorted(tip for tip in tips if tip)
+        # Use master branch if it exists, `master` is resolved as git rev-parse does
+        names = ['HEAD']
+        if 'refs/heads/master' in refs:
+            names = ['refs/master', 'refs/tags/master', 'refs/heads/master']
+        for name in names:
+            tip = self.resolve_ref(refs, name)
+            if tip:
+                return [tip]
+        return []
+
+    def is_reachable(self, commit_ids: List[str], tips: List[str]) -> bool:
+        """ Check if all commits are reachable from tips, false if any of them no longer exists. """
+        try:
+            walk = RevWalk(self)
+            return next(walk.run(commit_ids + ['^' + tip for tip in tips]), None) is None
+        except (KeyError, ValueError):
+            return False
+
+    def iter_log(self, revs: List[str], begin: int, end: int) -> Iterator[Record]:
+        """ Commits reachable from revs and committed in [begin, end], like git log. """
+        walk = RevWalk(self)
+        for oid in walk.run(revs, since=begin, until=end):
+            info = walk.infos.pop(oid, None) or self.read_commit(oid)
+            tree, parents, _ = walk.nodes[oid]
+            num_stat = []
+            # git log shows no diff of merges
+            if len(parents) < 2:
+                parent_tree = walk.get_node(parents[0])[0] if parents else None
+                num_stat = self.get_num_stat(parent_tree, tree)
+            yield self.get_fields(oid, parents, info), num_stat
+
+    def iter_commits(self, commit_ids: List[str]) -> Iterator[Record]:
+        """ Commits of the ids in order without numstat, unknown ids are skipped. """
+        for commit_id in commit_ids:
+            try:
+                oid = bytes.fromhex(commit_id)
+                info = self.read_commit(oid)
+            except (KeyError, ValueError):
+                continue
+            parents = [] if oid in self.shallow else info.parents
+            yield self.get_fields(oid, parents, info), []
+
+    @staticmethod
+    def get_fields(oid: bytes, parents: List[bytes], info: gitobjects.CommitInfo) -> List[str]:
+        return [oid.hex(), ' '.join(parent.hex() for parent in parents), info.author, info.email,
+                str(info.author_time), info.subject]
+
+    def read_commit(self, oid: bytes) -> gitobjects.CommitInfo:
+        return gitobjects.parse_commit(self.objects.read_typed(oid, 'commit'))
+
+    def read_tree(self, oid: bytes) -> List[Tuple[bytes, int, bytes]]:
+        return gitobjects.parse_tree(self.objects.read_typed(oid, 'tree'))
+
+    def peel(self, oid: bytes) -> Optional[bytes]:
+        """ The commit a tag points to, None if the object isn't a commit. """
+        for _ in range(8):
+            if self.graph.lookup(oid) is not None:
+                return oid
+            obj_type, data = self.objects.read(oid)
+            if obj_type != 'tag':
+                return oid if obj_type == 'commit' else None
+            oid = gitobjects.parse_tag_target(data)
+        return None
+
+    def get_head_tree(self) -> str:
+        tip = self.resolve_ref(self.read_refs(), 'HEAD')
+        if not tip:
+            return ''
+        try:
+            return self.read_commit(bytes.fromhex(tip)).tree.hex()
+        except (KeyError, ValueError):
+            return ''
+
+    def get_head_files(self) -> List[str]:
+        tree = self.get_head_tree()
+        if not tree:
+            return []
+        return [path.decode('utf8', errors='replace')
+                for path in self.iter_tree_files(bytes.fromhex(tree))]
+
+    def iter_tree_files(self, tree: bytes, prefix=b'') -> Iterator[bytes]:
+        """ Paths of files in the tree recursively, in the order of git ls-tree -r. """
+        for name, mode, oid in self.read_tree(tree):
+            if mode == tree_mode:
+                yield from self.iter_tree_files(oid, prefix + name + b'/')
+            else:
+                yield prefix + name
+
+    def diff_trees(self, old_tree: Optional[bytes], new_tree: Optional[bytes],
+                   prefix=b'') -> Iterator[Tuple[bytes, Optional[Tuple], Optional[Tuple]]]:
+        """ Yield (path, old (mode, id), new (mode, id)) of changed files like git diff-tree -r. """
+        if old_tree == new_tree:
+            return
+        old = {tree_key(name, mode): (name, mode, oid)
+               for name, mode, oid in (self.read_tree(old_tree) if old_tree else [])}
+        new = {tree_key(name, mode): (name, mode, oid)
+               for name, mode, oid in (self.read_tree(new_tree) if new_tree else [])}
+        # Entries are compared in the order of git, directories sort as if they end with /
+        for key in sorted(old.keys() | new.keys()):
+            old_entry, new_entry = old.get(key), new.get(key)
+            if old_entry and new_entry and old_entry[1:] == new_entry[1:]:
+                continue
+            path = prefix + (old_entry or new_entry)[0]
+            if key.endswith(b'/'):
+                yield from self.diff_trees(old_entry and old_entry[2], new_entry and new_entry[2],
+                                           path + b'/')
+            else:
+                yield path, old_entry and old_entry[1:], new_entry and new_entry[1:]
+
+    def load(self, spec: gitdiff.FileSpec) -> bytes:
+        if spec.data is None:
+            if spec.mode == gitlink_mode:
+                spec.data = 'Subproject commit {0}\n'.format(spec.oid.hex()).encode()
+            else:
+                spec.data = self.objects.read_typed(spec.oid, 'blob')
+        return spec.data
+
+    def get_num_stat(self, old_tree: Optional[bytes],
+                     new_tree: bytes) -> List[Tuple[str, str, str]]:
+        """ Numstat entries of the diff between trees, with renames detected. """
+        pairs, deleted, added = [], [], []
+        for path, old, new in self.diff_trees(old_tree, new_tree):
+            old_spec = old and gitdiff.FileSpec(path, *old)
+            new_spec = new and gitdiff.FileSpec(path, *new)
+            if old_spec and new_spec:
+                pairs.append((old_spec, new_spec))
+            elif old_spec:
+                deleted.append(old_spec)
+            else:
+                added.append(new_spec)
+        if deleted and added:
+            renames = gitdiff.find_renames(deleted, added, self.load)
+            pairs.extend((deleted[i], added[j]) for j, i in renames.items())
+            renamed = set(renames.values())
+            deleted = [spec for i, spec in enumerate(deleted) if i not in renamed]
+            added = [spec for j, spec in enumerate(added) if j not in renames]
+        pairs.extend((spec, None) for spec in deleted)
+        pairs.extend((None, spec) for spec in added)
+        num_stat = []
+        for old_spec, new_spec in pairs:
+            old_data = self.load(old_spec) if old_spec else b''
+            new_data = self.load(new_spec) if new_spec else b''
+            path = (new_spec or old_spec).path.decode('utf8', errors='replace')
+            if gitdiff.is_binary(old_data) or gitdiff.is_binary(new_data):
+                num_stat.append(('-', '-', path))
+                continue
+            if old_spec and new_spec and old_spec.oid == new_spec.oid:
+                insertions = deletions = 0
+            else:
+                insertions, deletions = gitdiff.count_changes(old_data, new_data)
+            num_stat.append((str(insertions), str(deletions), path))
+        return num_stat
+
+
+class RevWalk:
+    """
+    Walk commits like git log. Commits are popped by commit date, a walk with excluded revisions
+    marks their ancestors uninteresting and stops when only uninteresting commits are left,
+    like limit_list() of git.
+    """
+    slop = 5
+
+    def __init__(self, backend: ObjectBackend):
+        self.backend = backend
+        # Commit id -> (tree, parents, commit date) of commits met by the walk
+        self.nodes = {}
+        # Commits in the time range parsed by the walk, so they aren't parsed again for output
+        self.infos = {}
+        self.since = self.until = None
+        self.seen = set()
+        self.uninteresting = set()
+        self.queue = []
+        self.counter = count()
+
+    def get_node(self, oid: bytes) -> Tuple[bytes, List[bytes], int]:
+        node = self.nodes.get(oid)
+        if node is None:
+            node = self.backend.graph.lookup(oid)
+            if node is None:
+                info = self.backend.read_commit(oid)
+                node = (info.tree, info.parents, info.date)
+                if self.in_range(info.date):
+                    self.infos[oid] = info
+            if oid in self.backend.shallow:
+                node = (node[0], [], node[2])
+            self.nodes[oid] = node
+        return node
+
+    def in_range(self, date: int) -> bool:
+        return ((self.since is None or date >= self.since) and
+                (self.until is None or date <= self.until))
+
+    def push(self, oid: bytes):
+        """ Newer commits are popped first, commits of the same date in the order they came. """
+        self.seen.add(oid)
+        heapq.heappush(self.queue, (-self.get_node(oid)[2], next(self.counter), oid))
+
+    def mark_uninteresting(self, oid: bytes):
+        """ Mark the commit and its ancestors met so far uninteresting. """
+        stack = [oid]
+        while stack:
+            oid = stack.pop()
+            if oid in self.uninteresting:
+                continue
+            self.uninteresting.add(oid)
+            node = self.nodes.get(oid)
+            if node:
+                stack.extend(node[1])
+
+    def process_parents(self, oid: bytes):
+        if oid in self.uninteresting:
+            for parent in self.get_node(oid)[1]:
+                self.uninteresting.add(parent)
+                try:
+                    grandparents = self.get_node(parent)[1]
+                except KeyError:  # history of uninteresting commits may be missing
+                    continue
+                for grandparent in grandparents:
+                    self.mark_uninteresting(grandparent)
+                if parent not in self.seen:
+                    self.push(parent)
+            return
+        for parent in self.get_node(oid)[1]:
+            if parent not in self.seen:
+                self.push(parent)
+
+    def run(self, revs: List[str], since: int = None, until: int = None) -> Iterator[bytes]:
+        """
+        Yield ids of commits reachable from revs but not from revs starting with ^, whose
+        commit dates are in [since, until].
+        """
+        self.since, self.until = since, until
+        limited = False
+        tips = []
+        for rev in revs:
+            excluded = rev.startswith('^')
+            oid = self.backend.peel(bytes.fromhex(rev.lstrip('^')))
+            if oid is None:
+                continue
+            if excluded:
+                limited = True
+                self.uninteresting.add(oid)
+                for parent in self.get_node(oid)[1]:
+                    self.mark_uninteresting(parent)
+            tips.append(oid)
+        for oid in tips:
+            if oid not in self.seen:
+                self.push(oid)
+        return self.run_limited() if limited else self.run_unlimited()
+
+    def run_unlimited(self) -> Iterator[bytes]:
+        while self.queue:
+            _, _, oid = heapq.heappop(self.queue)
+            date = self.nodes[oid][2]
+            # History behind a commit older than the range isn't walked
+            if self.since is not None and date < self.since:
+                continue
+            self.process_parents(oid)
+            if self.until is None or date <= self.until:
+                yield oid
+
+    def run_limited(self) -> Iterator[bytes]:
+        commits = []
+        last_date = float('inf')
+        slop = self.slop
+        while self.queue:
+            _, _, oid = heapq.heappop(self.queue)
+            date = self.nodes[oid][2]
+            if self.since is not None and date < self.since:
+                self.uninteresting.add(oid)
+            self.process_parents(oid)
+            if oid in self.uninteresting:
+                slop = self.still_interesting(last_date, slop)
+                if slop:
+                    continue
+                break
+            if self.until is not None and date > self.until:
+                continue
+            last_date = date
+            commits.append(oid)
+        # Commits may be found uninteresting after they are walked
+        return (oid for oid in commits if oid not in self.uninteresting)
+
+    def still_interesting(self, last_date: float, slop: int) -> int:
+        """ Keep walking a few more commits after the queue has only uninteresting ones. """
+        if not self.queue:
+            return 0
+        if last_date <= -self.queue[0][0]:
+            return self.slop
+        if any(oid not in self.uninteresting for _, _, oid in self.queue):
+            return self.slop
+        return slop - 1
+
+
+backends = {
+    'subprocess': SubprocessBackend,
+    'inprocess': ObjectBackend,
+}
+
+
+def get_backend(ctx: util.DotDict, repo_dir: str):
+    """ The backend of conf.history_backend, git commands are used if it can't read the repo. """
+    name = ctx.history_backend or conf.history_backend
+    if name not in backends:
+        raise ValueError('Unknown history backend: {0}'.format(name))
+    try:
+        return backends[name](repo_dir)
+    except (OSError, ValueError) as e:
+        if name == 'subprocess':
+            raise
+        print('Warning: read history of {0} by git commands, reason: {1}'.format(repo_dir, e))
+        return SubprocessBackend(repo_dir)
+
+
+def find_git_dirs(repo_dir: str) -> Tuple[str, str]:
+    """ Return the git directory of the work tree, and the common directory of its worktrees. """
+    path = os.path.realpath(repo_dir)
+    while True:
+        dot_git = os.path.join(path, '.git')
+        if os.path.isdir(dot_git):
+            git_dir = dot_git
+            break
+        if os.path.isfile(dot_git):  # worktrees and submodules
+            with open(dot_git, encoding='utf8') as f:
+                content = f.read().strip()
+            if not content.startswith('gitdir:'):
+                raise ValueError('Invalid .git file: {0}'.format(dot_git))
+            git_dir = os.path.join(path, content[7:].strip())
+            break
+        if os.path.isfile(os.path.join(path, 'HEAD')) and os.path.isdir(
+                os.path.join(path, 'objects')):  # bare repository
+            git_dir = path
+            break
+        parent = os.path.dirname(path)
+        if parent == path:
+            raise ValueError('{0} is not a git repository'.format(repo_dir))
+        path = parent
+    common_dir = git_dir
+    try:
+        with open(os.path.join(git_dir, 'commondir'), encoding='utf8') as f:
+            common_dir = os.path.join(git_dir, f.read().strip())
+    except FileNotFoundError:
+        pass
+    return os.path.realpath(git_dir), os.path.realpath(common_dir)
+
+
+def read_config(path: str) -> Dict[str, str]:
+    """ {section.subsection.key: value} of a git config file, included files are not read. """
+    config = {}
+    section = ''
+    try:
+        with open(path, encoding='utf8') as f:
+            lines = f.read().split('\n')
+    except FileNotFoundError:
+        return config
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] in '#;':
+            continue
+        if line.startswith('['):
+            name, _, subsection = line[1:line.find(']')].partition(' ')
+            section = name.strip().lower()
+            if subsection:
+                section += '.' + subsection.strip().strip('"')
+            continue
+        key, _, value = line.partition('=')
+        value = value.strip()
+        if len(value) > 1 and value[0] == value[-1] == '"':
+            value = value[1:-1]
+        config['{0}.{1}'.format(section, key.strip().lower())] = value
+    return config
+
+
+def tree_key(name: bytes, mode: int) -> bytes:
+    return name + b'/' if mode == tree_mode else name
+
+
+def match_ref(pattern: str, name: str) -> bool:
+    """ Match a ref name like git for-each-ref: a prefix up to a slash, or a glob. """
+    prefix = pattern.rstrip('/')
+    return name == prefix or name.startswith(prefix + '/') or fnmatch.fnmatchcase(name, pattern)
+
+
+def main():
+    """ Compare commits read by both backends, e.g. python3 backend.py ../repo --year 2018. """
+    parser = argparse.ArgumentParser(description='Validate the in-process history backend.')
+    parser.add_argument('repo_dir')
+    parser.add_argument('--year', type=int, default=2018)
+    parser.add_argument('--branches', default=conf.branches)
+    args = parser.parse_args()
+    begin, end = util.get_year_ends(args.year)
+    expected, actual = SubprocessBackend(args.repo_dir), ObjectBackend(args.repo_dir)
+    tips = expected.get_tips(args.branches)
+    if actual.get_tips(args.branches) != tips:
+        print('Different tips: {0} {1}'.format(tips, actual.get_tips(args.branches)))
+    records = list(expected.iter_log(tips, begin, end))
+    differences = 0
+    for i, (record, other) in enumerate(zip(records, actual.iter_log(tips, begin, end))):
+        fields, num_stat = record
+        if other[0] != fields or sorted(other[1]) != sorted(num_stat):
+            differences += 1
+            print('Commit {0} differs:\n  {1}\n  {2}'.format(i, record, other))
+    count_other = sum(1 for _ in actual.iter_log(tips, begin, end))
+    if count_other != len(records):
+        print('{0} commits by git, {1} in process'.format(len(records), count_other))
+    print('{0} commits compared, {1} differ'.format(len(records), differences))
+
+
+if __name__ == '__main__':
+    main()
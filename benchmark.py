@@ -0,0 +1,350 @@
+# coding: utf8
+"""
+Benchmarks of parsing, aggregation and rendering on a deterministic synthetic repository, results
+are saved as JSON, e.g. python3 benchmark.py --commits 5000 --compare output/benchmark.json.
+"""
+import argparse
+import calendar
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import List, Dict, Any, Tuple, Callable, Optional, BinaryIO
+
+import util
+from main import RUN_DIR
+from report import Reporter
+from repository import Repo, Repos
+from store import CommitStore
+
+# Extensions of generated code files, in the order languages are added, see --languages
+code_extensions = ['py', 'go', 'java', 'js', 'c', 'rb', 'ts', 'cpp', 'php', 'swift']
+# Extensions of generated files which aren't code
+other_extensions = ['md', 'txt', 'json']
+# Generated vendored files are put in these directories, which conf.ignore_directories ignores
+vendor_directories = ['vendor', 'build']
+source_directories = ['src', 'app', 'core', 'api', 'utils', 'models', 'tests', 'docs']
+# Bump it when results are no longer comparable with earlier runs
+result_version = 1
+
+default_spec = {
+    'commits': 2000,
+    'authors': 20,
+    'files': 400,
+    'languages': 4,
+    'merge_ratio': 0.1,
+    'vendor_ratio': 0.1,
+    'seed': 0,
+    'year': 2018,
+}
+
+
+def generate_repo(repo_dir: str, spec: util.DotDict) -> str:
+    """
+    Generate a git repository of spec by git fast-import and return the id of master, the same
+    spec makes the same commits. Merge commits merge topic branches of 1 to 3 commits, the first
+    author dev0@example.com is the user of reports, see get_bench_ctx().
+    """
+    rand = random.Random(spec.seed)
+    os.makedirs(repo_dir, exist_ok=True)
+    util.run('git init --quiet && git symbolic-ref HEAD refs/heads/master', cwd=repo_dir)
+    authors = [('Dev {0}'.format(i), 'dev{0}@example.com'.format(i)) for i in range(spec.authors)]
+    # A few authors make most commits, like in real teams
+    author_weights = [1 / (i + 1) for i in range(spec.authors)]
+    paths = get_paths(rand, spec)
+    timestamps = get_timestamps(rand, spec)
+    contents = {}
+    proc = subprocess.Popen(['git', 'fast-import', '--quiet'], stdin=subprocess.PIPE, cwd=repo_dir)
+    mark = head = 0
+    i = 0
+    while i < spec.commits:
+        author = rand.choices(authors, author_weights)[0]
+        if head and i + 2 < spec.commits and rand.random() < spec.merge_ratio:
+            topic, changed = head, set()
+            for _ in range(rand.randint(1, min(3, spec.commits - i - 1))):
+                changes = edit_files(rand, paths, contents)
+                changed.update(path for path, _ in changes)
+                mark += 1
+                write_commit(proc.stdin, mark, 'refs/heads/topic', author, timestamps[i],
+                             get_subject(changes), [topic], changes)
+                topic = mark
+                i += 1
+            # Someone else merges the topic branch, so the merge graph isn't empty
+            merger = rand.choices(authors, author_weights)[0]
+            changes = [(path, contents.get(path)) for path in sorted(changed)]
+            mark += 1
+            write_commit(proc.stdin, mark, 'refs/heads/master', merger, timestamps[i],
+                         "Merge branch 'topic'", [head, topic], changes)
+        else:
+            changes = edit_files(rand, paths, contents)
+            mark += 1
+            write_commit(proc.stdin, mark, 'refs/heads/master', author, timestamps[i],
+                         get_subject(changes), [head] if head else [], changes)
+        head = mark
+        i += 1
+    proc.stdin.close()
+    if proc.wait():
+        raise subprocess.CalledProcessError(proc.returncode, 'git fast-import')
+    return util.run('git rev-parse refs/heads/master', cwd=repo_dir)
+
+
+def get_paths(rand: random.Random, spec: util.DotDict) -> List[str]:
+    """ Paths of files in the repo, vendored files are about vendor_ratio of them. """
+    extensions = code_extensions[:spec.languages]
+    paths = set()
+    while len(paths) < spec.files:
+        parts = rand.sample(source_directories, rand.randint(0, 2))
+        if rand.random() < spec.vendor_ratio:
+            parts.insert(0, rand.choice(vendor_directories))
+        if extensions and rand.random() < 0.8:
+            extension = rand.choice(extensions)
+        else:
+            extension = rand.choice(other_extensions)
+        parts.append('file{0}.{1}'.format(rand.randrange(spec.files * 4), extension))
+        paths.add('/'.join(parts))
+    return sorted(paths)
+
+
+def get_timestamps(rand: random.Random, spec: util.DotDict) -> List[int]:
+    """ Sorted commit times in the year of spec, most of them in working hours. """
+    begin = calendar.timegm(datetime(spec.year, 1, 1).timetuple())
+    days = 366 if calendar.isleap(spec.year) else 365
+    hour_weights = [1 if hour < 9 or hour > 21 else 8 for hour in range(24)]
+    timestamps = []
+    for _ in range(spec.commits):
+        hour = rand.choices(range(24), hour_weights)[0]
+        timestamps.append(begin + rand.randrange(days) * 86400 + hour * 3600 +
+                          rand.randrange(3600))
+    return sorted(timestamps)
+
+
+def edit_files(rand: random.Random, paths: List[str],
+               contents: Dict[str, List[str]]) -> List[Tuple[str, Optional[List[str]]]]:
+    """
+    Edit files in contents like a commit does and return [(path, lines or None if deleted)].
+    A few commits change lots of files, like generated code does.
+    """
+    size = rand.randint(20, 60) if rand.random() < 0.03 else rand.randint(1, 4)
+    changes = []
+    for path in rand.sample(paths, min(size, len(paths))):
+        lines = contents.get(path)
+        if lines is None:
+            lines = contents[path] = [get_line(rand) for _ in range(rand.randint(10, 200))]
+        elif rand.random() < 0.02:
+            del contents[path]
+            lines = None
+        else:
+            pos = rand.randrange(len(lines) + 1)
+            del lines[pos:pos + rand.randint(0, 10)]
+            lines[pos:pos] = [get_line(rand) for _ in range(rand.randint(0, 30))]
+        changes.append((path, lines))
+    return changes
+
+
+def get_line(rand: random.Random) -> str:
+    return '{0}value_{1} = {2}\n'.format(' ' * 4 * rand.randint(0, 3), rand.randrange(1000),
+                                         rand.randrange(1 << 30))
+
+
+def get_subject(changes: List[Tuple[str, Any]]) -> str:
+    return 'Update {0} and {1} more'.format(os.path.basename(changes[0][0]), len(changes) - 1)
+
+
+def write_commit(out: BinaryIO, mark: int, ref: str, author: Tuple[str, str], timestamp: int,
+                 message: str, parents: List[int], changes: List[Tuple[str, Any]]):
+    """ Write a commit in the format of git fast-import, parents are marks of commits. """
+    ident = '{0} <{1}> {2} +0800'.format(author[0], author[1], timestamp)
+    lines = ['commit ' + ref, 'mark :{0}'.format(mark), 'author ' + ident, 'committer ' + ident]
+    out.write(('\n'.join(lines) + '\n').encode('utf8'))
+    write_data(out, message.encode('utf8'))
+    for i, parent in enumerate(parents):
+        out.write('{0} :{1}\n'.format('merge' if i else 'from', parent).encode('utf8'))
+    for path, lines in changes:
+        if lines is None:
+            out.write('D {0}\n'.format(path).encode('utf8'))
+            continue
+        out.write('M 100644 inline {0}\n'.format(path).encode('utf8'))
+        write_data(out, ''.join(lines).encode('utf8'))
+    out.write(b'\n')
+
+
+def write_data(out: BinaryIO, data: bytes):
+    out.write('data {0}\n'.format(len(data)).encode('utf8'))
+    out.write(data)
+    out.write(b'\n')
+
+
+class Benchmark:
+    """ Run functions several times and keep their times in seconds by name. """
+
+    def __init__(self, repeat: int):
+        self.repeat = repeat
+        self.results = {}
+
+    def run(self, name: str, func: Callable, setup: Callable = None):
+        """ Time func, setup is called before each run and isn't timed. """
+        runs = []
+        for _ in range(self.repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            func()
+            runs.append(time.perf_counter() - start)
+        self.results[name] = {'runs': runs, 'min': min(runs), 'median': statistics.median(runs)}
+        print('{0:<32}{1:>10.4f}s'.format(name, self.results[name]['median']))
+
+
+def get_bench_ctx(repo_dir: str, run_dir: str, spec: util.DotDict) -> util.DotDict:
+    """ Context of the user of generated repos, caches and outputs are kept in run_dir. """
+    return util.DotDict({
+        'run_dir': run_dir,
+        'output_dir': os.path.join(run_dir, 'output'),
+        'name': 'Dev 0',
+        'emails': ['dev0@example.com'],
+        'git_inputs': [repo_dir],
+        'encrypt': False,
+        'year': spec.year,
+        'trend_years': 2,
+        'render_workers': 1,
+        'linguist_enabled': False,
+    })
+
+
+def run_benchmarks(repo_dir: str, run_dir: str, spec: util.DotDict,
+                   repeat: int) -> Dict[str, Any]:
+    ctx = get_bench_ctx(repo_dir, run_dir, spec)
+    cache_dir = os.path.join(run_dir, 'cache')
+    bench = Benchmark(repeat)
+
+    def clear_cache():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    repo = Repo(repo_dir, ctx)
+
+    def reset_commits():
+        repo.commit_list = CommitStore()
+
+    bench.run('parse_git_commits', repo.parse_git_commits,
+              setup=lambda: (clear_cache(), reset_commits()))
+    repo.parse_git_commits()
+    bench.run('parse_git_commits_cached', repo.parse_git_commits, setup=reset_commits)
+    reset_commits()
+    repo.parse_git_commits()
+
+    since, until = util.get_time_range(ctx)
+    records = list(repo.backend.iter_log(repo.get_tips(), since, until - 1))
+
+    def parse_commit_stat():
+        for _, num_stat in records:
+            repo.parse_commit_stat(num_stat)
+
+    def reset_classifier():
+        repo.classifier = repo.get_path_classifier()
+
+    bench.run('parse_commit_stat', parse_commit_stat, setup=reset_classifier)
+
+    repos = Repos(ctx, [repo])
+
+    def reset_merges():
+        repos.invalidate()
+        repo.commit_dict = {}
+        repo.old_commits = CommitStore()
+
+    bench.run('get_merge_stat', repos.get_merge_stat, setup=reset_merges)
+
+    reporter = Reporter(ctx, repos)
+    bench.run('write_stat', reporter.write_stat, setup=repos.invalidate)
+    for name in sorted(name for name in dir(Reporter) if name.startswith('draw_')):
+        bench.run(name, getattr(reporter, name), setup=repos.invalidate)
+    reporter.report_file.close()
+
+    def generate_report():
+        end_to_end = Reporter(ctx)
+        end_to_end.generate_report()
+        end_to_end.report_file.close()
+
+    bench.run('generate_report', generate_report, setup=clear_cache)
+    bench.run('generate_report_cached', generate_report)
+    return {
+        'commits': len(repo.commit_list),
+        'user_commits': len(repo.user_commits),
+        'results': bench.results,
+    }
+
+
+def get_environment() -> Dict[str, Any]:
+    revision = ''
+    if util.run_with_check('git rev-parse --git-dir', cwd=RUN_DIR):
+        revision = util.run('git rev-parse HEAD', cwd=RUN_DIR, check=False)
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'git': util.run('git --version'),
+        'revision': revision,
+    }
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any]):
+    """ Print median times of both runs, benchmarks 10% slower than before are marked. """
+    if old.get('spec') != new['spec']:
+        print('Warning: specs of the runs differ, times may not be comparable')
+    print('{0:<32}{1:>11}{2:>11}{3:>9}'.format('benchmark', 'old', 'new', 'ratio'))
+    for name, result in new['results'].items():
+        old_result = old.get('results', {}).get(name)
+        if not old_result:
+            print('{0:<32}{1:>11}{2:>10.4f}s'.format(name, '-', result['median']))
+            continue
+        ratio = result['median'] / old_result['median'] if old_result['median'] else 0
+        mark = '  slower' if ratio > 1.1 else ''
+        print('{0:<32}{1:>10.4f}s{2:>10.4f}s{3:>9.2f}{4}'.format(
+            name, old_result['median'], result['median'], ratio, mark))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark on a synthetic git repository.')
+    for key, value in default_spec.items():
+        parser.add_argument('--' + key.replace('_', '-'), type=type(value), default=value)
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each benchmark')
+    parser.add_argument('--repo-dir', help='generate the repository here and keep it, it is '
+                                           'reused if it exists')
+    parser.add_argument('--output', default=os.path.join(RUN_DIR, 'output', 'benchmark.json'))
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    args = parser.parse_args()
+    spec = util.DotDict({key: getattr(args, key) for key in default_spec})
+    tmp_dir = tempfile.mkdtemp(prefix='year2018-bench-')
+    try:
+        repo_dir = args.repo_dir or os.path.join(tmp_dir, 'repo')
+        start = time.perf_counter()
+        if not os.path.isdir(repo_dir):
+            generate_repo(repo_dir, spec)
+            print('Generated {0} in {1:.2f}s'.format(repo_dir, time.perf_counter() - start))
+        run_dir = os.path.join(tmp_dir, 'run')
+        res = {
+            'version': result_version,
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'spec': spec,
+            'environment': get_environment(),
+            'repeat': args.repeat,
+        }
+        res.update(run_benchmarks(repo_dir, run_dir, spec, args.repeat))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w', encoding='utf8') as f:
+        json.dump(res, f, indent=2, sort_keys=True)
+    print('Results are saved in ' + args.output)
+    if args.compare:
+        with open(args.compare, encoding='utf8') as f:
+            compare(json.load(f), res)
+
+
+if __name__ == '__main__':
+    main()
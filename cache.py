@@ -0,0 +1,123 @@
+# coding: utf8
+import hashlib
+import json
+import os
+import threading
+from typing import List, Dict, Any, Optional
+
+import conf
+import util
+
+# Bump it when the format of cached commits changes
+cache_version = 3
+
+
+class CommitCache:
+    """
+    Parsed commits of one repository in the time range of the report, saved under
+    run_dir/cache/commits. The cache records the tips it was built from, so a later run only
+    parses the new commits.
+    """
+
+    def __init__(self, ctx: util.DotDict, source: str):
+        self.enabled = conf.commit_cache
+        key = json.dumps([cache_version, source, util.get_time_range(ctx),
+                          bool(ctx.linguist_enabled), ctx.branches or conf.branches,
+                          conf.ignore_directories, conf.code_file_extensions], sort_keys=True)
+        file_name = hashlib.sha1(key.encode('utf8')).hexdigest() + '.json'
+        self.path = os.path.join(ctx.run_dir, 'cache', 'commits', file_name)
+
+    def load(self) -> Dict[str, Any]:
+        """ Return {'tips': [tip], 'commits': [commit record]}, or an empty dict on a miss. """
+        if not self.enabled:
+            return {}
+        return read_json(self.path)
+
+    def save(self, tips: List[str], commits: List[List[Any]]):
+        if not self.enabled:
+            return
+        write_json(self.path, {'tips': tips, 'commits': commits})
+
+
+class RollupCache:
+    """
+    Monthly rollups of commits of one repository, saved under run_dir/cache/rollups. Like
+    CommitCache it records the tips it was built from, and the time range it covers as well, so
+    the trend of several years is updated by the new commits and months only.
+    """
+
+    def __init__(self, ctx: util.DotDict, source: str):
+        self.enabled = conf.commit_cache
+        key = json.dumps([cache_version, source, bool(ctx.linguist_enabled),
+                          ctx.branches or conf.branches, conf.ignore_directories,
+                          conf.code_file_extensions], sort_keys=True)
+        file_name = hashlib.sha1(key.encode('utf8')).hexdigest() + '.json'
+        self.path = os.path.join(ctx.run_dir, 'cache', 'rollups', file_name)
+
+    def load(self) -> Dict[str, Any]:
+        """ Return {'tips': [tip], 'since': since, 'until': until, 'months': rollups}. """
+        if not self.enabled:
+            return {}
+        return read_json(self.path)
+
+    def save(self, tips: List[str], since: int, until: int, months: Dict[str, Any]):
+        if not self.enabled:
+            return
+        write_json(self.path, {'tips': tips, 'since': since, 'until': until, 'months': months})
+
+
+class LinguistCache:
+    """
+    Linguist results saved under run_dir/cache/linguist and keyed by tree id, so an unchanged tree
+    is never classified again. The last linguist file cache of each repo is kept as well, with it
+    linguist only classifies the blobs changed since then.
+    """
+
+    def __init__(self, ctx: util.DotDict, source: str):
+        self.enabled = conf.linguist_cache
+        self.directory = os.path.join(ctx.run_dir, 'cache', 'linguist')
+        key = json.dumps([cache_version, source])
+        file_name = 'repo-' + hashlib.sha1(key.encode('utf8')).hexdigest() + '.json'
+        self.state_path = os.path.join(self.directory, file_name)
+
+    def load_result(self, tree: str) -> Optional[Dict[str, List[str]]]:
+        """ Return {language: [file]} of the tree, or None on a miss. """
+        if not self.enabled or not tree:
+            return None
+        return read_json(os.path.join(self.directory, tree + '.json')).get('breakdown')
+
+    def save_result(self, tree: str, breakdown: Dict[str, List[str]]):
+        if not self.enabled or not tree:
+            return
+        write_json(os.path.join(self.directory, tree + '.json'), {'breakdown': breakdown})
+
+    def load_state(self) -> Dict[str, Any]:
+        """ Return {'commit': commit, 'cache': linguist cache of the commit} of the repo. """
+        if not self.enabled:
+            return {}
+        return read_json(self.state_path)
+
+    def save_state(self, commit: str, linguist_cache: Dict[str, Any]):
+        if not self.enabled:
+            return
+        write_json(self.state_path, {'commit': commit, 'cache': linguist_cache})
+
+
+def read_json(path: str) -> Any:
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, encoding='utf8') as f:
+            return json.load(f)
+    except Exception as e:
+        print('Ignore broken cache {0}: {1}'.format(path, e))
+        return {}
+
+
+def write_json(path: str, data: Any):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first, a killed run mustn't leave a truncated cache
+    tmp_path = '{0}.tmp.{1}.{2}'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
@@ -0,0 +1,109 @@
+# coding: utf8
+"""Detect languages of changed files with rules compiled once from conf."""
+import functools
+import re
+import threading
+from typing import Dict, List, Set, Any
+
+import conf
+
+rules_lock = threading.Lock()
+compiled_rules = None
+
+
+def glob_to_regex(pattern: str) -> str:
+    """
+    Translate a gitignore style directory pattern to a regex matching the paths under it. A pattern
+    matches the directory at any depth unless it contains a slash, then it's relative to the root.
+    """
+    anchored = '/' in pattern.strip().rstrip('/')
+    pattern = pattern.strip().strip('/')
+    res = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            res.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            res.append('.*')
+            i += 2
+            continue
+        char = pattern[i]
+        if char == '*':
+            res.append('[^/]*')
+        elif char == '?':
+            res.append('[^/]')
+        elif char == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            res.append('[' + chars.replace('\\', '\\\\') + ']')
+            i = end
+        else:
+            res.append(re.escape(char))
+        i += 1
+    prefix = '' if anchored else '(?:.*/)?'
+    return prefix + ''.join(res) + '/'
+
+
+def compile_patterns(patterns: List[str]) -> Any:
+    """ Compile patterns into one regex, None if there are no patterns. """
+    regexes = ['(?:{0})'.format(glob_to_regex(p)) for p in patterns if p.strip().strip('/')]
+    if not regexes:
+        return None
+    return re.compile('|'.join(regexes))
+
+
+class IgnoreRules:
+    """ Directories to ignore, for all languages and for each language. """
+
+    def __init__(self, ignore_directories: Dict[str, List[str]]):
+        self.common = compile_patterns(ignore_directories.get('common', []))
+        self.languages = {}
+        for language, patterns in ignore_directories.items():
+            regex = compile_patterns(patterns)
+            if language != 'common' and regex:
+                self.languages[language] = regex
+
+    def is_ignored(self, file_path: str, language='') -> bool:
+        regex = self.languages.get(language) if language else self.common
+        return bool(regex and regex.match(file_path))
+
+
+def get_ignore_rules() -> IgnoreRules:
+    """ Rules compiled from conf.ignore_directories, compiled only once. """
+    global compiled_rules
+    with rules_lock:
+        if compiled_rules is None:
+            compiled_rules = IgnoreRules(conf.ignore_directories)
+        return compiled_rules
+
+
+class PathClassifier:
+    """
+    Detect the language of files in one repo. Linguist results are used for files in the HEAD
+    tree, file extensions for other files. The same files change in many commits, so results are
+    kept in a bounded LRU.
+    """
+
+    def __init__(self, linguist_res: Dict[str, str] = None, head_files: Set[str] = None,
+                 cache_size=None):
+        self.rules = get_ignore_rules()
+        self.linguist_res = linguist_res
+        self.head_files = head_files or set()
+        cache_size = cache_size if cache_size is not None else conf.path_cache_size
+        self.detect = functools.lru_cache(maxsize=cache_size)(self.detect_uncached)
+
+    def detect_uncached(self, file_path: str) -> str:
+        if self.rules.is_ignored(file_path):
+            return ''
+        if self.linguist_res is not None and file_path in self.head_files:
+            language = self.linguist_res.get(file_path, '')
+        else:
+            extension = file_path.rsplit('.', maxsplit=1)[-1].strip().lower()
+            language = conf.code_file_extensions.get(extension, '')
+        if language and self.rules.is_ignored(file_path, language):
+            language = ''
+        return language
@@ -0,0 +1,103 @@
+# coding: utf8
+"""Clone remote repositories into user_repos/, or fetch new commits of existing clones."""
+import os
+import re
+import shlex
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any
+
+import conf
+import profiler
+import util
+
+# Blobs are left on the server by partial clones, see conf.partial_clone
+git_clone_tmpl = 'git clone --quiet {filter} {git_url} {repo_dir}'
+git_fetch_cmd = 'git fetch --quiet --prune origin'
+git_reset_cmd = 'git reset --quiet --hard "@{upstream}"'
+scheme_re = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*://')
+scp_url_re = re.compile(r'^[^/:]+:')
+user_info_re = re.compile(r'^[^/@]*@')
+
+# Clone directory -> the directory, or the exception if it failed to sync
+results = {}
+results_lock = threading.Lock()
+
+
+def get_clone_dir(ctx: util.DotDict, git_url: str) -> str:
+    """
+    The clone directory of git_url is user_repos/ followed by its host and path, e.g.
+    user_repos/github.com/a/proj for https://github.com/a/proj.git and git@github.com:a/proj, so
+    forks of a repo are cloned into their own directories.
+    """
+    url = git_url.strip().rstrip('/')
+    if url.endswith('.git'):
+        url = url[:-len('.git')]
+    if scheme_re.match(url):
+        url = scheme_re.sub('', url)
+    elif scp_url_re.match(url):  # [user@]host:path
+        url = url.replace(':', '/', 1)
+    # Leave out the user and the password, a port is kept in the host directory
+    url = user_info_re.sub('', url).replace(':', '_')
+    parts = [part for part in url.split('/') if part not in ('', '.', '..')]
+    return os.path.join(ctx.run_dir, 'user_repos', *parts)
+
+
+def sync(ctx: util.DotDict, git_url: str) -> str:
+    """
+    Clone the repo of git_url or fetch its new commits if it has been cloned, and return the
+    clone directory. A repo is synced only once by a process, later calls return the first result.
+    """
+    repo_dir = get_clone_dir(ctx, git_url)
+    with results_lock:
+        result = results.get(repo_dir)
+    if result is None:
+        try:
+            with profiler.span('sync', 'repo', url=git_url):
+                result = clone_or_fetch(git_url, repo_dir)
+        except Exception as e:
+            print('Error: fail to sync {0}, reason: {1}'.format(git_url, e))
+            result = e
+        with results_lock:
+            results[repo_dir] = result
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def clone_or_fetch(git_url: str, repo_dir: str) -> str:
+    if os.path.isdir(repo_dir):
+        util.run(git_fetch_cmd, stdout=None, cwd=repo_dir)
+        # The clone is only read by reports, move it to the fetched branch even if it was rewritten
+        if not util.run_with_check(git_reset_cmd, cwd=repo_dir):
+            print('Warning: {0} is not updated, its branch has no upstream'.format(repo_dir))
+        print('Fetch {0} succeed!'.format(git_url))
+        return repo_dir
+    os.makedirs(os.path.dirname(repo_dir), exist_ok=True)
+    cmd = git_clone_tmpl.format(filter='--filter=blob:none' if conf.partial_clone else '',
+                                git_url=shlex.quote(git_url), repo_dir=shlex.quote(repo_dir))
+    util.run(cmd, stdout=None)
+    print('Clone {0} succeed!'.format(git_url))
+    return repo_dir
+
+
+def sync_all(ctx: util.DotDict, git_urls: List[str]) -> Dict[str, Any]:
+    """
+    Sync repos of git_urls with at most conf.clone_workers git processes at a time. Return
+    {git_url: clone directory or the exception}, errors are printed as well.
+    """
+    def sync_url(git_url: str) -> Any:
+        try:
+            return sync(ctx, git_url)
+        except Exception as e:
+            return e
+
+    # Urls sharing a clone directory are synced once, by the first of them
+    first_urls = {}
+    for git_url in git_urls:
+        first_urls.setdefault(get_clone_dir(ctx, git_url), git_url)
+    workers = min(ctx.clone_workers or conf.clone_workers, len(first_urls))
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(sync_url, first_urls.values()))
+    return {git_url: sync_url(git_url) for git_url in git_urls}
@@ -1,6 +1,8 @@
 # coding: utf8
 
-# Change directories you want to ignore here
+# Change directories you want to ignore here. Patterns are like .gitignore: a pattern matches the
+# directory at any depth, unless it contains a slash, e.g. '/lib' only matches lib in the root.
+# '*', '?', '[abc]' and '**' are supported.
 ignore_directories = {
     'common': [
         'vendor',
@@ -64,3 +66,75 @@ code_file_extensions = {
     'scala': 'Scala',
     'sh': 'Shell',
 }
+
+# Number of repositories loaded concurrently, set it to 1 to load repositories one by one.
+load_workers = 4
+
+# Cache parsed commits under cache/ directory, later runs only parse commits added since last run.
+commit_cache = True
+
+# File of email aliases relative to this directory, one person per line with emails separated by
+# spaces. Emails of a line are all considered as yours if any of them is yours.
+alias_file = ''
+
+# Cache linguist results under cache/ directory, unchanged repositories are not analyzed again.
+linguist_cache = True
+
+# Max number of file paths whose detected language is cached for each repository.
+path_cache_size = 65536
+
+# Number of processes rendering report pages, set it to 1 to render pages one by one.
+render_workers = 1
+
+# Save charts of the report as separate images in output/ directory as well, for debugging.
+save_charts = False
+
+# Layout of the calendar graph on the cover, 'rows' puts 19 days in a row and 'weeks' puts each
+# week in a column like GitHub.
+calendar_layout = 'rows'
+
+# Commit weights separating color levels of the calendar graph, set it to 'quantile' to split days
+# with commits into levels of about the same number of days.
+calendar_thresholds = [48, 128, 512]
+
+# Max number of shaped texts cached for drawing report pages.
+text_cache_size = 1024
+
+# Directories skipped when searching git repositories, hidden directories are always skipped.
+ignore_search_directories = ['node_modules', 'bower_components', 'vendor', 'venv', 'site-packages',
+                             '__pycache__', 'build', 'dist', 'target']
+
+# Number of repositories cloned or fetched concurrently.
+clone_workers = 4
+
+# Clone repositories without file contents. git log then fetches the contents of each commit it
+# diffs one by one, a round trip per commit, so it only pays off for huge repositories of which
+# few commits are in the report. Repositories cloned this way are read by git commands only.
+partial_clone = False
+
+# Branches to scan, master is scanned if it exists, otherwise HEAD. Set it to 'all' to scan all
+# local and remote-tracking branches, or to ref globs separated by spaces, e.g.
+# 'refs/heads/release/*'.
+branches = ''
+
+# How history of repositories is read: 'subprocess' runs git commands, 'inprocess' reads git
+# objects directly and computes line stat itself, repositories it can't read fall back to git
+# commands, e.g. partial clones.
+history_backend = 'subprocess'
+
+# Number of years in the trend page of the report, ending with the year of the report. Stats of
+# each month are cached under cache/ directory, so later runs only read new commits. Set it to 0
+# to leave the trend page out.
+trend_years = 0
+
+# Record how long each phase, repository, report page and subprocess takes, and save them as a
+# Chrome trace in output/trace.json with a summary table printed. Team mode has --profile as well.
+profile = False
+
+# Layout of the merge graph, 'spring' is the force-directed layout of networkx, 'radial' puts you in
+# the center and partners on rings around you, it's computed at once and is much faster.
+merge_graph_layout = 'spring'
+
+# Max number of partners in the merge graph, the ones you merged with most are kept. Set it to 0 to
+# draw all of them.
+merge_graph_partners = 30
@@ -4,8 +4,9 @@ REPO_URL = 'https://github.com/baijiangliang/year2018'
 
 GIT_EMAIL_CMD = 'git config --get user.email'
 CHECK_GIT_DIR_CMD = 'git rev-parse --is-inside-work-tree'
-GIT_COMMIT_SEPARATOR = 'git-commit-separator'
-GIT_LOG_FORMAT = GIT_COMMIT_SEPARATOR + '%H%n%P%n%an%n%ae%n%at%n%s%n'
+# Fields of a commit in git log, used with -z so records are NUL delimited
+GIT_LOG_FIELDS = ['%H', '%P', '%an', '%ae', '%at', '%s']
+GIT_LOG_FORMAT = '%x00'.join(GIT_LOG_FIELDS)
 GIT_REMOTE_URL_CMD = 'git config --get remote.origin.url'
 GIT_BRANCH_CMD = 'git branch --list'
 
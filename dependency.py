@@ -1,7 +1,7 @@
 # coding: utf8
-import os
 from typing import Dict
 
+import linguist
 import util
 
 
@@ -10,9 +10,13 @@ def check_linguist(ctx: util.DotDict) -> Dict[str, bool]:
     if util.run_with_check('which gem'):
         if not util.run('gem list --local -q github-linguist', check=False):
             util.run_with_check('gem install github-linguist', stdout=None)
-    ruby_script = os.path.join(ctx.run_dir, 'linguist.rb')
-    linguist_cmd = 'ruby {0} {1}'.format(ruby_script, ctx.run_dir)
+    # The worker started by the probe is kept and used to analyze repos later
+    try:
+        enabled = linguist.get_worker(ctx.run_dir).ping()
+    except OSError as e:  # ruby is not installed
+        print(e)
+        enabled = False
     result = {
-        'linguist_enabled': util.run_with_check(linguist_cmd),
+        'linguist_enabled': enabled,
     }
     return result
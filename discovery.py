@@ -0,0 +1,66 @@
+# coding: utf8
+"""Find git repositories under a directory with os.scandir, no git process is spawned."""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Iterable, Tuple
+
+import conf
+
+
+def scan_dir(dir_path: str, ignored: frozenset) -> Tuple[bool, List[str]]:
+    """ Return whether the directory is a git work tree, and its subdirectories to walk. """
+    is_repo, sub_dirs = False, []
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                # .git is a directory, or a file in worktrees and submodules
+                if entry.name == '.git':
+                    is_repo = True
+                elif not entry.name.startswith('.') and entry.name not in ignored:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            sub_dirs.append(entry.path)
+                    except OSError:
+                        continue
+    except OSError:  # no permission, removed while walking, etc.
+        pass
+    return is_repo, sub_dirs
+
+
+def walk(dir_path: str, ignored: frozenset, excluded: frozenset) -> List[str]:
+    """ Find repos in the directory tree, directories under a repo are not walked. """
+    repos = []
+    stack = [dir_path]
+    while stack:
+        path = stack.pop()
+        if path in excluded:
+            continue
+        is_repo, sub_dirs = scan_dir(path, ignored)
+        if is_repo:
+            repos.append(path)
+        else:
+            stack.extend(sub_dirs)
+    return repos
+
+
+def find_git_repos(root: str, excluded: Iterable[str] = (), workers=8) -> List[str]:
+    """
+    Find git repositories under root, sorted by path. Hidden directories, directories named in
+    conf.ignore_search_directories and the excluded paths are skipped. Subtrees of root are
+    walked by a thread pool, os.scandir releases the GIL while it waits for the file system.
+    """
+    ignored = frozenset(conf.ignore_search_directories)
+    excluded = frozenset(os.path.realpath(path) for path in excluded)
+    # Symlinks aren't followed, so paths under a real root are real and compared as they are
+    root = os.path.realpath(root)
+    if root in excluded:
+        return []
+    is_repo, sub_dirs = scan_dir(root, ignored)
+    if is_repo:
+        return [root]
+    if workers > 1 and len(sub_dirs) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda x: walk(x, ignored, excluded), sub_dirs))
+    else:
+        results = [walk(sub_dir, ignored, excluded) for sub_dir in sub_dirs]
+    return sorted(repo for repos in results for repo in repos)
@@ -0,0 +1,82 @@
+# coding: utf8
+"""Fonts of report pages and text shaped with them, everything is loaded on first use."""
+import functools
+import os
+import threading
+from typing import List, Tuple, Any
+
+import conf
+
+file_dir = os.path.dirname(os.path.realpath(__file__))
+font_files = {
+    'normal': os.path.join(file_dir, 'static/SourceHanSansSC/SourceHanSansSC-Normal.otf'),
+    'regular': os.path.join(file_dir, 'static/SourceHanSansSC/SourceHanSansSC-Regular.otf'),
+}
+# Font family for matplotlib
+font_name = 'Source Han Sans SC'
+
+matplotlib_lock = threading.Lock()
+matplotlib_ready = False
+
+
+@functools.lru_cache(maxsize=None)
+def get_font(weight: str, size: int) -> Any:
+    """ Return the PIL font of weight 'normal' or 'regular' in size, each is loaded only once. """
+    from PIL import ImageFont
+    return ImageFont.truetype(font_files[weight], size=size)
+
+
+def setup_matplotlib():
+    """ Register the font family for matplotlib, only on the first call. """
+    global matplotlib_ready
+    with matplotlib_lock:
+        if matplotlib_ready:
+            return
+        import matplotlib
+        from matplotlib import font_manager
+        font_entry = font_manager.FontEntry(fname=font_files['normal'], name=font_name)
+        font_manager.fontManager.ttflist.extend([font_entry])
+        matplotlib.rcParams['font.family'] = font_name
+        matplotlib_ready = True
+
+
+class ShapedText:
+    """
+    Metrics and glyph mask of a string in a font. Width and height are measured from the origin
+    like the removed ImageDraw.textsize, the mask is pasted at offset from the origin.
+    """
+    __slots__ = ('width', 'height', 'offset', 'mask')
+
+    def __init__(self, width: int, height: int, offset: Tuple[int, int], mask: Any):
+        self.width = width
+        self.height = height
+        self.offset = offset
+        self.mask = mask
+
+
+@functools.lru_cache(maxsize=conf.text_cache_size)
+def shape_text(text: str, weight: str, size: int) -> ShapedText:
+    """ Shape the text once, pages draw the same strings over and over. """
+    from PIL import Image, ImageDraw
+    font = get_font(weight, size)
+    left, top, right, bottom = font.getbbox(text)
+    mask = None
+    if right > left and bottom > top:
+        mask = Image.new('L', (right - left, bottom - top), 0)
+        ImageDraw.Draw(mask).text((-left, -top), text, fill=255, font=font)
+    return ShapedText(right, bottom, (left, top), mask)
+
+
+def draw_shaped(img: Any, pos: Tuple[int, int], shaped: ShapedText, fill: str):
+    if shaped.mask is not None:
+        img.paste(fill, (pos[0] + shaped.offset[0], pos[1] + shaped.offset[1]), shaped.mask)
+
+
+def draw_text(img: Any, pos: Tuple[int, int], text: str, fill: str, weight: str, size: int):
+    draw_shaped(img, pos, shape_text(text, weight, size), fill)
+
+
+def layout_line(segments: List[Tuple[str, str, int]]) -> Tuple[List[ShapedText], int]:
+    """ Shape (text, weight, size) segments of a line, return them with the total width. """
+    shaped = [shape_text(*segment) for segment in segments]
+    return shaped, sum(s.width for s in shaped)
@@ -0,0 +1,444 @@
+# coding: utf8
+"""
+Line counts and rename detection of git diff --numstat, computed in process. The line diff follows
+xdiff, the diff library of git, including its heuristics for large diffs, so counts are the same as
+those of git rather than those of a minimal diff.
+"""
+from collections import Counter
+from typing import List, Dict, Tuple, Callable
+
+# Only the first few bytes are checked for NUL when git decides whether a file is binary
+first_few_bytes = 8000
+
+# Constants of xdiff
+max_eq_limit = 1024
+simscan_window = 100
+kpdis_run = 4
+max_cost_min = 256
+heur_min_cost = 256
+snake_cnt = 20
+k_heur = 4
+line_max = 1 << 62
+
+# Rename scores of git, a file is renamed if at least 50% of it is kept by default
+max_score = 60000
+min_rename_score = 30000
+rename_limit = 1000
+rename_candidates = 4
+hash_base = 107927
+
+
+def is_binary(data: bytes) -> bool:
+    return b'\0' in data[:first_few_bytes]
+
+
+def split_lines(data: bytes) -> list:
+    """ Lines of data, the last line without newline differs from the same line with newline. """
+    lines = data.split(b'\n')
+    last = lines.pop()
+    if last:
+        lines.append((last,))
+    return lines
+
+
+def bogosqrt(n: int) -> int:
+    i = 1
+    while n > 0:
+        n >>= 2
+        i <<= 1
+    return i
+
+
+def count_changes(old: bytes, new: bytes) -> Tuple[int, int]:
+    """ Return inserted and deleted lines from old to new, the same as git diff --numstat. """
+    classes = {}
+    ha1 = [classes.setdefault(line, len(classes)) for line in split_lines(old)]
+    ha2 = [classes.setdefault(line, len(classes)) for line in split_lines(new)]
+    n1, n2 = len(ha1), len(ha2)
+    # Lines of the common head and tail are unchanged
+    start, lim = 0, min(n1, n2)
+    while start < lim and ha1[start] == ha2[start]:
+        start += 1
+    tail = 0
+    while tail < lim - start and ha1[n1 - 1 - tail] == ha2[n2 - 1 - tail]:
+        tail += 1
+    end1, end2 = n1 - tail, n2 - tail
+    if start == end1 or start == end2:
+        return end2 - start, end1 - start
+    counts1, counts2 = Counter(ha1), Counter(ha2)
+    rest1, deletions = discard_records(ha1[start:end1], counts2, n1)
+    rest2, insertions = discard_records(ha2[start:end2], counts1, n2)
+    changed1, changed2 = diff_records(rest1, rest2)
+    return insertions + changed2, deletions + changed1
+
+
+def discard_records(ha: List[int], other_counts: Counter, nrec: int) -> Tuple[List[int], int]:
+    """
+    Leave out lines which can't match lines of the other file and count them as changed, like
+    xdl_cleanup_records(). Lines with too many matches are left out too if they are surrounded
+    by lines without a match.
+    """
+    mlim = min(bogosqrt(nrec), max_eq_limit)
+    dis = []
+    for h in ha:
+        matches = other_counts[h]
+        dis.append(0 if not matches else 2 if matches >= mlim else 1)
+    kept, discarded = [], 0
+    end = len(dis) - 1
+    for i, h in enumerate(ha):
+        if dis[i] == 1 or (dis[i] == 2 and not clean_mmatch(dis, i, 0, end)):
+            kept.append(h)
+        else:
+            discarded += 1
+    return kept, discarded
+
+
+def clean_mmatch(dis: List[int], i: int, start: int, end: int) -> bool:
+    start = max(start, i - simscan_window)
+    end = min(end, i + simscan_window)
+    # Runs of lines without a match or with many matches before and after line i
+    no_match_before, multi_before = 0, 1
+    r = 1
+    while i - r >= start:
+        if not dis[i - r]:
+            no_match_before += 1
+        elif dis[i - r] == 2:
+            multi_before += 1
+        else:
+            break
+        r += 1
+    if not no_match_before:
+        return False
+    no_match_after, multi_after = 0, 1
+    r = 1
+    while i + r <= end:
+        if not dis[i + r]:
+            no_match_after += 1
+        elif dis[i + r] == 2:
+            multi_after += 1
+        else:
+            break
+        r += 1
+    if not no_match_after:
+        return False
+    no_match = no_match_before + no_match_after
+    multi = multi_before + multi_after
+    return multi * kpdis_run < multi + no_match
+
+
+def diff_records(ha1: List[int], ha2: List[int]) -> Tuple[int, int]:
+    """ Count changed records of both sides by divide and conquer, like xdl_recs_cmp(). """
+    n1, n2 = len(ha1), len(ha2)
+    ndiags = n1 + n2 + 3
+    mxcost = max(bogosqrt(ndiags), max_cost_min)
+    # Diagonal k is stored at k + offset of the forward and backward vectors
+    offset = n2 + 1
+    kvdf, kvdb = [0] * (ndiags + 2), [0] * (ndiags + 2)
+    changed1 = changed2 = 0
+    stack = [(0, n1, 0, n2, False)]
+    while stack:
+        off1, lim1, off2, lim2, need_min = stack.pop()
+        while off1 < lim1 and off2 < lim2 and ha1[off1] == ha2[off2]:
+            off1 += 1
+            off2 += 1
+        while off1 < lim1 and off2 < lim2 and ha1[lim1 - 1] == ha2[lim2 - 1]:
+            lim1 -= 1
+            lim2 -= 1
+        if off1 == lim1:
+            changed2 += lim2 - off2
+        elif off2 == lim2:
+            changed1 += lim1 - off1
+        else:
+            i1, i2, min_lo, min_hi = split_records(ha1, off1, lim1, ha2, off2, lim2, kvdf, kvdb,
+                                                   offset, need_min, mxcost)
+            stack.append((i1, lim1, i2, lim2, min_hi))
+            stack.append((off1, i1, off2, i2, min_lo))
+    return changed1, changed2
+
+
+def split_records(ha1: List[int], off1: int, lim1: int, ha2: List[int], off2: int, lim2: int,
+                  kvdf: List[int], kvdb: List[int], k: int, need_min: bool,
+                  mxcost: int) -> Tuple[int, int, bool, bool]:
+    """
+    Find the middle snake of the edit graph, or a good enough split point when the edit cost
+    is too high, like xdl_split(). Return the split point and whether both halves need a
+    minimal diff.
+    """
+    dmin, dmax = off1 - lim2, lim1 - off2
+    fmid, bmid = off1 - off2, lim1 - lim2
+    odd = (fmid - bmid) & 1
+    fmin = fmax = fmid
+    bmin = bmax = bmid
+    kvdf[fmid + k] = off1
+    kvdb[bmid + k] = lim1
+    ec = 0
+    while True:
+        ec += 1
+        got_snake = False
+        # Extend the forward diagonal domain by one
+        if fmin > dmin:
+            fmin -= 1
+            kvdf[fmin - 1 + k] = -1
+        else:
+            fmin += 1
+        if fmax < dmax:
+            fmax += 1
+            kvdf[fmax + 1 + k] = -1
+        else:
+            fmax -= 1
+        for d in range(fmax, fmin - 1, -2):
+            if kvdf[d - 1 + k] >= kvdf[d + 1 + k]:
+                i1 = kvdf[d - 1 + k] + 1
+            else:
+                i1 = kvdf[d + 1 + k]
+            prev1 = i1
+            i2 = i1 - d
+            while i1 < lim1 and i2 < lim2 and ha1[i1] == ha2[i2]:
+                i1 += 1
+                i2 += 1
+            if i1 - prev1 > snake_cnt:
+                got_snake = True
+            kvdf[d + k] = i1
+            if odd and bmin <= d <= bmax and kvdb[d + k] <= i1:
+                return i1, i2, True, True
+        # Extend the backward diagonal domain by one
+        if bmin > dmin:
+            bmin -= 1
+            kvdb[bmin - 1 + k] = line_max
+        else:
+            bmin += 1
+        if bmax < dmax:
+            bmax += 1
+            kvdb[bmax + 1 + k] = line_max
+        else:
+            bmax -= 1
+        for d in range(bmax, bmin - 1, -2):
+            if kvdb[d - 1 + k] < kvdb[d + 1 + k]:
+                i1 = kvdb[d - 1 + k]
+            else:
+                i1 = kvdb[d + 1 + k] - 1
+            prev1 = i1
+            i2 = i1 - d
+            while i1 > off1 and i2 > off2 and ha1[i1 - 1] == ha2[i2 - 1]:
+                i1 -= 1
+                i2 -= 1
+            if prev1 - i1 > snake_cnt:
+                got_snake = True
+            kvdb[d + k] = i1
+            if not odd and fmin <= d <= fmax and i1 <= kvdf[d + k]:
+                return i1, i2, True, True
+        if need_min:
+            continue
+        # The edit cost is high, split at a diagonal which has gone far with a long snake
+        if got_snake and ec > heur_min_cost:
+            best = 0
+            for d in range(fmax, fmin - 1, -2):
+                dd = abs(d - fmid)
+                i1 = kvdf[d + k]
+                i2 = i1 - d
+                v = (i1 - off1) + (i2 - off2) - dd
+                if (v > k_heur * ec and v > best and off1 + snake_cnt <= i1 < lim1 and
+                        off2 + snake_cnt <= i2 < lim2):
+                    n = 1
+                    while ha1[i1 - n] == ha2[i2 - n]:
+                        if n == snake_cnt:
+                            best, split1, split2 = v, i1, i2
+                            break
+                        n += 1
+            if best > 0:
+                return split1, split2, True, False
+            best = 0
+            for d in range(bmax, bmin - 1, -2):
+                dd = abs(d - bmid)
+                i1 = kvdb[d + k]
+                i2 = i1 - d
+                v = (lim1 - i1) + (lim2 - i2) - dd
+                if (v > k_heur * ec and v > best and off1 < i1 <= lim1 - snake_cnt and
+                        off2 < i2 <= lim2 - snake_cnt):
+                    n = 0
+                    while ha1[i1 + n] == ha2[i2 + n]:
+                        if n == snake_cnt - 1:
+                            best, split1, split2 = v, i1, i2
+                            break
+                        n += 1
+            if best > 0:
+                return split1, split2, False, True
+        # Enough is enough, split at the furthest reaching path
+        if ec >= mxcost:
+            fbest = fbest1 = -1
+            for d in range(fmax, fmin - 1, -2):
+                i1 = min(kvdf[d + k], lim1)
+                i2 = i1 - d
+                if lim2 < i2:
+                    i1, i2 = lim2 + d, lim2
+                if fbest < i1 + i2:
+                    fbest, fbest1 = i1 + i2, i1
+            bbest = bbest1 = line_max
+            for d in range(bmax, bmin - 1, -2):
+                i1 = max(off1, kvdb[d + k])
+                i2 = i1 - d
+                if i2 < off2:
+                    i1, i2 = off2 + d, off2
+                if i1 + i2 < bbest:
+                    bbest, bbest1 = i1 + i2, i1
+            if (lim1 + lim2) - bbest < fbest - (off1 + off2):
+                return fbest1, fbest - fbest1, True, False
+            return bbest1, bbest - bbest1, False, True
+
+
+class FileSpec:
+    """ A deleted or added file considered by rename detection, data is loaded when needed. """
+    __slots__ = ('path', 'mode', 'oid', 'data', 'spans')
+
+    def __init__(self, path: bytes, mode: int, oid: bytes):
+        self.path = path
+        self.mode = mode
+        self.oid = oid
+        self.data = None
+        self.spans = None
+
+
+def is_regular(mode: int) -> bool:
+    return mode & 0o170000 == 0o100000
+
+
+def get_basename(path: bytes) -> bytes:
+    return path.rsplit(b'/', 1)[-1]
+
+
+def hash_spans(data: bytes) -> Dict[int, int]:
+    """
+    Split data into spans ending at newlines or of 64 bytes, return {span hash: total bytes}.
+    CR of CRLF is ignored in text, like hash_chars() of git.
+    """
+    spans = {}
+    is_text = not is_binary(data)
+    accum1 = accum2 = n = 0
+    size = len(data)
+    for i, c in enumerate(data):
+        if is_text and c == 13 and i + 1 < size and data[i + 1] == 10:
+            continue
+        old1 = accum1
+        accum1 = ((((accum1 << 7) ^ (accum2 >> 25)) & 0xffffffff) + c) & 0xffffffff
+        accum2 = ((accum2 << 7) ^ (old1 >> 25)) & 0xffffffff
+        n += 1
+        if n < 64 and c != 10:
+            continue
+        h = ((accum1 + accum2 * 0x61) & 0xffffffff) % hash_base
+        spans[h] = spans.get(h, 0) + n
+        n = accum1 = accum2 = 0
+    if n:
+        h = ((accum1 + accum2 * 0x61) & 0xffffffff) % hash_base
+        spans[h] = spans.get(h, 0) + n
+    return spans
+
+
+def estimate_similarity(src: FileSpec, dst: FileSpec, minimum_score: int,
+                        load: Callable[[FileSpec], bytes]) -> int:
+    """ Score in [0, max_score] of how much content of dst comes from src. """
+    if not is_regular(src.mode) or not is_regular(dst.mode):
+        return 0
+    src_data, dst_data = load(src), load(dst)
+    src_size, dst_size = len(src_data), len(dst_data)
+    max_size = max(src_size, dst_size)
+    delta_size = max_size - min(src_size, dst_size)
+    # Files whose size changes a lot are not renamed
+    if max_size * (max_score - minimum_score) < delta_size * max_score:
+        return 0
+    if not dst_size:
+        return 0
+    if src.spans is None:
+        src.spans = hash_spans(src_data)
+    if dst.spans is None:
+        dst.spans = hash_spans(dst_data)
+    dst_spans = dst.spans
+    copied = sum(min(size, dst_spans.get(h, 0)) for h, size in src.spans.items())
+    return copied * max_score // max_size
+
+
+def is_better(a: Tuple[int, int, int, int], b: Tuple[int, int, int, int]) -> bool:
+    """ Whether candidate a has higher score than b, the same basename breaks ties. """
+    return a[:2] > b[:2]
+
+
+def find_renames(sources: List[FileSpec], dests: List[FileSpec],
+                 load: Callable[[FileSpec], bytes]) -> Dict[int, int]:
+    """
+    Pair added files with deleted files like git diff -M, return {dest index: source index}.
+    Exact renames are found first, then renames keeping their basenames, then the most similar
+    pairs of the rest.
+    """
+    renames, used = {}, set()
+    by_oid = {}
+    for i, src in enumerate(sources):
+        by_oid.setdefault(src.oid, []).append(i)
+    for j, dst in enumerate(dests):
+        best, best_score, tries = -1, 0, 0
+        for i in by_oid.get(dst.oid, ()):
+            src = sources[i]
+            if i in used or ((not is_regular(src.mode) or not is_regular(dst.mode)) and
+                             src.mode != dst.mode):
+                continue
+            score = 1 + (get_basename(src.path) == get_basename(dst.path))
+            if score > best_score:
+                best, best_score = i, score
+                if score == 2:
+                    break
+            tries += 1
+            if tries == 100:
+                break
+        if best >= 0:
+            renames[j] = best
+            used.add(best)
+
+    # A file moved to another directory is likely to keep its basename, pair files whose
+    # basenames are unique among the rest if they are similar enough
+    min_basename_score = min_rename_score + (max_score - min_rename_score) // 2
+    src_names, dst_names = {}, {}
+    for i, src in enumerate(sources):
+        if i not in used:
+            name = get_basename(src.path)
+            src_names[name] = -1 if name in src_names else i
+    for j, dst in enumerate(dests):
+        if j not in renames:
+            name = get_basename(dst.path)
+            dst_names[name] = -1 if name in dst_names else j
+    for name, i in src_names.items():
+        j = dst_names.get(name, -1)
+        if i < 0 or j < 0:
+            continue
+        if estimate_similarity(sources[i], dests[j], min_basename_score,
+                               load) >= min_basename_score:
+            renames[j] = i
+            used.add(i)
+
+    rest_sources = [i for i in range(len(sources)) if i not in used]
+    rest_dests = [j for j in range(len(dests)) if j not in renames]
+    if not rest_sources or not rest_dests:
+        return renames
+    if len(rest_sources) * len(rest_dests) > rename_limit * rename_limit:
+        return renames
+    # Keep the best candidates of each destination, then take pairs from the most similar
+    matrix = []
+    for j in rest_dests:
+        candidates = [(0, 0, -1, -1)] * rename_candidates
+        for i in rest_sources:
+            score = estimate_similarity(sources[i], dests[j], min_rename_score, load)
+            same_name = int(get_basename(sources[i].path) == get_basename(dests[j].path))
+            candidate = (score, same_name, j, i)
+            worst = 0
+            for n in range(1, rename_candidates):
+                if is_better(candidates[worst], candidates[n]):
+                    worst = n
+            if is_better(candidate, candidates[worst]):
+                candidates[worst] = candidate
+        matrix.extend(candidates)
+    matrix.sort(key=lambda x: (-x[0], -x[1]))
+    for score, _, j, i in matrix:
+        if j < 0 or score < min_rename_score:
+            break
+        if j in renames or i in used:
+            continue
+        renames[j] = i
+        used.add(i)
+    return renames
@@ -0,0 +1,457 @@
+# coding: utf8
+"""Read git objects in process: loose objects, packfiles with their idx files and commit-graph."""
+import mmap
+import os
+import struct
+import zlib
+from collections import OrderedDict
+from typing import List, Dict, Tuple, Optional
+
+object_types = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+ofs_delta_type = 6
+ref_delta_type = 7
+# Max total size of objects each pack keeps for resolving delta chains
+pack_cache_size = 32 << 20
+# Parent position of commit-graph meaning no parent, and the flag pointing to octopus edges
+graph_no_parent = 0x70000000
+graph_edge_flag = 0x80000000
+
+
+def open_mmap(path: str) -> mmap.mmap:
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def find_sorted_oid(data, fanout: Tuple[int, ...], names_offset: int, oid: bytes) -> int:
+    """ Binary search the table of sorted 20 bytes ids, return the position or -1. """
+    lo = fanout[oid[0] - 1] if oid[0] else 0
+    hi = fanout[oid[0]]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pos = names_offset + mid * 20
+        name = data[pos:pos + 20]
+        if name < oid:
+            lo = mid + 1
+        elif name > oid:
+            hi = mid
+        else:
+            return mid
+    return -1
+
+
+def inflate(data, pos: int, size: int) -> bytes:
+    """ Decompress a zlib stream starting at pos whose decompressed size is known. """
+    decompressor = zlib.decompressobj()
+    # Compressed data is rarely larger than the decompressed one plus zlib headers
+    step = size + 64
+    chunks = []
+    while not decompressor.eof:
+        chunk = data[pos:pos + step]
+        if not chunk:
+            raise ValueError('Truncated zlib stream')
+        chunks.append(decompressor.decompress(chunk))
+        pos += step
+        step = 1 << 16
+    return b''.join(chunks)
+
+
+def read_delta_size(delta: bytes, pos: int) -> Tuple[int, int]:
+    size = shift = 0
+    while True:
+        byte = delta[pos]
+        pos += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return size, pos
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    """ Build an object from its base and the delta of copy and insert instructions. """
+    src_size, pos = read_delta_size(delta, 0)
+    dst_size, pos = read_delta_size(delta, pos)
+    if src_size != len(base):
+        raise ValueError('Delta base size mismatch')
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        cmd = delta[pos]
+        pos += 1
+        if cmd & 0x80:  # copy from base, bits of cmd tell which offset and size bytes follow
+            offset = size = 0
+            for i in range(4):
+                if cmd & (1 << i):
+                    offset |= delta[pos] << (i * 8)
+                    pos += 1
+            for i in range(3):
+                if cmd & (0x10 << i):
+                    size |= delta[pos] << (i * 8)
+                    pos += 1
+            out += base[offset:offset + (size or 0x10000)]
+        elif cmd:  # insert the next cmd bytes
+            out += delta[pos:pos + cmd]
+            pos += cmd
+        else:
+            raise ValueError('Invalid delta instruction')
+    if len(out) != dst_size:
+        raise ValueError('Delta result size mismatch')
+    return bytes(out)
+
+
+class PackIndex:
+    """ Version 2 pack index, which maps object ids to offsets in the pack. """
+
+    def __init__(self, path: str):
+        self.data = open_mmap(path)
+        if self.data[:8] != b'\377tOc\0\0\0\2':
+            raise ValueError('Unsupported pack index: {0}'.format(path))
+        self.fanout = struct.unpack_from('>256I', self.data, 8)
+        count = self.fanout[255]
+        self.names_offset = 8 + 256 * 4
+        # Ids are followed by CRC32s, 32 bits offsets and 64 bits offsets of large packs
+        self.offsets_offset = self.names_offset + count * 24
+        self.large_offsets_offset = self.offsets_offset + count * 4
+
+    def find(self, oid: bytes) -> int:
+        """ Offset of the object in the pack, -1 if the pack doesn't contain it. """
+        i = find_sorted_oid(self.data, self.fanout, self.names_offset, oid)
+        if i < 0:
+            return -1
+        offset, = struct.unpack_from('>I', self.data, self.offsets_offset + i * 4)
+        if offset & 0x80000000:
+            pos = self.large_offsets_offset + (offset & 0x7fffffff) * 8
+            offset, = struct.unpack_from('>Q', self.data, pos)
+        return offset
+
+
+class Pack:
+    def __init__(self, path: str):
+        """ path is the pack file path without .pack or .idx extension. """
+        self.index = PackIndex(path + '.idx')
+        self.data = open_mmap(path + '.pack')
+        if self.data[:4] != b'PACK':
+            raise ValueError('Invalid pack: {0}'.format(path))
+        # Offset -> (type, data) of recently read objects, bases of deltas are often shared
+        self.cache = OrderedDict()
+        self.cache_size = 0
+
+    def read(self, oid: bytes, store: 'ObjectStore') -> Optional[Tuple[str, bytes]]:
+        offset = self.index.find(oid)
+        if offset < 0:
+            return None
+        return self.read_at(offset, store)
+
+    def read_at(self, offset: int, store: 'ObjectStore') -> Tuple[str, bytes]:
+        # Follow the delta chain to a cached object or a base object, then apply deltas backwards
+        deltas = []
+        while True:
+            cached = self.cache.get(offset)
+            if cached is not None:
+                self.cache.move_to_end(offset)
+                obj_type, obj = cached
+                break
+            obj_type, pos, size = self.read_header(offset)
+            if obj_type == ofs_delta_type:
+                byte = self.data[pos]
+                pos += 1
+                distance = byte & 0x7f
+                while byte & 0x80:
+                    byte = self.data[pos]
+                    pos += 1
+                    distance = ((distance + 1) << 7) | (byte & 0x7f)
+                deltas.append((offset, pos, size))
+                offset -= distance
+            elif obj_type == ref_delta_type:
+                deltas.append((offset, pos + 20, size))
+                obj_type, obj = store.read(self.data[pos:pos + 20])
+                break
+            else:
+                obj_type = object_types[obj_type]
+                obj = inflate(self.data, pos, size)
+                self.add_cache(offset, obj_type, obj)
+                break
+        for offset, pos, size in reversed(deltas):
+            obj = apply_delta(obj, inflate(self.data, pos, size))
+            self.add_cache(offset, obj_type, obj)
+        return obj_type, obj
+
+    def read_header(self, offset: int) -> Tuple[int, int, int]:
+        """ Return type, data position and size of the object at offset. """
+        byte = self.data[offset]
+        obj_type = (byte >> 4) & 7
+        size = byte & 0x0f
+        shift = 4
+        pos = offset + 1
+        while byte & 0x80:
+            byte = self.data[pos]
+            pos += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+        return obj_type, pos, size
+
+    def add_cache(self, offset: int, obj_type: str, obj: bytes):
+        if len(obj) > pack_cache_size // 4:
+            return
+        self.cache[offset] = (obj_type, obj)
+        self.cache_size += len(obj)
+        while self.cache_size > pack_cache_size:
+            _, (_, old) = self.cache.popitem(last=False)
+            self.cache_size -= len(old)
+
+
+class ObjectStore:
+    """ Objects of a repository and its alternates, in packs or loose. """
+
+    def __init__(self, objects_dir: str):
+        self.objects_dirs = get_alternates(objects_dir)
+        self.packs = []
+        for path in self.objects_dirs:
+            pack_dir = os.path.join(path, 'pack')
+            if not os.path.isdir(pack_dir):
+                continue
+            for name in sorted(os.listdir(pack_dir)):
+                if name.endswith('.idx') and os.path.isfile(os.path.join(pack_dir, name[:-4] +
+                                                                         '.pack')):
+                    self.packs.append(Pack(os.path.join(pack_dir, name[:-4])))
+
+    def read(self, oid: bytes) -> Tuple[str, bytes]:
+        """ Return type and data of the object, raise KeyError if it doesn't exist. """
+        for pack in self.packs:
+            res = pack.read(oid, self)
+            if res is not None:
+                return res
+        hex_id = oid.hex()
+        for path in self.objects_dirs:
+            try:
+                with open(os.path.join(path, hex_id[:2], hex_id[2:]), 'rb') as f:
+                    data = zlib.decompress(f.read())
+            except FileNotFoundError:
+                continue
+            header, _, body = data.partition(b'\0')
+            obj_type = header.split(b' ', 1)[0].decode()
+            return obj_type, body
+        raise KeyError('Object {0} not found'.format(hex_id))
+
+    def read_typed(self, oid: bytes, expected: str) -> bytes:
+        obj_type, data = self.read(oid)
+        if obj_type != expected:
+            raise ValueError('Object {0} is a {1}, not a {2}'.format(oid.hex(), obj_type,
+                                                                     expected))
+        return data
+
+
+def get_alternates(objects_dir: str) -> List[str]:
+    """ The objects directory followed by directories listed in info/alternates, recursively. """
+    dirs = [objects_dir]
+    for path in dirs:
+        try:
+            with open(os.path.join(path, 'info', 'alternates'), encoding='utf8') as f:
+                lines = f.read().split('\n')
+        except FileNotFoundError:
+            continue
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            alternate = os.path.realpath(os.path.join(path, line))
+            if alternate not in dirs and len(dirs) < 6:
+                dirs.append(alternate)
+    return dirs
+
+
+class GraphLayer:
+    """ A commit-graph file, positions of its commits start after those of its base layers. """
+
+    def __init__(self, path: str, base_count: int):
+        self.data = open_mmap(path)
+        data = self.data
+        if data[:4] != b'CGPH' or data[4] != 1 or data[5] != 1:
+            raise ValueError('Unsupported commit-graph: {0}'.format(path))
+        chunks = {}
+        for i in range(data[6]):
+            chunk_id, offset = struct.unpack_from('>4sQ', data, 8 + i * 12)
+            chunks[chunk_id] = offset
+        self.fanout = struct.unpack_from('>256I', data, chunks[b'OIDF'])
+        self.names_offset = chunks[b'OIDL']
+        self.data_offset = chunks[b'CDAT']
+        self.edges_offset = chunks.get(b'EDGE')
+        self.base_count = base_count
+        self.count = self.fanout[255]
+
+
+class CommitGraph:
+    """ Parents and commit dates from commit-graph files, without reading commit objects. """
+
+    def __init__(self, objects_dir: str):
+        self.layers = []
+        info_dir = os.path.join(objects_dir, 'info')
+        chain = os.path.join(info_dir, 'commit-graphs', 'commit-graph-chain')
+        if os.path.isfile(chain):
+            with open(chain, encoding='utf8') as f:
+                paths = [os.path.join(info_dir, 'commit-graphs', 'graph-{0}.graph'.format(line))
+                         for line in f.read().split()]
+        elif os.path.isfile(os.path.join(info_dir, 'commit-graph')):
+            paths = [os.path.join(info_dir, 'commit-graph')]
+        else:
+            paths = []
+        try:
+            for path in paths:
+                base_count = 0
+                if self.layers:
+                    base_count = self.layers[-1].base_count + self.layers[-1].count
+                self.layers.append(GraphLayer(path, base_count))
+        except (OSError, ValueError, KeyError) as e:
+            # Commits are read from objects instead
+            print('Warning: ignore commit-graph of {0}, reason: {1}'.format(objects_dir, e))
+            self.layers = []
+
+    def get_oid(self, position: int) -> bytes:
+        for layer in self.layers:
+            if position < layer.base_count + layer.count:
+                pos = layer.names_offset + (position - layer.base_count) * 20
+                return layer.data[pos:pos + 20]
+        raise ValueError('Invalid commit-graph position {0}'.format(position))
+
+    def lookup(self, oid: bytes) -> Optional[Tuple[bytes, List[bytes], int]]:
+        """ Return tree, parents and commit date of the commit, None if it isn't in the graph. """
+        for layer in reversed(self.layers):
+            i = find_sorted_oid(layer.data, layer.fanout, layer.names_offset, oid)
+            if i < 0:
+                continue
+            # Tree id, the first two parents, then generation and date in the lowest 34 bits
+            pos = layer.data_offset + i * 36
+            tree = layer.data[pos:pos + 20]
+            parent1, parent2, high, low = struct.unpack_from('>IIII', layer.data, pos + 20)
+            parents = []
+            if parent1 != graph_no_parent:
+                parents.append(self.get_oid(parent1))
+            if parent2 & graph_edge_flag:  # octopus merge, the rest parents are in EDGE chunk
+                pos = layer.edges_offset + (parent2 & 0x7fffffff) * 4
+                while True:
+                    edge, = struct.unpack_from('>I', layer.data, pos)
+                    parents.append(self.get_oid(edge & 0x7fffffff))
+                    if edge & graph_edge_flag:
+                        break
+                    pos += 4
+            elif parent2 != graph_no_parent:
+                parents.append(self.get_oid(parent2))
+            return tree, parents, ((high & 3) << 32) | low
+        return None
+
+
+class CommitInfo:
+    __slots__ = ('tree', 'parents', 'author', 'email', 'author_time', 'date', 'subject')
+
+    def __init__(self, tree: bytes, parents: List[bytes], author: str, email: str,
+                 author_time: int, date: int, subject: str):
+        self.tree = tree
+        self.parents = parents
+        self.author = author
+        self.email = email
+        self.author_time = author_time
+        self.date = date
+        self.subject = subject
+
+
+def split_ident(ident: bytes) -> Tuple[bytes, bytes, int]:
+    """ Split `name <email> timestamp timezone` the way git does, broken parts are left empty. """
+    lt = ident.find(b'<')
+    if lt < 0:
+        return ident.strip(), b'', 0
+    gt = ident.find(b'>', lt)
+    if gt < 0:
+        return ident[:lt].rstrip(), b'', 0
+    # The timestamp follows the last >, in case the email contains another one
+    date = ident[ident.rfind(b'>') + 1:].split()
+    timestamp = int(date[0]) if date and date[0].isdigit() else 0
+    return ident[:lt].rstrip(), ident[lt + 1:gt], timestamp
+
+
+def get_subject(message: bytes) -> bytes:
+    """ Lines of the first paragraph joined by spaces, like %s of git log. """
+    lines = []
+    for line in message.split(b'\n'):
+        line = line.rstrip()
+        if line:
+            lines.append(line)
+        elif lines:
+            break
+    return b' '.join(lines)
+
+
+def parse_commit(data: bytes) -> CommitInfo:
+    header, _, message = data.partition(b'\n\n')
+    tree, parents = b'', []
+    author = email = b''
+    author_time = date = 0
+    encoding = 'utf8'
+    for line in header.split(b'\n'):
+        key, _, value = line.partition(b' ')
+        if key == b'tree':
+            tree = bytes.fromhex(value.decode())
+        elif key == b'parent':
+            parents.append(bytes.fromhex(value.decode()))
+        elif key == b'author':
+            author, email, author_time = split_ident(value)
+        elif key == b'committer':
+            date = split_ident(value)[2]
+        elif key == b'encoding':
+            encoding = value.decode('ascii', errors='replace')
+
+    def decode(x: bytes) -> str:
+        return x.decode(encoding, errors='replace')
+
+    try:
+        decode(b'')
+    except LookupError:  # unknown encoding, git would leave it as is
+        encoding = 'utf8'
+    return CommitInfo(tree, parents, decode(author), decode(email), author_time, date,
+                      decode(get_subject(message)))
+
+
+def parse_tree(data: bytes) -> List[Tuple[bytes, int, bytes]]:
+    """ Return (name, mode, id) of the tree entries, in the order of the tree. """
+    entries = []
+    pos, end = 0, len(data)
+    while pos < end:
+        space = data.index(b' ', pos)
+        nul = data.index(b'\0', space)
+        entries.append((data[space + 1:nul], int(data[pos:space], 8), data[nul + 1:nul + 21]))
+        pos = nul + 21
+    return entries
+
+
+def parse_tag_target(data: bytes) -> bytes:
+    """ Id of the object a tag points to. """
+    for line in data.split(b'\n'):
+        if line.startswith(b'object '):
+            return bytes.fromhex(line[7:].decode())
+        if not line:
+            break
+    raise ValueError('Invalid tag object')
+
+
+def read_refs(git_dir: str) -> Dict[str, str]:
+    """ {ref name: target} of packed and loose refs, symbolic ref targets start with `ref: `. """
+    refs = {}
+    try:
+        with open(os.path.join(git_dir, 'packed-refs'), encoding='utf8') as f:
+            for line in f:
+                if line.startswith('#') or line.startswith('^'):
+                    continue
+                parts = line.split()
+                if len(parts) == 2:
+                    refs[parts[1]] = parts[0]
+    except FileNotFoundError:
+        pass
+    refs_dir = os.path.join(git_dir, 'refs')
+    for dir_path, _, file_names in os.walk(refs_dir):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            name = 'refs/' + os.path.relpath(path, refs_dir).replace(os.sep, '/')
+            try:
+                with open(path, encoding='utf8') as f:
+                    refs[name] = f.read().strip()
+            except (OSError, UnicodeDecodeError):
+                continue
+    return refs
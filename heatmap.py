@@ -0,0 +1,144 @@
+# coding: utf8
+"""Render calendar heatmaps with NumPy, a grid of palette indexes is upsampled in one shot."""
+import datetime
+import functools
+import math
+from typing import List, Dict, Any, Tuple
+
+import numpy as np
+from PIL import Image, ImageColor
+
+# Layout name -> (cell size, gap size) in pixels
+layout_sizes = {
+    'rows': (26, 4),
+    'weeks': (9, 3),
+}
+# Days of a row in the rows layout
+row_days = 19
+# Weeks of a band in the weeks layout, longer ranges are split into bands stacked vertically
+band_weeks = 53
+
+
+@functools.lru_cache(maxsize=None)
+def get_day_grid(layout: str, first_day: datetime.date, days: int) -> np.ndarray:
+    """
+    Return the grid of a time range, each cell is a day counting from first_day as 0, or -1 if
+    it's empty. The rows layout fills rows of 19 days, the weeks layout puts each week in a column
+    from Sunday to Saturday like GitHub. Ranges longer than a year get rows of 19 * scale days,
+    or bands of 53 weeks, see get_scale().
+    """
+    if layout == 'rows':
+        row_size = row_days * get_scale(layout, days)
+        # Both leap years and other years fill 20 rows, so all years have the same size
+        rows = (days + row_size - 1) // row_size
+        grid = np.full(rows * row_size, -1, dtype=np.int32)
+        grid[:days] = np.arange(days)
+        grid = grid.reshape(rows, row_size)
+    elif layout == 'weeks':
+        first_row = (first_day.weekday() + 1) % 7
+        cells = np.arange(days) + first_row
+        weeks = (first_row + days + 6) // 7
+        if weeks > band_weeks + 1:
+            # A band of 7 days and an empty row between bands
+            band, week = cells // 7 // band_weeks, cells // 7 % band_weeks
+            grid = np.full((8 * band[-1] + 7, band_weeks), -1, dtype=np.int32)
+            grid[band * 8 + cells % 7, week] = np.arange(days)
+        else:
+            grid = np.full((7, weeks), -1, dtype=np.int32)
+            grid[cells % 7, cells // 7] = np.arange(days)
+    else:
+        raise ValueError('Unknown calendar layout: {0}'.format(layout))
+    grid.flags.writeable = False
+    return grid
+
+
+def get_scale(layout: str, days: int) -> int:
+    """
+    How many times a row of the rows layout is longer than 19 days, rows get longer and cells get
+    smaller for ranges longer than a year, so the grid keeps about the size of a year.
+    """
+    if layout != 'rows' or days <= 366:
+        return 1
+    return math.ceil(math.sqrt(days / 366))
+
+
+def get_cell_size(layout: str, days: int) -> Tuple[int, int]:
+    """ Cell size and gap size of the grid in pixels. """
+    cell_size, gap_size = layout_sizes[layout]
+    scale = get_scale(layout, days)
+    if scale == 1:
+        return cell_size, gap_size
+    step = max((cell_size + gap_size) // scale, 2)
+    gap_size = max(gap_size // scale, 1)
+    return step - gap_size, gap_size
+
+
+def get_quantile_thresholds(weights: np.ndarray, levels: int) -> List[float]:
+    """ Thresholds splitting days with commits into levels of about the same number of days. """
+    active = weights[weights > 0]
+    if not len(active):
+        return []
+    quantiles = np.quantile(active, np.arange(1, levels) / levels)
+    return sorted(set(quantiles.tolist()))
+
+
+def get_levels(weights: np.ndarray, thresholds: List[float]) -> np.ndarray:
+    """
+    Level 0 is for days without commits. Other days get 1 plus the number of thresholds not
+    greater than their weights, e.g. thresholds [48, 128] put weight 48 in level 2.
+    """
+    levels = np.searchsorted(np.asarray(thresholds, dtype=np.float64), weights, side='right') + 1
+    levels[weights <= 0] = 0
+    return levels
+
+
+def upsample(index: np.ndarray, palette: np.ndarray, cell_size: int, gap_size: int) -> Image:
+    """
+    Paint each cell of the grid as a square of cell_size + 1 pixels in its palette color, the
+    last color of the palette fills the gaps.
+    """
+    rows, cols = index.shape
+    step = cell_size + gap_size
+    height, width = rows * step - gap_size, cols * step - gap_size
+    ys, xs = np.arange(height), np.arange(width)
+    # Squares include their right and lower edges, like ImageDraw.rectangle does
+    row_of_y = np.where(ys % step <= cell_size, ys // step, rows)
+    col_of_x = np.where(xs % step <= cell_size, xs // step, cols)
+    # Look up colors as uint32 per cell first, then repeat columns and rows of the small grid
+    gap = len(palette) - 1
+    colored = np.full((rows + 1, cols + 1), palette[gap], dtype=np.uint32)
+    colored[:rows, :cols] = palette[index]
+    pixels = colored[:, col_of_x][row_of_y]
+    return Image.frombuffer('RGBA', (width, height), pixels, 'raw', 'RGBA', 0, 1)
+
+
+def render_calendar(weights: Dict[int, int], first_day: datetime.date, days: int,
+                    colors: List[str], layout='rows', thresholds: Any = 'quantile',
+                    background='white') -> Image:
+    """
+    Render weights of days, keyed by day counting from first_day as 0, as a heatmap. Colors are
+    of level 0 to len(colors) - 1, thresholds are the weights separating level 1 and above, or
+    'quantile' to compute them from weights.
+    """
+    grid = get_day_grid(layout, first_day, days)
+    day_weights = np.zeros(days, dtype=np.float64)
+    if weights:
+        day_weights[np.fromiter(weights.keys(), dtype=np.int64)] = list(weights.values())
+    if thresholds == 'quantile':
+        thresholds = get_quantile_thresholds(day_weights, len(colors) - 1)
+    levels = get_levels(day_weights, thresholds)
+    levels = np.minimum(levels, len(colors) - 1)
+    palette = get_palette(tuple(colors) + (background,))
+    # Empty cells of the grid have the background color
+    index = np.where(grid >= 0, levels[grid], len(colors))
+    cell_size, gap_size = get_cell_size(layout, days)
+    return upsample(index, palette, cell_size, gap_size)
+
+
+@functools.lru_cache(maxsize=None)
+def get_palette(colors: Tuple[str, ...]) -> np.ndarray:
+    """ RGBA colors packed in uint32, so a pixel is looked up at once. """
+    palette = np.array([ImageColor.getcolor(color, 'RGBA') for color in colors], dtype=np.uint8)
+    palette = palette.view(np.uint32).ravel()
+    palette.flags.writeable = False
+    return palette
@@ -0,0 +1,123 @@
+# coding: utf8
+"""Match commit authors to people by email, with aliases and .mailmap support."""
+import os
+import re
+from typing import Iterable, Optional, Tuple
+
+import conf
+import util
+
+mailmap_entry_re = re.compile(r'([^<]*)<([^>]*)>')
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+class Mailmap:
+    """
+    Entries of a .mailmap file, see https://git-scm.com/docs/gitmailmap. Emails and names are
+    matched case insensitively like git does.
+    """
+
+    def __init__(self):
+        # (commit email, commit name or '') -> (proper name, proper email), empty if not mapped
+        self.entries = {}
+
+    @classmethod
+    def from_file(cls, path: str) -> 'Mailmap':
+        mailmap = cls()
+        if not os.path.isfile(path):
+            return mailmap
+        with open(path, encoding='utf8', errors='replace') as f:
+            for line in f:
+                mailmap.add_line(line)
+        return mailmap
+
+    def add_line(self, line: str):
+        line = line.split('#', maxsplit=1)[0]
+        items = [(name.strip(), email.strip()) for name, email in mailmap_entry_re.findall(line)]
+        if len(items) == 1:  # Proper Name <commit@email>
+            (proper_name, commit_email), proper_email, commit_name = items[0], '', ''
+        elif len(items) == 2:  # [Proper Name] <proper@email> [Commit Name] <commit@email>
+            (proper_name, proper_email), (commit_name, commit_email) = items
+        else:
+            return
+        key = (normalize_email(commit_email), commit_name.lower())
+        self.entries[key] = (proper_name, proper_email)
+
+    def resolve(self, name: str, email: str) -> Tuple[str, str]:
+        """ Return the canonical name and email of a commit author. """
+        email_key = normalize_email(email)
+        proper = self.entries.get((email_key, name.lower())) or self.entries.get((email_key, ''))
+        if not proper:
+            return name, email
+        return proper[0] or name, proper[1] or email
+
+
+class IdentityIndex:
+    """
+    Hashed index from every known email of a person to the person. It is built once from the
+    context and the alias file, and shared by all repos.
+    """
+
+    def __init__(self):
+        self.owners = {}
+
+    @classmethod
+    def from_ctx(cls, ctx: util.DotDict) -> 'IdentityIndex':
+        """ Index the user of ctx, or every member of ctx.members in team mode. """
+        index = cls()
+        for member in ctx.members or [ctx]:
+            index.add(member.name, member.emails)
+        alias_file = ctx.alias_file or conf.alias_file
+        if alias_file:
+            index.load_aliases(os.path.join(ctx.run_dir, alias_file))
+        return index
+
+    def add(self, person: str, emails: Iterable[str]):
+        for email in emails:
+            self.owners[normalize_email(email)] = person
+
+    def load_aliases(self, path: str):
+        """
+        Each line of the alias file lists emails of one person separated by spaces, a line is
+        attached to the person who owns any email of it.
+        """
+        if not os.path.isfile(path):
+            print('Alias file {0} not found!'.format(path))
+            return
+        with open(path, encoding='utf8') as f:
+            for line in f:
+                emails = line.split('#', maxsplit=1)[0].split()
+                owners = [self.owners[normalize_email(e)] for e in emails
+                          if normalize_email(e) in self.owners]
+                if owners:
+                    self.add(owners[0], emails)
+
+    def for_repo(self, repo_dir: str) -> 'RepoIdentity':
+        return RepoIdentity(self, Mailmap.from_file(os.path.join(repo_dir, '.mailmap')))
+
+
+class RepoIdentity:
+    """ Identity index combined with the .mailmap of one repo. """
+
+    def __init__(self, index: IdentityIndex, mailmap: Mailmap):
+        self.index = index
+        self.mailmap = mailmap
+        # Authors repeat in every commit, remember the owner of each (name, email) pair
+        self.owners = {}
+
+    def canonical(self, name: str, email: str) -> Tuple[str, str]:
+        return self.mailmap.resolve(name, email)
+
+    def owner(self, name: str, email: str) -> Optional[str]:
+        """ The person who authored the commit, None if it's someone unknown. """
+        key = (name, email)
+        if key not in self.owners:
+            owner = self.index.owners.get(normalize_email(email))
+            if owner is None:
+                _, proper_email = self.mailmap.resolve(name, email)
+                owner = self.index.owners.get(normalize_email(proper_email))
+            self.owners[key] = owner
+        return self.owners[key]
@@ -0,0 +1,79 @@
+# coding: utf8
+"""Classify repository files with a long-lived linguist.rb process."""
+import atexit
+import json
+import os
+import subprocess
+import threading
+from typing import Dict, Any
+
+import profiler
+
+workers = {}
+workers_lock = threading.Lock()
+
+
+class LinguistWorker:
+    """
+    A ruby process running linguist.rb --server, ruby and its gems are loaded only once. Requests
+    and responses are json lines, requests are serialized by a lock.
+    """
+
+    def __init__(self, run_dir: str):
+        ruby_script = os.path.join(run_dir, 'linguist.rb')
+        self.proc = subprocess.Popen(['ruby', ruby_script, '--server'], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+        self.lock = threading.Lock()
+
+    def request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        with self.lock:
+            self.proc.stdin.write((json.dumps(request) + '\n').encode('utf8'))
+            self.proc.stdin.flush()
+            line = self.proc.stdout.readline()
+        if not line:
+            raise RuntimeError('linguist worker exited with code {0}'.format(self.proc.poll()))
+        response = json.loads(line.decode('utf8'))
+        if 'error' in response:
+            raise RuntimeError('linguist error: ' + response['error'])
+        return response
+
+    def ping(self) -> bool:
+        try:
+            return self.request({}).get('ok', False)
+        except Exception as e:
+            print(e)
+            return False
+
+    def analyze(self, repo_dir: str, old_commit='', old_cache=None) -> Dict[str, Any]:
+        """
+        Return {'commit': HEAD, 'breakdown': {language: [file]}, 'cache': linguist cache}, only
+        blobs changed since old_commit are classified if its cache is given.
+        """
+        with profiler.span('linguist analyze', 'subprocess', repo=repo_dir):
+            return self.request({
+                'repo': repo_dir,
+                'old_commit': old_commit or None,
+                'old_cache': old_cache or None,
+            })
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+
+
+def get_worker(run_dir: str) -> LinguistWorker:
+    """ The shared worker of run_dir, it's started again if it has exited. """
+    with workers_lock:
+        worker = workers.get(run_dir)
+        if worker is None or worker.proc.poll() is not None:
+            worker = workers[run_dir] = LinguistWorker(run_dir)
+        return worker
+
+
+@atexit.register
+def close_workers():
+    with workers_lock:
+        for worker in workers.values():
+            worker.close()
+        workers.clear()
@@ -13,4 +13,37 @@ def detect_code_files()
   puts JSON.generate(project.breakdown_by_file)
 end
 
-detect_code_files()
\ No newline at end of file
+# Analyze the HEAD of a repo, only blobs changed since old_commit are classified if the linguist
+# cache of old_commit is given.
+def analyze(request)
+  repo = Rugged::Repository.new(request['repo'])
+  commit_oid = repo.head.target_id
+  old_commit_oid, old_cache = request['old_commit'], request['old_cache']
+  # The old commit is gone if history has been rewritten, analyze the whole tree then
+  unless old_commit_oid && old_cache && repo.exists?(old_commit_oid)
+    old_commit_oid, old_cache = nil, nil
+  end
+  project = Linguist::Repository.incremental(repo, commit_oid, old_commit_oid, old_cache)
+  {'commit' => commit_oid, 'breakdown' => project.breakdown_by_file, 'cache' => project.cache}
+end
+
+# Serve requests of JSON lines from stdin, so ruby and gems are loaded only once. A request
+# without repo is a ping.
+def serve()
+  STDOUT.sync = true
+  STDIN.each_line do |line|
+    begin
+      request = JSON.parse(line)
+      response = request['repo'] ? analyze(request) : {'ok' => true}
+    rescue StandardError => e
+      response = {'error' => e.message}
+    end
+    puts JSON.generate(response)
+  end
+end
+
+if ARGV[0] == '--server' then
+  serve()
+else
+  detect_code_files()
+end
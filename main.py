@@ -3,9 +3,12 @@
 import os
 import traceback
 from datetime import datetime
-from typing import Dict, Any
+from typing import List, Dict, Any
 
+import conf
 import const
+import discovery
+import profiler
 import util
 from dependency import check_linguist
 from report import Reporter
@@ -22,13 +25,15 @@ def get_user_info() -> Dict[str, Any]:
         name = input('请输入你的名字，按回车继续\n').strip()
         if name:
             break
-    now = datetime.now()
-    recent_year = now.year
-    if now.month == 1:
-        recent_year -= 1
-    year = input('请输入你想要生成报告的年份，不输入则使用 {0}\n'.format(recent_year)).strip()
-    if not year:
-        year = recent_year
+    recent_year = get_recent_year()
+    while True:
+        period = input('请输入你想要生成报告的年份，或者 2018-01..2018-04 这样不含结束日期的时间范围，'
+                       '不输入则使用 {0}\n'.format(recent_year)).strip()
+        try:
+            since, until = util.parse_period(period or str(recent_year))
+            break
+        except ValueError as e:
+            print(e)
     print('请输入你近一年使用过的 git 邮箱，不输入则使用 ${0} 的结果'.format(const.GIT_EMAIL_CMD))
     emails = []
     while True:
@@ -50,14 +55,7 @@ def get_user_info() -> Dict[str, Any]:
         git_inputs.extend(git_input.split())
     # Try to find git repositories in parent directory
     if not git_inputs:
-        parent_dir = os.path.join(RUN_DIR, os.pardir)
-        for root, dirs, files in os.walk(parent_dir):
-            for dir_name in dirs:
-                if dir_name.startswith('.') or dir_name == 'year2018':
-                    continue
-                dir_path = os.path.join(root, dir_name)
-                if util.is_git_dir(dir_path):
-                    git_inputs.append(dir_path)
+        git_inputs = find_git_inputs(os.path.join(RUN_DIR, os.pardir))
     print('请选择是否对报告中的项目名、人名等进行加密，默认不加密(开启加密后，year2018 会变成 ye****18)')
     encrypt = False
     option = input('是否加密(y/n)，输入 y 开启\n').strip()
@@ -65,7 +63,8 @@ def get_user_info() -> Dict[str, Any]:
         encrypt = True
     info = {
         'name': name,
-        'year': int(year),
+        'since': since,
+        'until': until,
         'emails': list(set(emails)),
         'git_inputs': list(set(git_inputs)),
         'encrypt': encrypt,
@@ -73,11 +72,26 @@ def get_user_info() -> Dict[str, Any]:
     return info
 
 
+def get_recent_year() -> int:
+    """ The current year, or the last year in January. """
+    now = datetime.now()
+    return now.year - 1 if now.month == 1 else now.year
+
+
+def find_git_inputs(parent_dir: str) -> List[str]:
+    """ Find git repositories in parent_dir, except this one. """
+    with profiler.span('find repos'):
+        return discovery.find_git_repos(parent_dir, excluded=[RUN_DIR])
+
+
 def main():
+    if conf.profile:
+        profiler.enable()
     ctx = util.DotDict()
     ctx.run_dir = RUN_DIR
     ctx.update(get_user_info())
-    ctx.update(check_linguist(ctx))
+    with profiler.span('check linguist'):
+        ctx.update(check_linguist(ctx))
     print('\nContext:')
     for key, val in ctx.items():
         if key == 'git_inputs':
@@ -87,8 +101,9 @@ def main():
         print(key + ': ' + str(val))
     print('报告生成中...')
     try:
-        reporter = Reporter(ctx)
-        reporter.generate_report()
+        with profiler.span('generate report'):
+            reporter = Reporter(ctx)
+            reporter.generate_report()
         print('报告生成成功')
         print('请到 ' + reporter.output_dir + ' 查看你的年度编程报告')
     except Exception as e:
@@ -96,6 +111,8 @@ def main():
         traceback.print_exc()
         print('报告生成失败')
         print('请到 ' + const.REPO_URL + ' 提 issue')
+    if profiler.enabled:
+        profiler.save(os.path.join(RUN_DIR, 'output'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,131 @@
+# coding: utf8
+"""
+Record spans of pipeline phases, report pages and subprocesses when profiling is enabled, see
+conf.profile. Spans are saved as a Chrome trace, which chrome://tracing or ui.perfetto.dev opens,
+and summed up in a table.
+"""
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from typing import List, Dict, Any, Callable, Iterator
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, peak memory isn't recorded there
+    resource = None
+
+enabled = False
+# Trace events of this process, in the Trace Event Format of Chrome
+events = []
+events_lock = threading.Lock()
+# Order of span categories in the summary, subprocess spans are named by their commands
+categories = ['phase', 'repo', 'page', 'fallback', 'subprocess']
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+@contextlib.contextmanager
+def span(name: str, category='phase', **args) -> Iterator[None]:
+    """ Record the with block as a span of name, args are shown with the span in the trace. """
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        event = {
+            'name': name, 'cat': category, 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+            'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args,
+        }
+        with events_lock:
+            events.append(event)
+            if category != 'subprocess':
+                events.append({'name': 'peak rss', 'ph': 'C', 'ts': end * 1e6, 'pid': os.getpid(),
+                               'args': get_peak_rss()})
+
+
+def get_command_name(cmd: Any) -> str:
+    """ Name of a command in the summary, e.g. git log for git log --stdin ... """
+    words = cmd.split() if isinstance(cmd, str) else list(cmd)
+    words = [word for word in words[:2] if not word.startswith('-')]
+    return ' '.join(words)
+
+
+def get_peak_rss() -> Dict[str, float]:
+    """ Peak resident memory in MB of this process and of its finished subprocesses. """
+    if resource is None:
+        return {}
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    unit = 1 << 20 if sys.platform == 'darwin' else 1 << 10
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit,
+    }
+
+
+def call_traced(profile: bool, func: Callable, *args) -> Any:
+    """
+    Call func in a worker process and return its result with the events it recorded, the
+    parent adds them to its trace by add_events().
+    """
+    if profile:
+        enable()
+    result = func(*args)
+    pid = os.getpid()
+    with events_lock:
+        # A forked worker starts with a copy of the events of its parent
+        recorded = [event for event in events if event['pid'] == pid]
+        events.clear()
+    return result, recorded
+
+
+def add_events(recorded: List[Dict[str, Any]]):
+    with events_lock:
+        events.extend(recorded)
+
+
+def summarize() -> List[str]:
+    """ Lines of a table of the total and max time of spans by category and name. """
+    stats = {}
+    for event in events:
+        if event['ph'] != 'X':
+            continue
+        stat = stats.setdefault((event['cat'], event['name']), [0, 0.0, 0.0])
+        stat[0] += 1
+        stat[1] += event['dur'] / 1e6
+        stat[2] = max(stat[2], event['dur'] / 1e6)
+    lines = ['{0:<12}{1:<40}{2:>8}{3:>12}{4:>10}'.format('category', 'name', 'count',
+                                                         'total(s)', 'max(s)')]
+    order = {category: i for i, category in enumerate(categories)}
+    keys = sorted(stats, key=lambda x: (order.get(x[0], len(order)), -stats[x][1]))
+    for category, name in keys:
+        count, total, longest = stats[(category, name)]
+        lines.append('{0:<12}{1:<40}{2:>8}{3:>12.3f}{4:>10.3f}'.format(
+            category, name[:39], count, total, longest))
+    rss = get_peak_rss()
+    if rss:
+        lines.append('Peak RSS: {0:.1f} MB, subprocesses: {1:.1f} MB'.format(
+            rss['self'], rss['children']))
+    return lines
+
+
+def save(output_dir: str) -> str:
+    """ Save the trace as output_dir/trace.json, print the summary and return the trace path. """
+    path = os.path.join(output_dir, 'trace.json')
+    os.makedirs(output_dir, exist_ok=True)
+    with events_lock:
+        trace = {'traceEvents': list(events), 'displayTimeUnit': 'ms',
+                 'otherData': {'peak_rss_mb': get_peak_rss()}}
+    with open(path, 'w', encoding='utf8') as f:
+        json.dump(trace, f, ensure_ascii=False)
+    print('\n'.join(summarize()))
+    print('Trace is saved in {0}, open it in chrome://tracing or ui.perfetto.dev'.format(path))
+    return path
@@ -1,39 +1,27 @@
 # coding: utf8
-import calendar
 import csv
+import functools
+import math
 import os
-from typing import List, Tuple, Any
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, Dict, Any, Callable
 
-import matplotlib
-import matplotlib.pyplot as plt
-import networkx as nx
-from PIL import Image, ImageFont, ImageDraw
-from matplotlib import font_manager
+import numpy as np
+from PIL import Image
 
+import conf
 import const
+import fonts
+import heatmap
+import profiler
 import util
 from repository import Repos
 
-file_dir = os.path.dirname(os.path.realpath(__file__))
-font_file_normal = os.path.join(file_dir, 'static/SourceHanSansSC/SourceHanSansSC-Normal.otf')
-font_file_regular = os.path.join(file_dir, 'static/SourceHanSansSC/SourceHanSansSC-Regular.otf')
-
-# Set font family for matplotlib
-font_name = 'Source Han Sans SC'
-font_entry = font_manager.FontEntry(fname=font_file_normal, name=font_name)
-font_manager.fontManager.ttflist.extend([font_entry])
-matplotlib.rcParams['font.family'] = font_name
-
-font_normal_18 = ImageFont.truetype(font_file_normal, size=18)
-font_normal_20 = ImageFont.truetype(font_file_normal, size=20)
-font_normal_26 = ImageFont.truetype(font_file_normal, size=26)
-font_normal_28 = ImageFont.truetype(font_file_normal, size=28)
-font_normal_30 = ImageFont.truetype(font_file_normal, size=30)
-font_regular_30 = ImageFont.truetype(font_file_regular, size=30)
-font_regular_32 = ImageFont.truetype(font_file_regular, size=32)
-font_regular_36 = ImageFont.truetype(font_file_regular, size=36)
-
 default_size = (720, 1280)
+# Size of matplotlib figures pasted into pages, in inches of 100 dpi
+figure_size = (5, 5)
+# Partners on the first ring of the radial merge graph, ring k holds 8 * k of them
+ring_size = 8
 colors = {
     0: '#ebedf0',
     1: '#c6e48b',
@@ -44,38 +32,67 @@ colors = {
 
 
 class TextStyle:
-    def __init__(self, color: str, font: Any):
+    def __init__(self, color: str, font_weight: str, font_size: int):
         self.color = color
-        self.font = font
+        self.font_weight = font_weight
+        self.font_size = font_size
+
+
+styles = (TextStyle('black', 'normal', 26), TextStyle(colors[3], 'regular', 36))
+styles1 = (TextStyle('black', 'normal', 30), TextStyle('black', 'normal', 30))
 
 
 class Reporter:
-    def __init__(self, ctx: util.DotDict):
+    """
+    Compute the stats of repos and render report pages. Pages are painted from plain stat data by
+    module level painters, so they can be rendered by a process pool as well.
+    """
+
+    def __init__(self, ctx: util.DotDict, repos: Repos = None):
         self.ctx = ctx
-        self.repos = Repos(ctx)
-        self.output_dir = os.path.join(self.ctx.run_dir, 'output')
-        if not os.path.exists(self.output_dir):
-            os.mkdir(self.output_dir)
+        self.repos = repos or Repos(ctx)
+        self.output_dir = ctx.output_dir or os.path.join(self.ctx.run_dir, 'output')
+        os.makedirs(self.output_dir, exist_ok=True)
         self.report_file = open(os.path.join(self.output_dir, 'report.csv'), 'w', encoding='utf8')
         self.report = csv.writer(self.report_file, lineterminator='\n')
-        self.styles = (TextStyle('black', font_normal_26), TextStyle(colors[3], font_regular_36))
-        self.styles1 = (TextStyle('black', font_normal_30), TextStyle('black', font_normal_30))
+        since, until = util.get_time_range(ctx)
+        # Everything a painter needs besides stat data, it's sent to render workers
+        self.page = util.DotDict({
+            'name': ctx.name,
+            'since': since,
+            'until': until,
+            'period': util.get_period_name(since, until),
+            # A calendar year, reports of other time ranges say "this period" instead of year
+            'yearly': (since, until) == util.get_year_ends(util.timestamp_to_datetime(since).year),
+            'encrypt': ctx.encrypt,
+            'run_dir': ctx.run_dir,
+            'output_dir': self.output_dir,
+        })
+        self.render_workers = ctx.render_workers or conf.render_workers
+        self.jobs = []
 
     def generate_report(self):
-        self.write_stat()
-        self.draw_cover()
-        self.draw_short_summary()
-        self.draw_most_common_repo()
-        self.draw_language_stat()
-        self.draw_merge_stat()
-        self.draw_busiest_day()
-        self.draw_latest_commit()
-        self.draw_commit_distribution()
-        self.draw_summary()
+        steps = [
+            self.write_stat, self.draw_cover, self.draw_short_summary, self.draw_most_common_repo,
+            self.draw_language_stat, self.draw_merge_stat, self.draw_busiest_day,
+            self.draw_latest_commit, self.draw_commit_distribution, self.draw_summary,
+            self.draw_trend, self.render_jobs,
+        ]
+        # Stats are computed by draw methods, pages are rendered by them too unless rendered in
+        # parallel by render_jobs
+        for step in steps:
+            with profiler.span(step.__name__, 'page'):
+                step()
 
     def write_stat(self):
         email_name = util.get_name_from_email(self.ctx.emails[0])
-        title = ['Annual programming report {0} of {1}'.format(self.ctx.year, email_name)]
+        first = util.timestamp_to_datetime(self.page.since)
+        last = util.timestamp_to_datetime(self.page.until - 1)
+        if self.page.yearly:
+            title = ['Annual programming report {0} of {1}'.format(first.year, email_name)]
+        else:
+            title = ['Programming report {0:%Y-%m-%d} - {1:%Y-%m-%d} of {2}'.format(
+                first, last, email_name)]
         self.report.writerow(title)
         self.report.writerow('')
 
@@ -128,432 +145,634 @@ class Reporter:
             self.report.writerow(row)
         self.report.writerow('')
 
+        trend = self.repos.get_trend()
+        if trend:
+            self.report.writerow(['Trend by year'])
+            headers = ['year', 'projects', 'commits', 'merges', 'insertions', 'deletions',
+                       'active days', 'language']
+            self.report.writerow(headers)
+            for year, stat in sorted(trend.items()):
+                row = [
+                    year, stat.projects, stat.commits, stat.merges, stat.insert, stat.delete,
+                    stat.days, stat.language,
+                ]
+                self.report.writerow(row)
+            self.report.writerow('')
+
         self.report_file.flush()
 
     def draw_cover(self):
-        img = Image.new('RGBA', default_size, 'white')
-        self.add_header(img)
-        self.add_footer(img)
-        calendar_graph = self.get_calendar_graph()
-        pos_x, pos_y = (img.size[0] - calendar_graph.size[0]) // 2, 240
-        img.paste(calendar_graph, (pos_x, pos_y))
-        texts1 = ['你的编程秘密隐藏在上面这张日历图里']
-        texts2 = ['答案即将揭晓']
-        draw_center_with_y(img, 880, texts1, [], self.styles1)
-        draw_center_with_y(img, 950, texts2, [], self.styles1)
-        self.save_img(img, '1_cover', 'png')
+        weights = self.repos.get_commit_weight_by_day()
+        self.render(paint_cover, '1_cover', weights)
 
     def draw_short_summary(self):
-        img = Image.new('RGBA', default_size, 'white')
-        self.add_header(img)
-        self.add_footer(img)
         summary = self.repos.get_commit_summary()
-        texts1 = ['{0} 年你一共参与了 '.format(self.ctx.year), str(summary.projects), ' 个项目']
-        bolds1 = [1]
-        texts2 = ['提交更新 ', str(summary.commits), ' 次']
-        bolds2 = [1]
-        texts3 = ['修改代码 ', str(summary.insert + summary.delete), ' 行']
-        bolds3 = [1]
-        texts4 = ['看到这些数字，你是否充满了成就感呢']
-        draw_center_with_y(img, 200, texts1, bolds1, self.styles)
-        draw_center_with_y(img, 260, texts2, bolds2, self.styles)
-        draw_center_with_y(img, 320, texts3, bolds3, self.styles)
-        draw_center_with_y(img, 600, texts4, [], self.styles1)
-        self.save_img(img, '2_short_summary', 'png')
+        self.render(paint_short_summary, '2_short_summary', summary)
 
     def draw_most_common_repo(self):
-        img = Image.new('RGBA', default_size, 'white')
-        self.add_header(img)
-        self.add_footer(img)
         repo = self.repos.get_most_common_repo()
-        texts1 = [
-            '{0} 年你最常去的地方是 '.format(self.ctx.year),
-            repo.name,
-        ]
-        bolds1 = [1]
-        summary = repo.get_commit_summary()
-        texts2 = [
-            '你在这个项目上进行了 ',
-            str(summary.commits),
-            ' 次提交，',
-            str(summary.merges),
-            ' 次合并']
-        bolds2 = [1, 3]
-        texts3 = [
-            '共计修改了 ',
-            str(summary.insert + summary.delete),
-            ' 行代码'
-        ]
-        bolds3 = [1]
-        texts4 = ['在这里，你挥洒了最多的汗水']
-        texts5 = ['和泪水']
-        draw_center_with_y(img, 240, texts1, bolds1, self.styles)
-        draw_center_with_y(img, 300, texts2, bolds2, self.styles)
-        draw_center_with_y(img, 360, texts3, bolds3, self.styles)
-        draw_center_with_y(img, 600, texts4, [], self.styles1)
-        draw_center_with_y(img, 670, texts5, [], self.styles1)
-        self.save_img(img, '3_most_common_repo', 'png')
+        data = util.DotDict(repo.get_commit_summary())
+        data.name = repo.name
+        self.render(paint_most_common_repo, '3_most_common_repo', data)
 
     def draw_language_stat(self):
-        img = Image.new('RGBA', default_size, 'white')
-        self.add_header(img)
-        self.add_footer(img)
         lang_stat = self.repos.get_language_stat()
-        favor = max(lang_stat.keys(), key=lambda x: lang_stat[x]['weight'])
-        texts1 = [
-            '{0} 年你最常用的编程语言是 '.format(self.ctx.year),
-            favor,
-        ]
-        bolds1 = [1]
-        texts2 = [
-            '这一年你一共使用 ',
-            favor,
-            ' 提交代码 ',
-            str(lang_stat[favor]['commits']),
-            ' 次',
-        ]
-        bolds2 = [1, 3]
-        texts3 = [
-            '增加代码 ',
-            str(lang_stat[favor]['insert']),
-            ' 行，删减代码 ',
-            str(lang_stat[favor]['delete']),
-            ' 行'
-        ]
-        bolds3 = [1, 3]
-        draw_center_with_y(img, 180, texts1, bolds1, self.styles)
-        draw_center_with_y(img, 240, texts2, bolds2, self.styles)
-        draw_center_with_y(img, 300, texts3, bolds3, self.styles)
-
-        plt.figure(1, figsize=(5, 5))
-        labels = list(lang_stat.keys())
-        weights = [lang_stat[key]['weight'] for key in labels]
-        percents = util.get_percents(weights)
-        weighted = [(labels[i], percents[i]) for i in range(len(labels))]
-        res = []
-        other_percent = 0
-        for item in weighted:
-            if item[1] > 2:
-                res.append(item)
-            else:
-                other_percent += item[1]
-        if other_percent > 0:
-            other_percent += 0.001
-            res.append(('other', other_percent))
-        labels, weights = [item[0] for item in res], [item[1] for item in res]
-        plt.pie(weights, labels=labels, autopct='%1.1f%%', startangle=90)
-        plt.title('Programming languages by weight')
-        fig_path = self.save_fig('language_pie', 'png')
-        language_pie = Image.open(fig_path)
-        img.paste(language_pie, (100, 360))
-        language_cnt = len(list(p for p in percents if p > 5))
-        if language_cnt == 1:
-            text = '看来你是一个专一的程序员'
-        else:
-            text = '哪种语言是你的最爱呢'
-        texts4 = [
-            text
-        ]
-        draw_center_with_y(img, 840, texts4, [], self.styles1)
-        self.save_img(img, '4_language_stat', 'png')
+        self.render(paint_language_stat, '4_language_stat', lang_stat)
 
     def draw_merge_stat(self):
-        img = Image.new('RGBA', default_size, 'white')
-        self.add_header(img)
-        self.add_footer(img)
         merges = self.repos.get_merge_stat()
         if not merges:
             print('Fail to generate merge stat!')
             return
         user_name = util.get_name_from_email(self.ctx.emails[0])
-        edges = []
-        weights = []
-        for name, stat in merges.items():
-            weight = stat.get('merge', 0) + stat.get('merged_by', 0)
-            weights.append(weight)
-            edges.append([user_name, name, weight])
-        edges.sort(key=lambda x: x[-1], reverse=True)
-        best_partner = edges[0][1]
-        most_merge = merges[best_partner].get('merge', 0) + merges[best_partner].get('merged_by', 0)
-        texts1 = [
-            '{0} 年与你合作最多的小伙伴是 '.format(self.ctx.year),
-            merges[best_partner]['readable_name'],
-        ]
-        bolds1 = [1]
-        texts2 = [
-            '你们互相 review 代码高达 ',
-            str(most_merge),
-            ' 次'
-        ]
-        bolds2 = [1]
-        draw_center_with_y(img, 180, texts1, bolds1, self.styles)
-        draw_center_with_y(img, 240, texts2, bolds2, self.styles)
-
-        weights = util.rescale_to_interval(weights, 0.5, 5)
-        for i, edge in enumerate(edges):
-            edge[-1] = weights[i]
-        graph = nx.Graph()
-        graph.add_weighted_edges_from(edges)
-        plt.figure(1, figsize=(6, 5))
-        nx.draw(graph, with_labels=True, width=weights, node_size=1000, node_color=colors[1],
-                edge_color=colors[2], font_size=10)
-        fig_path = self.save_fig('merge_relations', 'png')
-        merge_graph = Image.open(fig_path)
-        img.paste(merge_graph, (100, 360))
-        texts3 = [
-            '过去一年与你有过交集的那些人'
-        ]
-        texts4 = [
-            '他们现在在哪里呢'
-        ]
-        draw_center_with_y(img, 900, texts3, [], self.styles1)
-        draw_center_with_y(img, 970, texts4, [], self.styles1)
-        self.save_img(img, '5_merge_stat', 'png')
+        partners = sorted(merges, key=lambda x: merges[x]['merge'] + merges[x]['merged_by'],
+                          reverse=True)
+        # Only the top partners are drawn, so the graph takes the same time however many there are
+        if conf.merge_graph_partners:
+            partners = partners[:conf.merge_graph_partners]
+        merges = {name: merges[name] for name in partners}
+        self.render(paint_merge_stat, '5_merge_stat', {'user_name': user_name, 'merges': merges})
 
     def draw_busiest_day(self):
-        img = Image.new('RGBA', default_size, 'white')
-        self.add_header(img)
-        self.add_footer(img)
         date, stat = self.repos.get_busiest_day()
-
-        texts1 = [
-            str(date.month),
-            ' 月 ',
-            str(date.day),
-            ' 日是你过去一年写代码最多的一天'
-        ]
-        bolds1 = [0, 2]
-        texts2 = [
-            '这一天你一共提交了 ',
-            str(len(stat['commits'])),
-            ' 次更新'
-        ]
-        bolds2 = [1]
-        texts3 = [
-            '增加代码 ',
-            str(stat['insert']),
-            ' 行，删减代码 ',
-            str(stat['delete']),
-            ' 行'
-        ]
-        bolds3 = [1, 3]
-        texts4 = [
-            '同时，这也是你被 PM 打断次数最少的一天'
-        ]
-        draw_center_with_y(img, 240, texts1, bolds1, self.styles)
-        draw_center_with_y(img, 300, texts2, bolds2, self.styles)
-        draw_center_with_y(img, 360, texts3, bolds3, self.styles)
-        draw_center_with_y(img, 600, texts4, [], self.styles1)
-        self.save_img(img, '6_busiest_day', 'png')
+        data = {
+            'date': date,
+            'commits': len(stat['commits']),
+            'insert': stat['insert'],
+            'delete': stat['delete'],
+        }
+        self.render(paint_busiest_day, '6_busiest_day', data)
 
     def draw_latest_commit(self):
-        img = Image.new('RGBA', default_size, 'white')
-        self.add_header(img)
-        self.add_footer(img)
         commit = self.repos.get_latest_commit()
-        date = util.timestamp_to_datetime(commit.timestamp)
-        texts1 = [
-            '还记得 ',
-            str(date.month),
-            ' 月 ',
-            str(date.day),
-            ' 日这天吗'
-        ]
-        bolds1 = [1, 3]
-        texts2 = [
-            '在这一天的 ',
-            str(date.hour),
-            ' 时 ',
-            str(date.minute),
-            ' 分，你执行了去年最晚的一次提交'
-        ]
-        bolds2 = [1, 3]
-        draw_center_with_y(img, 240, texts1, bolds1, self.styles)
-        draw_center_with_y(img, 300, texts2, bolds2, self.styles)
-        commit_img = self.get_commit_img(commit)
-        img.paste(commit_img, (60, 400))
-        texts3 = [
-            '再忙，也要照顾好自己'
-        ]
-        draw_center_with_y(img, 800, texts3, [], self.styles1)
-        self.save_img(img, '7_latest_commit', 'png')
+        data = util.DotDict({
+            'id': commit.id,
+            'author': commit.author,
+            'email': commit.email,
+            'timestamp': commit.timestamp,
+            'subject': commit.subject,
+        })
+        self.render(paint_latest_commit, '7_latest_commit', data)
 
     def draw_commit_distribution(self):
-        img = Image.new('RGBA', default_size, 'white')
-        self.add_header(img)
-        self.add_footer(img)
         stat = self.repos.get_commit_times_by_hour()
-        most_hour = max(stat.keys(), key=lambda x: stat[x])
-        most_percent = max(util.get_percents(list(stat.values()), digits=1))
-        texts1 = [
-            '你提交代码最多的时间段是 ',
-            '{0}:00 - {1}:00'.format(most_hour, most_hour + 1),
-        ]
-        bolds1 = [1]
-        texts2 = [
-            '你在这个时间段提交代码的次数占总数的 ',
-            str(most_percent) + '%',
-        ]
-        bolds2 = [1]
-        draw_center_with_y(img, 240, texts1, bolds1, self.styles)
-        draw_center_with_y(img, 300, texts2, bolds2, self.styles)
-        hours = sorted(stat.keys())
-        commits = [stat[hour] for hour in hours]
-        plt.figure(1, figsize=(5, 3.5))
-        plt.bar(hours, commits, width=0.6, color=colors[2], edgecolor='black')
-        plt.title('Commit times by hour')
-        plt.xticks(hours)
-        plt.yticks(range(0, max(commits) + 10, 10))
-        fig_path = self.save_fig('commit_bar', 'png')
-        commit_bar = Image.open(fig_path)
-        img.paste(commit_bar, (100, 400))
-        self.save_img(img, '8_commit_distribution', 'png')
+        self.render(paint_commit_distribution, '8_commit_distribution', stat)
 
     def draw_summary(self):
-        img = Image.new('RGBA', default_size, 'white')
-        self.add_header(img)
-        self.add_footer(img)
         summary = self.repos.get_commit_summary()
-        texts1 = [
-            '{0} 年你的码力(编码战斗力)为 '.format(self.ctx.year),
-            str(summary.coding_power),
-        ]
-        bolds1 = [1]
-        texts2 = [
-            '击败了全球 ',
-            '99%',
-            ' 的程序员'
-        ]
-        bolds2 = [1]
-        texts3 = [
-            '{0}，请继续加油'.format(self.ctx.year + 1),
-        ]
-        draw_center_with_y(img, 240, texts1, bolds1, self.styles)
-        draw_center_with_y(img, 300, texts2, bolds2, self.styles)
-        draw_center_with_y(img, 600, texts3, [], self.styles1)
-        self.save_img(img, '9_summary', 'png')
-
-    def get_commit_img(self, commit):
-        img = Image.new('RGBA', (600, 300), 'black')
-        date = util.timestamp_to_datetime(commit.timestamp)
-        line1 = 'commit ' + util.encrypt_string(commit.id, self.ctx.encrypt)
-        line2 = 'Author: ' + commit.author + ' <' + commit.email + '>'
-        line3 = 'Date:  ' + date.strftime('%a %b %d %H:%M:%S %Y %z')
-        line4 = '    ' + util.encrypt_string(commit.subject, self.ctx.encrypt)
-        draw = ImageDraw.Draw(img)
-        draw.text((10, 10), line1, fill='yellow', font=font_normal_20)
-        draw.text((10, 40), line2, fill='white', font=font_normal_20)
-        draw.text((10, 70), line3, fill='white', font=font_normal_20)
-        draw.text((10, 120), line4, fill='white', font=font_normal_20)
-        return img
-
-    def add_header(self, img: Image):
-        text = '{name} 的 {year} 年度编程报告'.format(name=self.ctx.name, year=self.ctx.year)
-        draw = ImageDraw.Draw(img)
-        text_w, text_h = draw.textsize(text, font=font_regular_32)
-        pos_x, pos_y = (img.size[0] - text_w) // 2, 20
-        draw.text((pos_x, pos_y), text, fill='black', font=font_regular_32)
-
-    @staticmethod
-    def add_footer(img: Image):
-        text = const.REPO_URL
-        draw = ImageDraw.Draw(img)
-        text_w, text_h = draw.textsize(text, font_normal_18)
-        pos_x, pos_y = default_size[0] - text_w - 20, default_size[1] - text_h - 20
-        draw.text((pos_x, pos_y), text, fill='black', font=font_normal_18)
-
-    def save_img(self, img: Image, name, fmt: str) -> str:
-        full_name = name + '.' + fmt.lower()
-        img_path = os.path.join(self.output_dir, full_name)
+        self.render(paint_summary, '9_summary', summary)
+
+    def draw_trend(self):
+        trend = self.repos.get_trend()
+        if not trend:
+            return
+        if not any(stat.commits for stat in trend.values()):
+            print('Fail to generate trend!')
+            return
+        self.render(paint_trend, '10_trend', trend)
+
+    def render(self, painter: Callable, name: str, data: Any):
+        """ Render a page now, or queue it for render_jobs if pages are rendered in parallel. """
+        if self.render_workers > 1:
+            self.jobs.append((painter, name, data))
+        else:
+            render_page(self.page, painter, name, data)
+
+    def render_jobs(self):
+        """ Render queued pages in a process pool, each worker paints and encodes whole pages. """
+        jobs, self.jobs = self.jobs, []
+        if not jobs:
+            return
+        # Set up matplotlib before forking, so workers don't import it again one by one
+        new_figure()
+        with ProcessPoolExecutor(max_workers=min(self.render_workers, len(jobs))) as executor:
+            futures = [executor.submit(profiler.call_traced, profiler.enabled, render_page,
+                                       self.page, *job) for job in jobs]
+            for future in futures:
+                _, events = future.result()
+                profiler.add_events(events)
+
+
+def render_page(page: util.DotDict, painter: Callable, name: str, data: Any) -> str:
+    with profiler.span('paint', 'page', page=name):
+        img = get_page_template(get_title(page)).copy()
+        painter(page, img, data)
+    return save_img(img, page.output_dir, name, 'png')
+
+
+def paint_cover(page: util.DotDict, img: Image, weights: Dict[int, int]):
+    levels = [colors[level] for level in sorted(colors)]
+    first_day, days = util.get_range_days(page.since, page.until)
+    calendar_graph = heatmap.render_calendar(weights, first_day, days, levels,
+                                             conf.calendar_layout, conf.calendar_thresholds)
+    pos_x, pos_y = (img.size[0] - calendar_graph.size[0]) // 2, 240
+    img.paste(calendar_graph, (pos_x, pos_y))
+    texts1 = ['你的编程秘密隐藏在上面这张日历图里']
+    texts2 = ['答案即将揭晓']
+    draw_center_with_y(img, 880, texts1, [], styles1)
+    draw_center_with_y(img, 950, texts2, [], styles1)
+
+
+def paint_short_summary(page: util.DotDict, img: Image, summary: util.DotDict):
+    texts1 = ['{0}你一共参与了 '.format(page.period), str(summary.projects), ' 个项目']
+    bolds1 = [1]
+    texts2 = ['提交更新 ', str(summary.commits), ' 次']
+    bolds2 = [1]
+    texts3 = ['修改代码 ', str(summary.insert + summary.delete), ' 行']
+    bolds3 = [1]
+    texts4 = ['看到这些数字，你是否充满了成就感呢']
+    draw_center_with_y(img, 200, texts1, bolds1, styles)
+    draw_center_with_y(img, 260, texts2, bolds2, styles)
+    draw_center_with_y(img, 320, texts3, bolds3, styles)
+    draw_center_with_y(img, 600, texts4, [], styles1)
+
+
+def paint_most_common_repo(page: util.DotDict, img: Image, summary: util.DotDict):
+    texts1 = [
+        '{0}你最常去的地方是 '.format(page.period),
+        summary.name,
+    ]
+    bolds1 = [1]
+    texts2 = [
+        '你在这个项目上进行了 ',
+        str(summary.commits),
+        ' 次提交，',
+        str(summary.merges),
+        ' 次合并']
+    bolds2 = [1, 3]
+    texts3 = [
+        '共计修改了 ',
+        str(summary.insert + summary.delete),
+        ' 行代码'
+    ]
+    bolds3 = [1]
+    texts4 = ['在这里，你挥洒了最多的汗水']
+    texts5 = ['和泪水']
+    draw_center_with_y(img, 240, texts1, bolds1, styles)
+    draw_center_with_y(img, 300, texts2, bolds2, styles)
+    draw_center_with_y(img, 360, texts3, bolds3, styles)
+    draw_center_with_y(img, 600, texts4, [], styles1)
+    draw_center_with_y(img, 670, texts5, [], styles1)
+
+
+def paint_language_stat(page: util.DotDict, img: Image, lang_stat: Dict[str, Dict[str, int]]):
+    favor = max(lang_stat.keys(), key=lambda x: lang_stat[x]['weight'])
+    texts1 = [
+        '{0}你最常用的编程语言是 '.format(page.period),
+        favor,
+    ]
+    bolds1 = [1]
+    texts2 = [
+        '这一年你一共使用 ' if page.yearly else '这段时间你一共使用 ',
+        favor,
+        ' 提交代码 ',
+        str(lang_stat[favor]['commits']),
+        ' 次',
+    ]
+    bolds2 = [1, 3]
+    texts3 = [
+        '增加代码 ',
+        str(lang_stat[favor]['insert']),
+        ' 行，删减代码 ',
+        str(lang_stat[favor]['delete']),
+        ' 行'
+    ]
+    bolds3 = [1, 3]
+    draw_center_with_y(img, 180, texts1, bolds1, styles)
+    draw_center_with_y(img, 240, texts2, bolds2, styles)
+    draw_center_with_y(img, 300, texts3, bolds3, styles)
+
+    fig = new_figure()
+    labels = list(lang_stat.keys())
+    weights = [lang_stat[key]['weight'] for key in labels]
+    percents = util.get_percents(weights)
+    weighted = [(labels[i], percents[i]) for i in range(len(labels))]
+    res = []
+    other_percent = 0
+    for item in weighted:
+        if item[1] > 2:
+            res.append(item)
+        else:
+            other_percent += item[1]
+    if other_percent > 0:
+        other_percent += 0.001
+        res.append(('other', other_percent))
+    labels, weights = [item[0] for item in res], [item[1] for item in res]
+    ax = fig.gca()
+    ax.pie(weights, labels=labels, autopct='%1.1f%%', startangle=90)
+    ax.set_title('Programming languages by weight')
+    language_pie = figure_to_image(fig, page, 'language_pie')
+    img.paste(language_pie, (100, 360))
+    language_cnt = len(list(p for p in percents if p > 5))
+    if language_cnt == 1:
+        text = '看来你是一个专一的程序员'
+    else:
+        text = '哪种语言是你的最爱呢'
+    texts4 = [
+        text
+    ]
+    draw_center_with_y(img, 840, texts4, [], styles1)
+
+
+def paint_merge_stat(page: util.DotDict, img: Image, data: Dict[str, Any]):
+    user_name, merges = data['user_name'], data['merges']
+    edges = []
+    for name, stat in merges.items():
+        edges.append([user_name, name, stat.get('merge', 0) + stat.get('merged_by', 0)])
+    edges.sort(key=lambda x: x[-1], reverse=True)
+    best_partner = edges[0][1]
+    most_merge = merges[best_partner].get('merge', 0) + merges[best_partner].get('merged_by', 0)
+    texts1 = [
+        '{0}与你合作最多的小伙伴是 '.format(page.period),
+        merges[best_partner]['readable_name'],
+    ]
+    bolds1 = [1]
+    texts2 = [
+        '你们互相 review 代码高达 ',
+        str(most_merge),
+        ' 次'
+    ]
+    bolds2 = [1]
+    draw_center_with_y(img, 180, texts1, bolds1, styles)
+    draw_center_with_y(img, 240, texts2, bolds2, styles)
+
+    # Edge widths follow the order of edges, heaviest first
+    weights = util.rescale_to_interval([edge[-1] for edge in edges], 0.5, 5)
+    for i, edge in enumerate(edges):
+        edge[-1] = weights[i]
+    if conf.merge_graph_layout == 'radial':
+        merge_graph = draw_radial_graph(page, user_name, [edge[1] for edge in edges], weights)
+    else:
+        merge_graph = draw_spring_graph(page, edges, weights)
+    img.paste(merge_graph, (100, 360))
+    texts3 = [
+        '过去一年与你有过交集的那些人' if page.yearly else '这段时间与你有过交集的那些人'
+    ]
+    texts4 = [
+        '他们现在在哪里呢'
+    ]
+    draw_center_with_y(img, 900, texts3, [], styles1)
+    draw_center_with_y(img, 970, texts4, [], styles1)
+
+
+def draw_spring_graph(page: util.DotDict, edges: List[List[Any]], weights: List[float]) -> Image:
+    """ Draw the graph by networkx with a force-directed layout. """
+    # networkx is slow to import and only this page needs it
+    import networkx as nx
+    graph = nx.Graph()
+    graph.add_weighted_edges_from(edges)
+    fig = new_figure()
+    ax = fig.add_axes((0, 0, 1, 1))
+    # Seed the layout, a page must look the same whichever process renders it
+    pos = nx.spring_layout(graph, seed=0)
+    nx.draw(graph, pos, ax=ax, with_labels=True, width=weights, node_size=1000,
+            node_color=colors[1], edge_color=colors[2], font_size=10)
+    return figure_to_image(fig, page, 'merge_relations')
+
+
+def draw_radial_graph(page: util.DotDict, center: str, partners: List[str],
+                      weights: List[float]) -> Image:
+    """
+    Draw the user in the center and partners on rings around, heaviest partners on inner rings.
+    Nodes and fonts get smaller when there are more rings, so the graph fits in the figure.
+    """
+    from matplotlib.collections import LineCollection
+    positions = get_radial_layout(len(partners))
+    rings = get_ring_count(len(partners))
+    limit = rings + 0.6
+    # Partners of a ring are 2 * pi / 8 apart in ring units, whatever the ring is
+    spacing = 2 * math.pi / ring_size * min(figure_size) / 2 / limit * 72
+    node_size = min(1000, (spacing * 0.7) ** 2)
+    font_size = min(10, max(5, spacing * 0.7 / 4))
+    fig = new_figure()
+    ax = fig.add_axes((0, 0, 1, 1))
+    ax.set_axis_off()
+    ax.set_xlim(-limit, limit)
+    ax.set_ylim(-limit, limit)
+    segments = [[(0, 0), (x, y)] for x, y in positions]
+    ax.add_collection(LineCollection(segments, linewidths=weights, colors=colors[2], zorder=1))
+    ax.scatter([0] + list(positions[:, 0]), [0] + list(positions[:, 1]), s=node_size,
+               c=colors[1], zorder=2)
+    for name, (x, y) in zip([center] + partners, [(0, 0)] + positions.tolist()):
+        ax.text(x, y, name, ha='center', va='center', fontsize=font_size, zorder=3)
+    return figure_to_image(fig, page, 'merge_relations')
+
+
+def get_ring_count(count: int) -> int:
+    """ Rings holding count partners, ring k holds 8 * k partners. """
+    rings = 0
+    while count > 0:
+        rings += 1
+        count -= ring_size * rings
+    return rings
+
+
+@functools.lru_cache(maxsize=None)
+def get_radial_layout(count: int) -> np.ndarray:
+    """
+    Positions of count partners, ring k of radius k holds 8 * k partners evenly spaced from the
+    top, and the outermost ring spreads its partners over the whole circle. Odd rings are turned
+    by half a step, so partners of adjacent rings don't line up.
+    """
+    positions = np.zeros((count, 2))
+    start = 0
+    for ring in range(1, get_ring_count(count) + 1):
+        size = min(ring_size * ring, count - start)
+        angles = math.pi / 2 + (np.arange(size) + 0.5 * (ring % 2)) * 2 * math.pi / size
+        positions[start:start + size, 0] = ring * np.cos(angles)
+        positions[start:start + size, 1] = ring * np.sin(angles)
+        start += size
+    positions.flags.writeable = False
+    return positions
+
+
+def paint_busiest_day(page: util.DotDict, img: Image, stat: Dict[str, Any]):
+    date = stat['date']
+    texts1 = [
+        str(date.month),
+        ' 月 ',
+        str(date.day),
+        ' 日是你过去一年写代码最多的一天' if page.yearly else ' 日是你这段时间写代码最多的一天'
+    ]
+    bolds1 = [0, 2]
+    if is_multi_year(page):
+        texts1, bolds1 = [str(date.year), ' 年 '] + texts1, [0, 2, 4]
+    texts2 = [
+        '这一天你一共提交了 ',
+        str(stat['commits']),
+        ' 次更新'
+    ]
+    bolds2 = [1]
+    texts3 = [
+        '增加代码 ',
+        str(stat['insert']),
+        ' 行，删减代码 ',
+        str(stat['delete']),
+        ' 行'
+    ]
+    bolds3 = [1, 3]
+    texts4 = [
+        '同时，这也是你被 PM 打断次数最少的一天'
+    ]
+    draw_center_with_y(img, 240, texts1, bolds1, styles)
+    draw_center_with_y(img, 300, texts2, bolds2, styles)
+    draw_center_with_y(img, 360, texts3, bolds3, styles)
+    draw_center_with_y(img, 600, texts4, [], styles1)
+
+
+def paint_latest_commit(page: util.DotDict, img: Image, commit: util.DotDict):
+    date = util.timestamp_to_datetime(commit.timestamp)
+    texts1 = [
+        '还记得 ',
+        str(date.month),
+        ' 月 ',
+        str(date.day),
+        ' 日这天吗'
+    ]
+    bolds1 = [1, 3]
+    if is_multi_year(page):
+        texts1, bolds1 = texts1[:1] + [str(date.year), ' 年 '] + texts1[1:], [1, 3, 5]
+    texts2 = [
+        '在这一天的 ',
+        str(date.hour),
+        ' 时 ',
+        str(date.minute),
+        ' 分，你执行了去年最晚的一次提交' if page.yearly else ' 分，你执行了这段时间最晚的一次提交'
+    ]
+    bolds2 = [1, 3]
+    draw_center_with_y(img, 240, texts1, bolds1, styles)
+    draw_center_with_y(img, 300, texts2, bolds2, styles)
+    commit_img = get_commit_img(commit, page.encrypt)
+    img.paste(commit_img, (60, 400))
+    texts3 = [
+        '再忙，也要照顾好自己'
+    ]
+    draw_center_with_y(img, 800, texts3, [], styles1)
+
+
+def paint_commit_distribution(page: util.DotDict, img: Image, stat: Dict[int, int]):
+    most_hour = max(stat.keys(), key=lambda x: stat[x])
+    most_percent = max(util.get_percents(list(stat.values()), digits=1))
+    texts1 = [
+        '你提交代码最多的时间段是 ',
+        '{0}:00 - {1}:00'.format(most_hour, most_hour + 1),
+    ]
+    bolds1 = [1]
+    texts2 = [
+        '你在这个时间段提交代码的次数占总数的 ',
+        str(most_percent) + '%',
+    ]
+    bolds2 = [1]
+    draw_center_with_y(img, 240, texts1, bolds1, styles)
+    draw_center_with_y(img, 300, texts2, bolds2, styles)
+    hours = sorted(stat.keys())
+    commits = [stat[hour] for hour in hours]
+    fig = new_figure()
+    ax = fig.gca()
+    ax.bar(hours, commits, width=0.6, color=colors[2], edgecolor='black')
+    ax.set_title('Commit times by hour')
+    ax.set_xticks(hours)
+    ax.set_yticks(range(0, max(commits) + 10, 10))
+    commit_bar = figure_to_image(fig, page, 'commit_bar')
+    img.paste(commit_bar, (100, 400))
+
+
+def paint_summary(page: util.DotDict, img: Image, summary: util.DotDict):
+    texts1 = [
+        '{0}你的码力(编码战斗力)为 '.format(page.period),
+        str(summary.coding_power),
+    ]
+    bolds1 = [1]
+    texts2 = [
+        '击败了全球 ',
+        '99%',
+        ' 的程序员'
+    ]
+    bolds2 = [1]
+    texts3 = [
+        '{0}，请继续加油'.format(get_next_period_name(page)),
+    ]
+    draw_center_with_y(img, 240, texts1, bolds1, styles)
+    draw_center_with_y(img, 300, texts2, bolds2, styles)
+    draw_center_with_y(img, 600, texts3, [], styles1)
+
+
+def paint_trend(page: util.DotDict, img: Image, trend: Dict[int, util.DotDict]):
+    years = sorted(trend)
+    best_year = max(years, key=lambda x: trend[x].coding_power)
+    best = trend[best_year]
+    texts1 = [
+        '近 {0} 年你一共提交更新 '.format(len(years)),
+        str(sum(trend[year].commits for year in years)),
+        ' 次'
+    ]
+    bolds1 = [1]
+    texts2 = [
+        str(best_year),
+        ' 年是你码力最高的一年'
+    ]
+    bolds2 = [0]
+    texts3 = [
+        '这一年你活跃了 ',
+        str(best.days),
+        ' 天，修改代码 ',
+        str(best.insert + best.delete),
+        ' 行'
+    ]
+    bolds3 = [1, 3]
+    draw_center_with_y(img, 180, texts1, bolds1, styles)
+    draw_center_with_y(img, 240, texts2, bolds2, styles)
+    draw_center_with_y(img, 300, texts3, bolds3, styles)
+    commits = [trend[year].commits for year in years]
+    fig = new_figure()
+    ax = fig.gca()
+    ax.bar(years, commits, width=0.6, color=colors[2], edgecolor='black')
+    ax.set_title('Commits by year')
+    ax.set_xticks(years)
+    trend_bar = figure_to_image(fig, page, 'trend_bar')
+    img.paste(trend_bar, (100, 400))
+    texts4 = [
+        '一路走来，每一行代码都算数'
+    ]
+    draw_center_with_y(img, 940, texts4, [], styles1)
+
+
+def is_multi_year(page: util.DotDict) -> bool:
+    """ Whether the time range touches several years, dates of the report show years then. """
+    first, last = [util.timestamp_to_datetime(x) for x in (page.since, page.until - 1)]
+    return first.year != last.year
+
+
+def get_next_period_name(page: util.DotDict) -> str:
+    if page.yearly:
+        return str(util.timestamp_to_datetime(page.until).year)
+    return util.get_period_name(*util.get_next_period(page.since, page.until))
+
+
+def get_title(page: util.DotDict) -> str:
+    if page.yearly:
+        year = util.timestamp_to_datetime(page.since).year
+        return '{name} 的 {year} 年度编程报告'.format(name=page.name, year=year)
+    return '{name} 的 {period}编程报告'.format(name=page.name, period=page.period)
+
+
+def get_commit_img(commit: util.DotDict, encrypt: bool) -> Image:
+    img = Image.new('RGBA', (600, 300), 'black')
+    date = util.timestamp_to_datetime(commit.timestamp)
+    line1 = 'commit ' + util.encrypt_string(commit.id, encrypt)
+    line2 = 'Author: ' + commit.author + ' <' + commit.email + '>'
+    line3 = 'Date:  ' + date.strftime('%a %b %d %H:%M:%S %Y %z')
+    line4 = '    ' + util.encrypt_string(commit.subject, encrypt)
+    fonts.draw_text(img, (10, 10), line1, 'yellow', 'normal', 20)
+    fonts.draw_text(img, (10, 40), line2, 'white', 'normal', 20)
+    fonts.draw_text(img, (10, 70), line3, 'white', 'normal', 20)
+    fonts.draw_text(img, (10, 120), line4, 'white', 'normal', 20)
+    return img
+
+
+def add_header(img: Image, title: str):
+    shaped = fonts.shape_text(title, 'regular', 32)
+    pos_x, pos_y = (img.size[0] - shaped.width) // 2, 20
+    fonts.draw_shaped(img, (pos_x, pos_y), shaped, 'black')
+
+
+def add_footer(img: Image):
+    text = const.REPO_URL
+    shaped = fonts.shape_text(text, 'normal', 18)
+    pos_x, pos_y = default_size[0] - shaped.width - 20, default_size[1] - shaped.height - 20
+    fonts.draw_shaped(img, (pos_x, pos_y), shaped, 'black')
+
+
+def save_img(img: Image, output_dir: str, name: str, fmt: str) -> str:
+    full_name = name + '.' + fmt.lower()
+    img_path = os.path.join(output_dir, full_name)
+    with profiler.span('encode ' + fmt.lower(), 'page', image=full_name):
         img.save(img_path, fmt.upper())
-        return img_path
-
-    def save_fig(self, name, fmt: str) -> str:
-        full_name = name + '.' + fmt.lower()
-        fig_path = os.path.join(self.output_dir, full_name)
-        plt.savefig(fig_path, fmt=fmt)
-        plt.clf()
-        return fig_path
-
-    def get_background(self, img_name: str, transparency: float) -> Image:
-        img_path = os.path.join(self.ctx.run_dir, 'static/images', img_name)
-        img = Image.open(img_path)
-        img_w, img_h = img.size
-        # Cut and resize to default size
-        cut_h = default_size[1] if img_h > default_size[1] else img_h
-        cut_w = cut_h * default_size[0] // default_size[1]
-        left, upper = (img_w - cut_w) // 2, (img_h - cut_h) // 2
-        right, lower = left + cut_w, upper + cut_h
-        img = img.crop((left, upper, right, lower))
-        img = img.resize(default_size, resample=Image.ANTIALIAS)
-        # Add transparency
-        img = img.convert('RGBA')
-        img_blender = Image.new('RGBA', img.size, (0, 0, 0, 0))
-        img = Image.blend(img_blender, img, transparency)
-        return img
-
-    def get_calendar_graph(self) -> Image:
-        commits = self.repos.get_commit_weight_by_day()
-        days = list(range(1, const.MAX_YEAR_DAY))
-        if calendar.isleap(self.ctx.year):
-            days.append(const.MAX_YEAR_DAY)
-        col_size = 19
-        row_size = const.MAX_YEAR_DAY // col_size + 1
-        rect_size = 26
-        gap_size = 4
-        img_width = col_size * (rect_size + gap_size) - gap_size
-        img_height = row_size * (rect_size + gap_size) - gap_size
-        img = Image.new('RGBA', (img_width, img_height), 'white')
-        draw = ImageDraw.Draw(img)
-        for i, day in enumerate(days):
-            row, col = i // col_size, i % col_size
-            left, upper = col * (rect_size + gap_size), row * (rect_size + gap_size)
-            right, lower = left + rect_size, upper + rect_size
-            commit_level = get_commit_level(commits.get(day, 0))
-            color = colors[commit_level]
-            draw.rectangle([left, lower, right, upper], fill=color, outline=color)
-        return img
+    return img_path
+
+
+def new_figure() -> Any:
+    """ A figure drawn by its own Agg canvas, pyplot and its global figures aren't involved. """
+    fonts.setup_matplotlib()
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=figure_size)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def figure_to_image(fig: Any, page: util.DotDict, name: str) -> Image:
+    """
+    Rasterize the figure to an image sharing the RGBA buffer of the canvas. The chart is saved
+    to the output directory as well if conf.save_charts is set.
+    """
+    with profiler.span('matplotlib', 'page', chart=name):
+        fig.canvas.draw()
+    size = fig.canvas.get_width_height()
+    img = Image.frombuffer('RGBA', size, fig.canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1)
+    if conf.save_charts:
+        save_img(img, page.output_dir, name, 'png')
+    return img
+
+
+@functools.lru_cache(maxsize=16)
+def get_page_template(title: str) -> Image:
+    """ A blank page with header and footer, pages are copies of it. Don't draw on it directly. """
+    img = Image.new('RGBA', default_size, 'white')
+    add_header(img, title)
+    add_footer(img)
+    return img
+
+
+@functools.lru_cache(maxsize=16)
+def get_background(run_dir: str, img_name: str, transparency: float) -> Image:
+    """ The background image cut to page size, it's shared so copy it before drawing. """
+    img_path = os.path.join(run_dir, 'static/images', img_name)
+    img = Image.open(img_path)
+    img_w, img_h = img.size
+    # Cut and resize to default size
+    cut_h = default_size[1] if img_h > default_size[1] else img_h
+    cut_w = cut_h * default_size[0] // default_size[1]
+    left, upper = (img_w - cut_w) // 2, (img_h - cut_h) // 2
+    right, lower = left + cut_w, upper + cut_h
+    img = img.crop((left, upper, right, lower))
+    img = img.resize(default_size, resample=Image.LANCZOS)
+    # Add transparency
+    img = img.convert('RGBA')
+    img_blender = Image.new('RGBA', img.size, (0, 0, 0, 0))
+    img = Image.blend(img_blender, img, transparency)
+    return img
+
+
+def layout_with_bold(texts: List[str], bolds: List[int], styles: Tuple[TextStyle, TextStyle]) \
+        -> Tuple[List[fonts.ShapedText], int]:
+    segments = []
+    for i, text in enumerate(texts):
+        style = styles[1] if i in bolds else styles[0]
+        segments.append((text, style.font_weight, style.font_size))
+    return fonts.layout_line(segments)
 
 
 def draw_with_bold(img: Image, pos: Tuple[int, int], texts: List[str], bolds: List[int],
-                   styles: Tuple[TextStyle, TextStyle]):
-    draw = ImageDraw.Draw(img)
-    _, normal_h = draw.textsize(texts[0], styles[0].font)
-    _, bold_h = draw.textsize(texts[0], styles[1].font)
+                   styles: Tuple[TextStyle, TextStyle], shaped: List[fonts.ShapedText] = None):
+    if shaped is None:
+        shaped, _ = layout_with_bold(texts, bolds, styles)
+    normal_h = fonts.shape_text(texts[0], styles[0].font_weight, styles[0].font_size).height
+    bold_h = fonts.shape_text(texts[0], styles[1].font_weight, styles[1].font_size).height
     pos_x, pos_y = pos
     bold_y = pos_y
     if bold_h > normal_h:
         bold_y = pos_y - (bold_h - normal_h) // 2 - 1
-    for i, text in enumerate(texts):
+    for i, text in enumerate(shaped):
         if i in bolds:
-            draw.text((pos_x, bold_y), text, styles[1].color, styles[1].font)
-            pos_x += draw.textsize(text, styles[1].font)[0]
+            fonts.draw_shaped(img, (pos_x, bold_y), text, styles[1].color)
         else:
-            draw.text((pos_x, pos_y), text, styles[0].color, styles[0].font)
-            pos_x += draw.textsize(text, styles[0].font)[0]
+            fonts.draw_shaped(img, (pos_x, pos_y), text, styles[0].color)
+        pos_x += text.width
 
 
 def draw_center_with_y(img: Image, pos_y: int, texts: List[str], bolds: List[int],
                        styles: Tuple[TextStyle, TextStyle]):
-    draw = ImageDraw.Draw(img)
-    total_w = 0
-    for i, text in enumerate(texts):
-        if i in bolds:
-            total_w += draw.textsize(text, styles[1].font)[0]
-        else:
-            total_w += draw.textsize(text, styles[0].font)[0]
+    shaped, total_w = layout_with_bold(texts, bolds, styles)
     pos_x = (img.size[0] - total_w) // 2
-    draw_with_bold(img, (pos_x, pos_y), texts, bolds, styles)
-
-
-def get_commit_level(weight: int) -> int:
-    if weight <= 0:
-        return 0
-    elif 0 < weight < 48:
-        return 1
-    elif 48 <= weight < 128:
-        return 2
-    elif 128 <= weight < 512:
-        return 3
-    else:
-        return 4
+    draw_with_bold(img, (pos_x, pos_y), texts, bolds, styles, shaped)
@@ -1,17 +1,25 @@
 # coding: utf8
-import json
+import copy
 import os
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Any, Tuple, Set
+from itertools import chain
+from typing import List, Dict, Any, Tuple, Set, Iterator, Iterable
 
+import backend
+import clone
 import conf
 import const
+import stats
 import util
-
-git_clone_tmpl = 'git clone {git_url}'
-git_log_tmpl = 'git log {branch} --since="{begin}" --until="{end}"  --format="{fmt}" --numstat'
-git_show_tmpl = 'git show {commit_id} --format="{fmt}"'
+import linguist
+import profiler
+from cache import CommitCache, LinguistCache, RollupCache
+from classifier import PathClassifier
+from identity import IdentityIndex
+from stats import weight_commits
+from store import Commit, CommitStore, CommitSelection
 
 # If the commit stat exceeds limits in one commit, this commit will be considered as auto-generated
 # change and be replaced with average commit stat.
@@ -28,179 +36,294 @@ common_insertions = 256
 common_deletions = 256
 
 
-class Commit:
-    def __init__(self, repo_dir, commit_id: str, parent_ids: List[str], author, email: str,
-                 timestamp: int):
-        self.repo_dir = repo_dir
-        self.id = commit_id
-        self.parents = parent_ids
-        self.author = author
-        self.email = email
-        self.timestamp = timestamp
-        self.subject = ''
-        self.num_stat = []
-        self.code_ins = 0
-        self.code_del = 0
-        self.code_files = 0
-        self.lang_stat = {}
-
-
 class Repo:
-    def __init__(self, git_url_or_path: str, ctx: util.DotDict):
+    def __init__(self, git_url_or_path: str, ctx: util.DotDict, identities: IdentityIndex = None):
         if os.path.isdir(git_url_or_path):  # git repository path
             repo_dir = git_url_or_path
+            self.source = os.path.realpath(repo_dir)
             if not util.is_git_dir(repo_dir):
                 print('Error: {0} is not a git repository!'.format(repo_dir))
                 raise ValueError('Invalid git path!')
             repo_name = os.path.basename(repo_dir)
         else:  # git remote url
-            repo_parent_dir = os.path.join(ctx.run_dir, 'user_repos')
-            if not os.path.exists(repo_parent_dir):
-                os.mkdir(repo_parent_dir)
-            os.chdir(repo_parent_dir)
-            repo_name = git_url_or_path.rsplit('/', 1)[-1].split('.')[0]
-            repo_dir = os.path.join(repo_parent_dir, repo_name)
-            # clone repository if not exists
-            if not os.path.isdir(repo_dir):
-                try:
-                    util.run(git_clone_tmpl.format(git_url=git_url_or_path), stdout=None)
-                    print('Clone {0} succeed!'.format(git_url_or_path))
-                except Exception as e:
-                    print('Error: fail to clone {0}, reason: {1}'.format(git_url_or_path, e))
-                    raise e
+            self.source = git_url_or_path
+            repo_dir = clone.sync(ctx, git_url_or_path)
+            repo_name = os.path.basename(repo_dir)
         self.directory = repo_dir
         self.name = util.encrypt_string(repo_name, ctx.encrypt)
-        self.git_url = util.run(const.GIT_REMOTE_URL_CMD, check=False)
         self.ctx = ctx
+        self.backend = backend.get_backend(ctx, repo_dir)
+        self.git_url = self.backend.get_remote_url()
+        self.identity = (identities or IdentityIndex.from_ctx(ctx)).for_repo(repo_dir)
+        # The person whose report is generated, commits of each known person are in member_commits
+        self.person = ctx.name
         self.language = ''
         self.linguist_enabled = False
         self.linguist_res = {}
-        self.commit_list = []
+        self.commit_list = CommitStore()
+        # Commits of the repo, commits of earlier repos are left out, see drop_duplicates()
+        self.commits = CommitSelection(self.commit_list)
+        self.member_commits = {}
+        self.user_commits = CommitSelection(self.commit_list)
+        # Commits out of the time range, looked up by id when needed
         self.commit_dict = {}
-        self.user_commits = []
-        self.analyze_by_linguist()
-        self.parse_git_commits()
+        self.old_commits = CommitStore()
+        self.memo = {}
+        with profiler.span('analyze by linguist', 'repo', repo=repo_name):
+            self.analyze_by_linguist()
+        self.classifier = self.get_path_classifier()
+        with profiler.span('parse commits', 'repo', repo=repo_name):
+            self.parse_git_commits()
+        # Monthly rollups of the trend, shared by views of members like parsed commits
+        with profiler.span('load rollups', 'repo', repo=repo_name):
+            self.rollups = self.load_rollups()
         self.get_repo_language()
         print('{0} loaded successfully!'.format(repo_name))
 
     def parse_git_commits(self):
         """ Parse commits in the given time range. """
-        os.chdir(self.directory)
-        # Use master branch if it exists
-        branches = util.run(const.GIT_BRANCH_CMD).split('\n')
-        branch = ''
-        for line in branches:
-            if line.strip() == 'master':
-                branch = 'master'
-                break
-        begin, end = util.get_year_ends(self.ctx.year)
-        git_log_cmd = git_log_tmpl.format(branch=branch, begin=begin, end=end,
-                                          fmt=const.GIT_LOG_FORMAT)
-        git_log = util.run(git_log_cmd)
-        commit_logs = git_log.split(const.GIT_COMMIT_SEPARATOR)
-        for commit_log in commit_logs:
-            if not commit_log:
-                continue
-            commit = self.parse_git_log(commit_log)
-            if not commit:
+        tips = self.get_tips()
+        commit_cache = CommitCache(self.ctx, self.source)
+        cached = commit_cache.load()
+        cached_tips = cached.get('tips', [])
+        new_commits = []
+        if tips and tips != cached_tips:
+            revs = tips
+            if cached_tips and self.is_reachable(cached_tips, tips):
+                # Only commits reachable from the new tips but not the cached ones
+                revs = tips + ['^' + tip for tip in cached_tips]
+            else:  # No cache or history has been rewritten, rebuild it
+                cached = {}
+            since, until = util.get_time_range(self.ctx)
+            # The time range doesn't include its end, but backends do
+            new_commits = self.parse_records(self.backend.iter_log(revs, since, until - 1),
+                                             self.commit_list)
+        cached_commits = (self.commit_list.append_record(record)
+                          for record in cached.get('commits', []))
+        self.group_commits(chain(new_commits, cached_commits))
+        if tips and tips != cached_tips:
+            commit_cache.save(tips, [commit.to_record() for commit in self.commit_list])
+
+    def load_rollups(self) -> Dict[str, Any]:
+        """
+        Monthly rollups of commits in the years of the trend, see add_rollups(). Only commits
+        added since the cached rollups and months out of them are read from the history.
+        """
+        years = get_trend_years(self.ctx)
+        tips = self.get_tips() if years else []
+        if not tips:
+            return {}
+        begin, end = util.get_year_ends(years[0])[0], util.get_year_ends(years[-1])[1]
+        rollup_cache = RollupCache(self.ctx, self.source)
+        cached = rollup_cache.load()
+        cached_tips = cached.get('tips', [])
+        if cached_tips and (cached_tips == tips or self.is_reachable(cached_tips, tips)):
+            since, until, months = cached['since'], cached['until'], cached['months']
+            walks = []
+            if tips != cached_tips:
+                walks.append((tips + ['^' + tip for tip in cached_tips], since, until))
+            if begin < since:
+                walks.append((tips, begin, since))
+            if end > until:
+                walks.append((tips, until, end))
+            since, until = min(since, begin), max(until, end)
+        else:  # No cache or history has been rewritten, rebuild it
+            since, until, months = begin, end, {}
+            walks = [(tips, begin, end)]
+        store = CommitStore()
+        for revs, walk_since, walk_until in walks:
+            records = self.backend.iter_log(revs, walk_since, walk_until - 1)
+            add_rollups(months, self.parse_records(records, store))
+        if walks:
+            rollup_cache.save(tips, since, until, months)
+        return months
+
+    def get_tips(self) -> List[str]:
+        """
+        Sorted ids of the commits that branches to scan point to. By default master is scanned if
+        it exists, otherwise HEAD. See conf.branches for other branches.
+        """
+        return self.backend.get_tips(self.ctx.branches or conf.branches)
+
+    def group_commits(self, commits: Iterable[Commit]):
+        """ Group commits by person, commits of unknown people are only kept in self.commits. """
+        self.commits = CommitSelection(self.commit_list)
+        self.member_commits = {}
+        for commit in commits:
+            self.commits.append(commit)
+            person = self.identity.owner(commit.author, commit.email)
+            if person is None:
                 continue
-            self.commit_list.append(commit)
-            self.commit_dict[commit.id] = commit
-            if commit.email in self.ctx.emails:
-                self.user_commits.append(commit)
-
-    def parse_git_log(self, commit_log: str) -> Any:
-        """ Parse formatted git log"""
-        lines = commit_log.split('\n')
-        if len(lines) < 6:
-            print('Wrong git log format: ' + commit_log)
-            return
-        commit = Commit(repo_dir=self.directory, commit_id=lines[0], parent_ids=lines[1].split(' '),
-                        author=lines[2], email=lines[3], timestamp=int(lines[4]))
-        commit.subject = lines[5]
-        commit.num_stat = [line.strip() for line in lines[6:] if line.strip()]
-        self.parse_commit_stat(commit)
-        return commit
+            if person not in self.member_commits:
+                self.member_commits[person] = CommitSelection(self.commit_list)
+            self.member_commits[person].append(commit)
+        self.user_commits = self.member_commits.get(self.person,
+                                                    CommitSelection(self.commit_list))
+
+    def drop_duplicates(self, index: Set[bytes]):
+        """
+        Leave out commits which are in the index already, e.g. loaded from a fork or a mirror of
+        this repo, and add the others to the index.
+        """
+        unique = []
+        for commit in self.commits:
+            digest = self.commit_list.get_digest(commit.row)
+            if digest not in index:
+                index.add(digest)
+                unique.append(commit)
+        if len(unique) < len(self.commits):
+            self.group_commits(unique)
+            self.invalidate()
+
+    def for_member(self, person: str) -> 'Repo':
+        """ A view of the repo for one person, parsed commits are shared with the repo. """
+        view = copy.copy(self)
+        view.person = person
+        view.user_commits = self.member_commits.get(person, CommitSelection(self.commit_list))
+        view.memo = {}
+        return view
+
+    def is_user(self, commit: Commit) -> bool:
+        return self.identity.owner(commit.author, commit.email) == self.person
+
+    def is_reachable(self, commit_ids: List[str], tips: List[str]) -> bool:
+        """ Check if all commits are reachable from tips, false if any of them no longer exists. """
+        return self.backend.is_reachable(commit_ids, tips)
+
+    def parse_records(self, records: Iterable[backend.Record],
+                      store: CommitStore) -> Iterator[Commit]:
+        """ Add commits to store from records of the backend, one by one as they are read. """
+        for fields, num_stat in records:
+            yield self.parse_git_record(fields, num_stat, store)
+
+    def parse_git_record(self, fields: List[str], num_stat: List[Tuple[str, str, str]],
+                         store: CommitStore) -> Commit:
+        """ Add a commit to store from its formatted fields, numstat entries are dropped here. """
+        code_files, code_ins, code_del, lang_stat = self.parse_commit_stat(num_stat)
+        return store.append(commit_id=fields[0], parent_ids=fields[1].split(), author=fields[2],
+                            email=fields[3], timestamp=int(fields[4]), subject=fields[5],
+                            files=code_files, insertions=code_ins, deletions=code_del,
+                            lang_stat=lang_stat)
 
     def analyze_by_linguist(self):
         if not self.ctx.linguist_enabled:
             return
-        ruby_script = os.path.join(self.ctx.run_dir, 'linguist.rb')
-        linguist_cmd = 'ruby {0} {1}'.format(ruby_script, self.directory)
-        try:
-            res = util.run(linguist_cmd)
-            code_files = json.loads(res)
-        except Exception as e:
-            print(e)
-            return
+        tree = self.backend.get_head_tree()
+        linguist_cache = LinguistCache(self.ctx, self.source)
+        code_files = linguist_cache.load_result(tree)
+        if code_files is None:
+            state = linguist_cache.load_state()
+            try:
+                worker = linguist.get_worker(self.ctx.run_dir)
+                res = worker.analyze(self.directory, state.get('commit'), state.get('cache'))
+            except Exception as e:
+                print(e)
+                return
+            code_files = res['breakdown']
+            linguist_cache.save_result(tree, code_files)
+            linguist_cache.save_state(res['commit'], res['cache'])
         for lang, files in code_files.items():
             for file in files:
                 self.linguist_res[file] = lang
         self.linguist_enabled = True
 
+    def get_path_classifier(self) -> PathClassifier:
+        if not self.linguist_enabled:
+            return PathClassifier()
+        # Linguist analyzed HEAD, so its results only apply to files in the HEAD tree
+        head_files = self.backend.get_head_files()
+        return PathClassifier(self.linguist_res, set(head_files))
+
     def get_repo_language(self):
         stat = self.get_language_stat(only_user=False)
         if not stat:
             return
         self.language = max(stat.keys(), key=lambda x: stat[x]['weight'])
 
+    def invalidate(self):
+        """ Drop memoized stats, it must be called after commits of the repo change. """
+        self.memo.clear()
+
+    @util.memoize
     def get_commit_summary(self) -> util.DotDict:
-        summary = {
-            'commits': 0,
-            'merges': 0,
-            'insert': 0,
-            'delete': 0,
-        }
-        for commit in self.user_commits:
-            summary['commits'] += 1
-            if len(commit.parents) > 1:
-                summary['merges'] += 1
-            summary['insert'] += commit.code_ins
-            summary['delete'] += commit.code_del
-        return util.DotDict(summary)
+        return util.DotDict(stats.get_commit_summary(self.user_commits))
 
+    @util.memoize
     def get_language_stat(self, only_user=True) -> Dict[str, Any]:
         """ Get each used language's commit stat. """
+        return stats.get_language_stat(self.commit_list, self.user_commits if only_user else None)
+
+    @util.memoize
+    def get_yearly_stat(self) -> Dict[int, Dict[str, Any]]:
+        """ Stat of user commits of each year in the rollups, active days are kept as dates. """
         res = {}
-        for commit in self.commit_list:
-            if only_user and commit.email not in self.ctx.emails:
-                continue
-            for lang, stat in commit.lang_stat.items():
-                if lang not in res:
-                    res[lang] = {
-                        'commits': 1,
-                        'insert': stat['insert'],
-                        'delete': stat['delete'],
-                    }
-                else:
-                    res[lang]['commits'] += 1
-                    res[lang]['insert'] += stat['insert']
-                    res[lang]['delete'] += stat['delete']
-        for lang, stat in res.items():
-            weight = weight_commits(stat['commits'], stat['insert'], stat['delete'])
-            res[lang]['weight'] = weight
+        for month, emails in self.rollups.items():
+            year, month = [int(x) for x in month.split('-')]
+            for email, authors in emails.items():
+                for author, rollup in authors.items():
+                    if self.identity.owner(author, email) != self.person:
+                        continue
+                    commits, merges, insertions, deletions, days, languages = rollup
+                    if year not in res:
+                        res[year] = {'commits': 0, 'merges': 0, 'insert': 0, 'delete': 0,
+                                     'days': set(), 'languages': {}}
+                    stat = res[year]
+                    stat['commits'] += commits
+                    stat['merges'] += merges
+                    stat['insert'] += insertions
+                    stat['delete'] += deletions
+                    stat['days'].update(datetime(year, month, day).date() for day in days)
+                    for lang, (lang_commits, lang_ins, lang_del) in languages.items():
+                        if lang not in stat['languages']:
+                            stat['languages'][lang] = {'commits': 0, 'insert': 0, 'delete': 0}
+                        stat['languages'][lang]['commits'] += lang_commits
+                        stat['languages'][lang]['insert'] += lang_ins
+                        stat['languages'][lang]['delete'] += lang_del
         return res
 
     def get_commit_by_id(self, commit_id) -> Any:
-        commit = self.commit_dict.get(commit_id)
-        # A very old commit, find it by git command
-        if not commit:
-            git_cmd = git_show_tmpl.format(commit_id=commit_id, fmt=const.GIT_LOG_FORMAT)
-            try:
-                res = util.run(git_cmd)
-            except Exception as e:
-                print(e)
-                return
-            commit_log = res.split(const.GIT_COMMIT_SEPARATOR)[0]
-            commit = self.parse_git_log(commit_log)
+        commit = self.commit_list.find(commit_id)
+        if commit:
+            return commit
+        if commit_id in self.commit_dict:
+            return self.commit_dict[commit_id]
+        # A very old commit, find it in the history
+        try:
+            with profiler.span('get_commit_by_id', 'fallback', repo=self.name):
+                records = self.backend.iter_commits([commit_id])
+                commit = next(self.parse_records(records, self.old_commits), None)
+        except Exception as e:
+            print(e)
+            return
+        self.commit_dict[commit_id] = commit
         return commit
 
-    def parse_commit_stat(self, commit: Commit):
-        total_files, code_files = len(commit.num_stat), 0
+    def resolve_commits(self, commit_ids: Iterable[str]):
+        """
+        Find commits which are out of the time range at once, results are memoized in
+        commit_dict, None for the ids can't be found.
+        """
+        missing = [commit_id for commit_id in set(commit_ids)
+                   if commit_id not in self.commit_dict and not self.commit_list.find(commit_id)]
+        if not missing:
+            return
+        try:
+            with profiler.span('resolve_commits', 'fallback', repo=self.name, commits=len(missing)):
+                commits = self.parse_records(self.backend.iter_commits(missing), self.old_commits)
+                for commit in commits:
+                    self.commit_dict[commit.id] = commit
+        except Exception as e:
+            print(e)
+            return
+        for commit_id in missing:
+            self.commit_dict.setdefault(commit_id, None)
+
+    def parse_commit_stat(self, num_stat: List[Tuple[str, str, str]]) -> Tuple[int, int, int, Dict]:
+        """ Return code files, insertions, deletions and stat by language of a commit. """
+        total_files, code_files = len(num_stat), 0
         total_ins = total_del = code_ins = code_del = 0
         lang_stat = {}
-        for line in commit.num_stat:
-            insert, delete, file_name = line.split(maxsplit=2)
+        for insert, delete, file_name in num_stat:
             if insert == '-':  # binary file
                 continue
             insert, delete = int(insert), int(delete)
@@ -230,45 +353,37 @@ class Repo:
         # Few changes, use total files stat
         elif total_files < common_files and (total_ins + total_del) < common_insertions:
             code_files, code_ins, code_del = total_files, total_ins, total_del
-        commit.code_files = code_files
-        commit.code_ins = code_ins
-        commit.code_del = code_del
-        commit.lang_stat = lang_stat
+        return code_files, code_ins, code_del, lang_stat
 
     def detect_file_lang(self, file_path: str) -> str:
         """
         Detect which programming language is used in the file .
         """
-        first_dir = file_path.split('/', maxsplit=1)[0].strip()
-        if first_dir in conf.ignore_directories['common']:
-            return ''
-        full_path = os.path.join(self.directory, file_path)
-        if self.linguist_enabled and os.path.exists(full_path):
-            language = self.linguist_res.get(file_path, '')
-        else:
-            extension = file_path.rsplit('.', maxsplit=1)[-1].strip().lower()
-            language = conf.code_file_extensions.get(extension, '')
-        if first_dir in conf.ignore_directories.get(language, []):
-            language = ''
-        return language
+        return self.classifier.detect(file_path)
 
 
 class Repos:
-    def __init__(self, ctx: util.DotDict):
+    def __init__(self, ctx: util.DotDict, repos: List[Repo] = None):
+        """ Load repos of ctx.git_inputs, or use the given loaded repos. """
         self.ctx = ctx
-        self.repos = []
-        for git_input in ctx.git_inputs:
-            try:
-                repo = Repo(git_input, ctx)
-            except Exception as e:
-                traceback.print_exc()
-                print(e)
-                continue
-            if repo.user_commits:
-                self.repos.append(repo)
+        # Stats are computed once and memoized here, see invalidate()
+        self.memo = {}
+        if repos is None:
+            with profiler.span('load repos'):
+                repos = load_repos(ctx, IdentityIndex.from_ctx(ctx))
+        # Repos without user commits in the time range may have some in years of the trend
+        self.all_repos = repos
+        self.repos = [repo for repo in repos if repo.user_commits]
         if not self.repos:
             raise ValueError('Empty repo list!')
 
+    def invalidate(self):
+        """ Drop memoized stats, it must be called after repos or their commits change. """
+        self.memo.clear()
+        for repo in self.all_repos:
+            repo.invalidate()
+
+    @util.memoize
     def get_commit_summary(self) -> util.DotDict:
         summary = {
             'projects': len(self.repos),
@@ -287,6 +402,7 @@ class Repos:
         res.coding_power = compute_coding_power(res.projects, res.commits, res.insert, res.delete)
         return res
 
+    @util.memoize
     def get_most_common_repo(self) -> Repo:
         """ Get the repo which has most user commits. """
         most_repo = commits = None
@@ -296,48 +412,44 @@ class Repos:
                 most_repo, commits = repo, summary['commits']
         return most_repo
 
+    @util.memoize
+    def get_commit_arrays(self) -> stats.CommitArrays:
+        """ Columns of user commits in all repos. """
+        return stats.CommitArrays([repo.user_commits for repo in self.repos])
+
+    @util.memoize
     def get_commit_times_by_hour(self) -> Dict[int, int]:
         """ Get each hour's commit time. """
-        commits = {}
-        for repo in self.repos:
-            for commit in repo.user_commits:
-                hour = util.timestamp_to_datetime(commit.timestamp).hour
-                commits[hour] = commits.get(hour, 0) + 1
-        return commits
+        return stats.get_commit_times_by_hour(self.get_commit_arrays())
 
+    @util.memoize
     def get_commit_weight_by_day(self) -> Dict[int, int]:
-        """ Get each day's commit weight. """
+        """
+        Get each day's commit weight, keyed by day counting from the first day of the range. Git
+        filters commits by committer date but days are of author dates, so days out of the range
+        are dropped.
+        """
+        first_day, days = util.get_range_days(*util.get_time_range(self.ctx))
         commits = self.get_commit_stat_by_day()
-        result = {day.timetuple().tm_yday: stat['weight'] for day, stat in commits.items()}
+        result = {}
+        for day, stat in commits.items():
+            offset = (day - first_day).days
+            if 0 <= offset < days:
+                result[offset] = stat['weight']
         return result
 
+    @util.memoize
     def get_commit_stat_by_day(self) -> Dict[datetime.date, Dict[str, Any]]:
         """ Get each day's commit stat. """
-        commits = {}
-        for repo in self.repos:
-            for commit in repo.user_commits:
-                commit_day = util.timestamp_to_datetime(commit.timestamp).date()
-                if commit_day not in commits:
-                    commits[commit_day] = {
-                        'commits': [commit],
-                        'insert': commit.code_ins,
-                        'delete': commit.code_del,
-                    }
-                else:
-                    commits[commit_day]['commits'].append(commit)
-                    commits[commit_day]['insert'] += commit.code_ins
-                    commits[commit_day]['delete'] += commit.code_del
-        for day, stat in commits.items():
-            weight = weight_commits(len(stat['commits']), stat['insert'], stat['delete'])
-            commits[day]['weight'] = weight
-        return commits
+        return stats.get_commit_stat_by_day(self.get_commit_arrays())
 
+    @util.memoize
     def get_latest_commit(self) -> Commit:
         """ Get the commit which has latest commit time. """
         latest_commit = latest_time = None
         for repo in self.repos:
             for commit in repo.user_commits:
-                commit_time = util.timestamp_to_fixed_day(commit.timestamp)
+                commit_time = util.timestamp_to_time_of_day(commit.timestamp)
                 if latest_commit is None:
                     latest_commit, latest_time = commit, commit_time
                     continue
@@ -350,12 +462,14 @@ class Repos:
                         latest_commit, latest_time = commit, commit_time
         return latest_commit
 
+    @util.memoize
     def get_busiest_day(self) -> Tuple[datetime.date, Dict[str, Any]]:
         """ Get the day which has max commit weight. """
         commits = self.get_commit_stat_by_day()
         busiest_day = max(commits.keys(), key=lambda x: commits[x]['weight'])
         return busiest_day, commits[busiest_day]
 
+    @util.memoize
     def get_language_stat(self) -> Dict[str, Any]:
         """ Get each used language's commit stat. """
         res = {}
@@ -363,7 +477,7 @@ class Repos:
             repo_stat = repo.get_language_stat()
             for lang, stat in repo_stat.items():
                 if lang not in res:
-                    res[lang] = stat
+                    res[lang] = dict(stat)
                 else:
                     res[lang]['commits'] += stat['commits']
                     res[lang]['insert'] += stat['insert']
@@ -373,44 +487,80 @@ class Repos:
             res[lang]['weight'] = weight
         return res
 
+    @util.memoize
+    def get_trend(self) -> Dict[int, util.DotDict]:
+        """
+        Stat of each year of the trend, combined from rollups of repos. Unlike stats of the time
+        range, commits shared by forks are counted in each of them.
+        """
+        trend = {}
+        for year in get_trend_years(self.ctx):
+            res = util.DotDict({'projects': 0, 'commits': 0, 'merges': 0, 'insert': 0,
+                                'delete': 0, 'language': ''})
+            days, languages = set(), {}
+            for repo in self.all_repos:
+                stat = repo.get_yearly_stat().get(year)
+                if not stat:
+                    continue
+                res.projects += 1
+                for key in ('commits', 'merges', 'insert', 'delete'):
+                    res[key] += stat[key]
+                days.update(stat['days'])
+                for lang, lang_stat in stat['languages'].items():
+                    languages[lang] = languages.get(lang, 0) + weight_commits(
+                        lang_stat['commits'], lang_stat['insert'], lang_stat['delete'])
+            res.days = len(days)
+            if languages:
+                res.language = max(languages, key=lambda x: languages[x])
+            res.coding_power = compute_coding_power(res.projects, res.commits, res.insert,
+                                                    res.delete)
+            trend[year] = res
+        return trend
+
+    @util.memoize
     def get_merge_stat(self) -> Dict[str, Dict[str, Any]]:
         """ Get merge stat related to user. """
         merges = {}
         # One author email may related to several author names, use the most readable name
         authors = {}
         for repo in self.repos:
-            for commit in repo.commit_list:
-                if len(commit.parents) == 1:
+            repo.resolve_commits(commit.parents[1] for commit in repo.commits
+                                 if len(commit.parents) > 1)
+            for commit in repo.commits:
+                if len(commit.parents) < 2:
                     continue
                 merged_id = commit.parents[1]
                 merged = repo.get_commit_by_id(merged_id)
                 if not merged:
                     continue
+                merge_by_user, merged_user = repo.is_user(commit), repo.is_user(merged)
                 # user merges his own commit
-                if commit.email in self.ctx.emails and merged.email in self.ctx.emails:
+                if merge_by_user and merged_user:
                     continue
                 # user merges others' commit
-                elif commit.email in self.ctx.emails:
-                    if merged.email not in merges:
-                        merges[merged.email] = {
+                elif merge_by_user:
+                    author, email = repo.identity.canonical(merged.author, merged.email)
+                    if email not in merges:
+                        merges[email] = {
                             'merge': 1,
                             'merged_by': 0,
                         }
-                        authors[merged.email] = {merged.author}
+                        authors[email] = {author}
                     else:
-                        merges[merged.email]['merge'] += 1
-                        authors[merged.email].add(merged.author)
+                        merges[email]['merge'] += 1
+                        authors[email].add(author)
                 # user's commit merged by others
-                elif merged.email in self.ctx.emails:
-                    if commit.email not in merges:
-                        merges[commit.email] = {
+                elif merged_user:
+                    author, email = repo.identity.canonical(commit.author, commit.email)
+                    if email not in merges:
+                        merges[email] = {
                             'merge': 0,
                             'merged_by': 1
                         }
-                        authors[commit.email] = {commit.author}
+                        authors[email] = {author}
                     else:
-                        merges[commit.email]['merged_by'] += 1
-                        authors[commit.email].add(commit.author)
+                        merges[email]['merged_by'] += 1
+                        authors[email].add(author)
         result = {}
         for email, stat in merges.items():
             # TODO: networkx doesn't support Chinese well, use English names instead
@@ -426,8 +576,71 @@ class Repos:
         return result
 
 
-def weight_commits(commit_times, insertions, deletions: int) -> int:
-    return commit_times * const.COMMIT_WEIGHT + insertions + deletions
+def load_repos(ctx: util.DotDict, identities: IdentityIndex) -> List[Repo]:
+    """ Load repos of ctx.git_inputs, repos failed to load are left out. """
+    with profiler.span('sync repos'):
+        clone.sync_all(ctx, [x for x in ctx.git_inputs if not os.path.isdir(x)])
+    workers = ctx.load_workers or conf.load_workers
+    if workers > 1 and len(ctx.git_inputs) > 1:
+        # Repos are loaded by git and ruby subprocesses mostly, so threads are enough here.
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            loaded = list(executor.map(lambda x: load_repo(x, ctx, identities), ctx.git_inputs))
+    else:
+        loaded = [load_repo(x, ctx, identities) for x in ctx.git_inputs]
+    repos = [repo for repo in loaded if repo]
+    # Forks and mirrors share history, count each commit only in the first repo it appears in
+    if len(repos) > 1:
+        index = set()
+        for repo in repos:
+            repo.drop_duplicates(index)
+    return repos
+
+
+def load_repo(git_input: str, ctx: util.DotDict, identities: IdentityIndex = None) -> Any:
+    """ Load a repo, errors are printed and None is returned to keep other repos going. """
+    try:
+        with profiler.span('load repo', 'repo', repo=git_input):
+            return Repo(git_input, ctx, identities)
+    except Exception as e:
+        traceback.print_exc()
+        print(e)
+        return None
+
+
+def get_trend_years(ctx: util.DotDict) -> List[int]:
+    """ Years of the trend ending with the year the time range ends in, see conf.trend_years. """
+    years = ctx.trend_years or conf.trend_years
+    if not years:
+        return []
+    last_year = util.timestamp_to_datetime(util.get_time_range(ctx)[1] - 1).year
+    return list(range(last_year - years + 1, last_year + 1))
+
+
+def add_rollups(months: Dict[str, Any], commits: Iterable[Commit]):
+    """
+    Add commits to monthly rollups {month: {email: {author: rollup}}}, a commit is in the month it
+    was authored in, like 2018-01 in local time. A rollup is [commits, merges, insertions,
+    deletions, [day of month], {language: [commits, insertions, deletions]}], authors are kept so
+    rollups don't depend on identities.
+    """
+    for commit in commits:
+        date = util.timestamp_to_datetime(commit.timestamp)
+        authors = months.setdefault('{0:%Y-%m}'.format(date), {}).setdefault(commit.email, {})
+        if commit.author not in authors:
+            authors[commit.author] = [0, 0, 0, 0, [], {}]
+        rollup = authors[commit.author]
+        rollup[0] += 1
+        rollup[1] += int(len(commit.parents) > 1)
+        rollup[2] += commit.code_ins
+        rollup[3] += commit.code_del
+        if date.day not in rollup[4]:
+            rollup[4].append(date.day)
+        for lang, stat in commit.lang_stat.items():
+            if lang not in rollup[5]:
+                rollup[5][lang] = [0, 0, 0]
+            rollup[5][lang][0] += 1
+            rollup[5][lang][1] += stat['insert']
+            rollup[5][lang][2] += stat['delete']
 
 
 def get_most_readable_name(names: Set[str]) -> str:
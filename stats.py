@@ -0,0 +1,153 @@
+# coding: utf8
+"""Aggregate commit stats over columns of the commit stores with NumPy."""
+from datetime import date
+from typing import List, Dict, Any, Tuple, Iterator
+
+import numpy as np
+
+import const
+import util
+from store import Commit, CommitStore, CommitSelection
+
+# Local time offsets are multiples of 15 minutes, so commits in one bucket share the day and hour.
+time_bucket_size = 900
+
+
+def weight_commits(commit_times, insertions, deletions: int) -> int:
+    return commit_times * const.COMMIT_WEIGHT + insertions + deletions
+
+
+def column(values: Any) -> np.ndarray:
+    """ A NumPy view of an array.array column. """
+    return np.asarray(memoryview(values))
+
+
+def group_by_first_seen(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return the distinct keys ordered by their first occurrence, and the group index of each key,
+    so results keep the order a loop over the commits would produce.
+    """
+    uniq, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return uniq[order], rank[inverse.reshape(-1)]
+
+
+def sum_by_group(groups: np.ndarray, values: np.ndarray, size: int) -> np.ndarray:
+    if not len(values):
+        return np.zeros(size, dtype=np.int64)
+    return np.bincount(groups, weights=values, minlength=size).round().astype(np.int64)
+
+
+class CommitGroup:
+    """ Commits of one group, e.g. one day, views are only created when they are iterated. """
+
+    def __init__(self, arrays: 'CommitArrays', indices: np.ndarray):
+        self.arrays = arrays
+        self.indices = indices
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, idx: int) -> Commit:
+        i = self.indices[idx]
+        return Commit(self.arrays.stores[self.arrays.store_ids[i]], int(self.arrays.rows[i]))
+
+    def __iter__(self) -> Iterator[Commit]:
+        for idx in range(len(self.indices)):
+            yield self[idx]
+
+
+class CommitArrays:
+    """ Columns of the selected commits of several stores, concatenated in order. """
+
+    def __init__(self, selections: List[CommitSelection]):
+        self.stores = [selection.store for selection in selections]
+        rows = [column(selection.rows).astype(np.int64) for selection in selections]
+        self.rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        self.store_ids = np.repeat(np.arange(len(rows)), [len(r) for r in rows])
+        self.timestamps = self.gather(lambda store: store.timestamps, rows)
+        self.insertions = self.gather(lambda store: store.insertions, rows)
+        self.deletions = self.gather(lambda store: store.deletions, rows)
+        self.day_ordinals, self.hours = self.get_local_times()
+
+    def gather(self, get_column, rows: List[np.ndarray]) -> np.ndarray:
+        parts = [column(get_column(store))[store_rows]
+                 for store, store_rows in zip(self.stores, rows)]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    def get_local_times(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ Local day ordinal and hour of each commit, converted once per time bucket. """
+        buckets, inverse = np.unique(self.timestamps // time_bucket_size, return_inverse=True)
+        times = [util.timestamp_to_datetime(int(bucket) * time_bucket_size) for bucket in buckets]
+        ordinals = np.array([t.toordinal() for t in times], dtype=np.int64)
+        hours = np.array([t.hour for t in times], dtype=np.int64)
+        inverse = inverse.reshape(-1)
+        return ordinals[inverse], hours[inverse]
+
+
+def get_commit_summary(selection: CommitSelection) -> Dict[str, int]:
+    store, rows = selection.store, column(selection.rows)
+    parent_counts = np.diff(column(store.parent_ends).astype(np.int64), prepend=0)
+    return {
+        'commits': len(rows),
+        'merges': int(np.count_nonzero(parent_counts[rows] > 1)),
+        'insert': int(column(store.insertions)[rows].sum()),
+        'delete': int(column(store.deletions)[rows].sum()),
+    }
+
+
+def get_commit_times_by_hour(arrays: CommitArrays) -> Dict[int, int]:
+    hours, groups = group_by_first_seen(arrays.hours)
+    counts = np.bincount(groups, minlength=len(hours))
+    return {int(hour): int(count) for hour, count in zip(hours, counts)}
+
+
+def get_commit_stat_by_day(arrays: CommitArrays) -> Dict[date, Dict[str, Any]]:
+    days, groups = group_by_first_seen(arrays.day_ordinals)
+    size = len(days)
+    counts = np.bincount(groups, minlength=size)
+    insertions = sum_by_group(groups, arrays.insertions, size)
+    deletions = sum_by_group(groups, arrays.deletions, size)
+    members = np.split(np.argsort(groups, kind='stable'), np.cumsum(counts)[:-1])
+    res = {}
+    for i, ordinal in enumerate(days):
+        res[date.fromordinal(int(ordinal))] = {
+            'commits': CommitGroup(arrays, members[i]),
+            'insert': int(insertions[i]),
+            'delete': int(deletions[i]),
+            'weight': weight_commits(int(counts[i]), int(insertions[i]), int(deletions[i])),
+        }
+    return res
+
+
+def get_language_stat(store: CommitStore, selection: CommitSelection = None) -> Dict[str, Any]:
+    """ Stat of each language in the store, only the selected commits are counted if given. """
+    ends = column(store.lang_ends).astype(np.int64)
+    entry_rows = np.repeat(np.arange(len(store)), np.diff(ends, prepend=0))
+    lang_ids = column(store.lang_ids)
+    insertions = column(store.lang_insertions)
+    deletions = column(store.lang_deletions)
+    if selection is not None:
+        selected = np.zeros(len(store), dtype=bool)
+        selected[column(selection.rows)] = True
+        entries = selected[entry_rows]
+        lang_ids, insertions, deletions = lang_ids[entries], insertions[entries], deletions[entries]
+    if not len(lang_ids):
+        return {}
+    # A commit has at most one entry for a language, so entries of a language count its commits
+    langs, groups = group_by_first_seen(lang_ids)
+    size = len(langs)
+    counts = np.bincount(groups, minlength=size)
+    insertions = sum_by_group(groups, insertions, size)
+    deletions = sum_by_group(groups, deletions, size)
+    res = {}
+    for i, lang_id in enumerate(langs):
+        res[store.language_names[int(lang_id)]] = {
+            'commits': int(counts[i]),
+            'insert': int(insertions[i]),
+            'delete': int(deletions[i]),
+            'weight': weight_commits(int(counts[i]), int(insertions[i]), int(deletions[i])),
+        }
+    return res
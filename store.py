@@ -0,0 +1,205 @@
+# coding: utf8
+from array import array
+from typing import List, Dict, Any, Iterator, Optional
+
+
+class Interner:
+    """ Map each distinct string to a small integer id, so repeated strings are stored once. """
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def intern(self, value: str) -> int:
+        idx = self.ids.get(value)
+        if idx is None:
+            idx = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return idx
+
+    def __getitem__(self, idx: int) -> str:
+        return self.values[idx]
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class Commit:
+    """ A lightweight view of one commit stored in a CommitStore. """
+    __slots__ = ('store', 'row')
+
+    def __init__(self, store: 'CommitStore', row: int):
+        self.store = store
+        self.row = row
+
+    @property
+    def id(self) -> str:
+        return self.store.get_digest(self.row).hex()
+
+    @property
+    def parents(self) -> List[str]:
+        store, size = self.store, self.store.id_size
+        begin = store.parent_ends[self.row - 1] if self.row else 0
+        end = store.parent_ends[self.row]
+        return [store.parent_ids[i * size:(i + 1) * size].hex() for i in range(begin, end)]
+
+    @property
+    def author(self) -> str:
+        return self.store.author_names[self.store.authors[self.row]]
+
+    @property
+    def email(self) -> str:
+        return self.store.author_emails[self.store.emails[self.row]]
+
+    @property
+    def timestamp(self) -> int:
+        return self.store.timestamps[self.row]
+
+    @property
+    def subject(self) -> str:
+        return self.store.subjects[self.row]
+
+    @property
+    def code_files(self) -> int:
+        return self.store.files[self.row]
+
+    @property
+    def code_ins(self) -> int:
+        return self.store.insertions[self.row]
+
+    @property
+    def code_del(self) -> int:
+        return self.store.deletions[self.row]
+
+    @property
+    def lang_stat(self) -> Dict[str, Dict[str, int]]:
+        store = self.store
+        begin = store.lang_ends[self.row - 1] if self.row else 0
+        res = {}
+        for i in range(begin, store.lang_ends[self.row]):
+            res[store.language_names[store.lang_ids[i]]] = {
+                'insert': store.lang_insertions[i],
+                'delete': store.lang_deletions[i],
+            }
+        return res
+
+    def to_record(self) -> List[Any]:
+        """ Parsed fields of the commit, which can be saved as json. """
+        return [self.id, self.parents, self.author, self.email, self.timestamp, self.subject,
+                self.code_files, self.code_ins, self.code_del, self.lang_stat]
+
+
+class CommitStore:
+    """
+    Commits stored column by column in arrays instead of one python object per commit. Ids are
+    binary digests, authors, emails and languages are interned, and the per language line counts
+    are a sparse table which only has entries for the languages a commit touched.
+    """
+
+    def __init__(self):
+        self.id_size = 20  # 32 for sha256 repositories, set by the first commit
+        self.ids = bytearray()
+        # Parents of commit i are parent_ids[parent_ends[i - 1]:parent_ends[i]]
+        self.parent_ids = bytearray()
+        self.parent_ends = array('Q')
+        self.authors = array('I')
+        self.emails = array('I')
+        self.timestamps = array('q')
+        self.subjects = []
+        self.files = array('q')
+        self.insertions = array('q')
+        self.deletions = array('q')
+        # Languages of commit i are entries lang_ends[i - 1] to lang_ends[i]
+        self.lang_ends = array('Q')
+        self.lang_ids = array('I')
+        self.lang_insertions = array('q')
+        self.lang_deletions = array('q')
+        self.author_names = Interner()
+        self.author_emails = Interner()
+        self.language_names = Interner()
+        # Rows sorted by commit id, built on the first lookup
+        self.sorted_rows = None
+
+    def append(self, commit_id: str, parent_ids: List[str], author: str, email: str,
+               timestamp: int, subject: str, files: int, insertions: int, deletions: int,
+               lang_stat: Dict[str, Dict[str, int]]) -> Commit:
+        digest = bytes.fromhex(commit_id)
+        if not self.timestamps:
+            self.id_size = len(digest)
+        self.ids += digest
+        for parent_id in parent_ids:
+            self.parent_ids += bytes.fromhex(parent_id)
+        self.parent_ends.append(len(self.parent_ids) // self.id_size)
+        self.authors.append(self.author_names.intern(author))
+        self.emails.append(self.author_emails.intern(email))
+        self.timestamps.append(timestamp)
+        self.subjects.append(subject)
+        self.files.append(files)
+        self.insertions.append(insertions)
+        self.deletions.append(deletions)
+        for lang, stat in lang_stat.items():
+            self.lang_ids.append(self.language_names.intern(lang))
+            self.lang_insertions.append(stat['insert'])
+            self.lang_deletions.append(stat['delete'])
+        self.lang_ends.append(len(self.lang_ids))
+        self.sorted_rows = None
+        return Commit(self, len(self.timestamps) - 1)
+
+    def append_record(self, record: List[Any]) -> Commit:
+        """ Append a commit saved by Commit.to_record(). """
+        return self.append(*record)
+
+    def get_digest(self, row: int) -> bytes:
+        return bytes(self.ids[row * self.id_size:(row + 1) * self.id_size])
+
+    def find(self, commit_id: str) -> Optional[Commit]:
+        """ Find a commit by its id with a binary search over the rows sorted by id. """
+        try:
+            digest = bytes.fromhex(commit_id)
+        except ValueError:
+            return None
+        if self.sorted_rows is None:
+            self.sorted_rows = array('I', sorted(range(len(self)), key=self.get_digest))
+        low, high = 0, len(self.sorted_rows)
+        while low < high:
+            mid = (low + high) // 2
+            if self.get_digest(self.sorted_rows[mid]) < digest:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(self.sorted_rows) and self.get_digest(self.sorted_rows[low]) == digest:
+            return Commit(self, self.sorted_rows[low])
+        return None
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __getitem__(self, row: int) -> Commit:
+        if not 0 <= row < len(self):
+            raise IndexError('commit row out of range')
+        return Commit(self, row)
+
+    def __iter__(self) -> Iterator[Commit]:
+        for row in range(len(self)):
+            yield Commit(self, row)
+
+
+class CommitSelection:
+    """ A subset of the commits in a store, e.g. the commits of the user. """
+
+    def __init__(self, store: CommitStore):
+        self.store = store
+        self.rows = array('I')
+
+    def append(self, commit: Commit):
+        self.rows.append(commit.row)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, idx: int) -> Commit:
+        return Commit(self.store, self.rows[idx])
+
+    def __iter__(self) -> Iterator[Commit]:
+        for row in self.rows:
+            yield Commit(self.store, row)
@@ -0,0 +1,98 @@
+# coding: utf8
+"""Generate annual reports for every member of a team, repositories are scanned only once."""
+import argparse
+import os
+import traceback
+from typing import List
+
+import conf
+import profiler
+import util
+from dependency import check_linguist
+from identity import IdentityIndex
+from main import RUN_DIR, get_recent_year, find_git_inputs
+from report import Reporter
+from repository import Repos, load_repos
+
+
+def read_roster(path: str) -> List[util.DotDict]:
+    """
+    Each line of the roster is a member, a name followed by git emails separated by spaces, e.g.
+    `张三 zhangsan@example.com san@example.org`. Words with @ are emails, others make the name.
+    """
+    members = []
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            words = line.split('#', maxsplit=1)[0].split()
+            if not words:
+                continue
+            emails = [word for word in words if '@' in word]
+            name = ' '.join(word for word in words if '@' not in word)
+            if not name or not emails:
+                print('Ignore invalid roster line: {0}'.format(line.strip()))
+                continue
+            members.append(util.DotDict({'name': name, 'emails': emails}))
+    return members
+
+
+def generate_reports(ctx: util.DotDict):
+    """
+    Load repos once with commits grouped by member, then generate the report of each member in
+    output/<name>/.
+    """
+    with profiler.span('load repos'):
+        repos = load_repos(ctx, IdentityIndex.from_ctx(ctx))
+    for member in ctx.members:
+        member_ctx = util.DotDict(ctx)
+        member_ctx.update(member)
+        dir_name = member.name.replace(os.sep, '_')
+        member_ctx.output_dir = os.path.join(ctx.run_dir, 'output', dir_name)
+        views = [repo.for_member(member.name) for repo in repos]
+        if not any(view.user_commits for view in views):
+            print('No commits of {0} in {1}'.format(
+                member.name, util.get_period_name(*util.get_time_range(ctx))))
+            continue
+        try:
+            with profiler.span('member report', member=member.name):
+                member_repos = Repos(member_ctx, views)
+                reporter = Reporter(member_ctx, member_repos)
+                reporter.generate_report()
+                reporter.report_file.close()
+            print('Report of {0} is generated in {1}'.format(member.name, reporter.output_dir))
+        except Exception as e:
+            traceback.print_exc()
+            print('Fail to generate report of {0}: {1}'.format(member.name, e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate annual reports for a team.')
+    parser.add_argument('roster', help='roster file, one member per line: name email [email...]')
+    parser.add_argument('git_inputs', nargs='*',
+                        help='git urls or paths, repositories in parent directory by default')
+    parser.add_argument('--year', type=int, default=get_recent_year())
+    parser.add_argument('--period', type=util.parse_period,
+                        help='time range instead of the year, e.g. 2018-01..2018-04 for Q1')
+    parser.add_argument('--encrypt', action='store_true', help='encrypt names in reports')
+    parser.add_argument('--profile', action='store_true',
+                        help='save a trace of phases in output/trace.json, see conf.profile')
+    args = parser.parse_args()
+    if args.profile or conf.profile:
+        profiler.enable()
+    ctx = util.DotDict()
+    ctx.run_dir = RUN_DIR
+    ctx.year = args.year
+    if args.period:
+        ctx.since, ctx.until = args.period
+    ctx.encrypt = args.encrypt
+    ctx.members = read_roster(args.roster)
+    ctx.git_inputs = args.git_inputs or find_git_inputs(os.path.join(RUN_DIR, os.pardir))
+    with profiler.span('check linguist'):
+        ctx.update(check_linguist(ctx))
+    print('{0} members, {1} repositories'.format(len(ctx.members), len(ctx.git_inputs)))
+    generate_reports(ctx)
+    if profiler.enabled:
+        profiler.save(os.path.join(RUN_DIR, 'output'))
+
+
+if __name__ == '__main__':
+    main()
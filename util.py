@@ -1,11 +1,13 @@
 # coding: utf8
+import functools
 import os
 import subprocess
 import time
-from  datetime import datetime
-from typing import List, Any, Tuple
+from  datetime import datetime, date, timedelta, time as dt_time
+from typing import List, Any, Tuple, Iterator
 
 import const
+import profiler
 
 
 class DotDict(dict):
@@ -15,24 +17,78 @@ class DotDict(dict):
     __delattr__ = dict.__delitem__
 
 
-def run(cmd: str, shell=True, stdout=subprocess.PIPE, timeout=600, check=True) -> str:
+def memoize(method):
+    """
+    Cache the result of a method in the memo dict of the instance, results are computed again
+    only after the memo is cleared.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        if key not in self.memo:
+            self.memo[key] = method(self, *args, **kwargs)
+        return self.memo[key]
+
+    return wrapper
+
+
+def run(cmd: str, shell=True, stdout=subprocess.PIPE, timeout=600, check=True, cwd=None,
+        input=None) -> str:
     """ Wrapper function of subprocess.run(). """
-    res = subprocess.run(cmd, shell=shell, stdout=stdout, timeout=timeout, check=check)
+    with profiler.span(profiler.get_command_name(cmd), 'subprocess', cmd=cmd, cwd=cwd):
+        res = subprocess.run(cmd, shell=shell, stdout=stdout, timeout=timeout, check=check,
+                             cwd=cwd, input=input)
     if res.stdout is None:
         return ''
     return res.stdout.decode('utf8').strip()
 
 
-def run_with_check(cmd: str, stdout=subprocess.PIPE, timeout=600) -> bool:
+def run_with_check(cmd: str, stdout=subprocess.PIPE, timeout=600, cwd=None) -> bool:
     """ Return true if cmd ran successfully else false. """
     try:
-        subprocess.run(cmd, shell=True, stdout=stdout, timeout=timeout, check=True)
+        with profiler.span(profiler.get_command_name(cmd), 'subprocess', cmd=cmd, cwd=cwd):
+            subprocess.run(cmd, shell=True, stdout=stdout, timeout=timeout, check=True, cwd=cwd)
     except Exception as e:
         print(e)
         return False
     return True
 
 
+def iter_split(cmd: str, sep=b'\0', cwd=None, chunk_size=1 << 16, input=None) -> Iterator[str]:
+    """ Run cmd and yield its output split by sep, without buffering the whole output. """
+    # The span lasts until the output is consumed, it's the wall time of the process
+    with profiler.span(profiler.get_command_name(cmd), 'subprocess', cmd=cmd, cwd=cwd):
+        stdin = subprocess.PIPE if input is not None else None
+        proc = subprocess.Popen(cmd, shell=True, stdin=stdin, stdout=subprocess.PIPE, cwd=cwd)
+        finished = False
+        try:
+            # Only used by commands which read all of stdin before writing output, e.g. git --stdin
+            if input is not None:
+                proc.stdin.write(input)
+                proc.stdin.close()
+            rest = b''
+            while True:
+                chunk = proc.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                parts = (rest + chunk).split(sep)
+                rest = parts.pop()
+                for part in parts:
+                    yield part.decode('utf8', errors='replace')
+            if rest:
+                yield rest.decode('utf8', errors='replace')
+            finished = True
+        finally:
+            # The caller stopped early, don't wait for the rest of the output
+            if not finished:
+                proc.kill()
+            proc.stdout.close()
+            ret_code = proc.wait()
+        if ret_code:
+            raise subprocess.CalledProcessError(ret_code, cmd)
+
+
 def timestamp_to_datetime(timestamp: int) -> datetime:
     return datetime.fromtimestamp(timestamp)
 
@@ -42,9 +98,12 @@ def timestamp_to_day_of_year(timestamp: int) -> int:
     return dt.timetuple().tm_yday
 
 
-def timestamp_to_fixed_day(timestamp: int) -> datetime:
-    dt = datetime.fromtimestamp(timestamp)
-    return dt.replace(year=2018, month=1, day=1)
+def timestamp_to_time_of_day(timestamp: int) -> dt_time:
+    return datetime.fromtimestamp(timestamp).time()
+
+
+def datetime_to_timestamp(dt: datetime) -> int:
+    return int(time.mktime(dt.timetuple()))
 
 
 def get_year_ends(year: int) -> Tuple[int, int]:
@@ -53,6 +112,84 @@ def get_year_ends(year: int) -> Tuple[int, int]:
     return int(begin_ts), int(end_ts)
 
 
+def add_months(timestamp: int, months: int) -> int:
+    """ The first day of the month some months after the month of timestamp, in local time. """
+    dt = datetime.fromtimestamp(timestamp)
+    month = dt.year * 12 + dt.month - 1 + months
+    return datetime_to_timestamp(datetime(year=month // 12, month=month % 12 + 1, day=1))
+
+
+def is_month_start(timestamp: int) -> bool:
+    dt = datetime.fromtimestamp(timestamp)
+    return dt == datetime(year=dt.year, month=dt.month, day=1)
+
+
+def parse_period(text: str) -> Tuple[int, int]:
+    """
+    Parse a time range [since, until) in local time. It's a year, month or day like 2018, 2018-04
+    or 2018-04-01, or two of them joined by .., e.g. 2018-01..2018-04 is the first quarter.
+    """
+    if '..' in text:
+        since, until = text.split('..', maxsplit=1)
+        since, until = parse_period(since)[0], parse_period(until)[0]
+    else:
+        parts = [int(part) for part in text.strip().split('-')]
+        if not 1 <= len(parts) <= 3:
+            raise ValueError('Invalid date: {0}'.format(text))
+        since = datetime_to_timestamp(datetime(*(parts + [1] * (3 - len(parts)))))
+        if len(parts) == 3:
+            until = datetime_to_timestamp(datetime(*parts) + timedelta(days=1))
+        else:
+            until = add_months(since, 12 if len(parts) == 1 else 1)
+    if since >= until:
+        raise ValueError('Empty time range: {0}'.format(text))
+    return since, until
+
+
+def get_time_range(ctx: DotDict) -> Tuple[int, int]:
+    """ The time range [since, until) of the report, the year of ctx.year by default. """
+    if ctx.since is not None:
+        return ctx.since, ctx.until
+    return get_year_ends(ctx.year)
+
+
+def get_range_days(since: int, until: int) -> Tuple[date, int]:
+    """ The first local day of a time range and the number of days it touches. """
+    first = datetime.fromtimestamp(since).date()
+    last = datetime.fromtimestamp(until - 1).date()
+    return first, (last - first).days + 1
+
+
+def get_period_name(since: int, until: int) -> str:
+    """ Name of a time range in reports, e.g. 2018 年, 2018 年 1 - 3 月 or 2014 - 2018 年. """
+    first, last = datetime.fromtimestamp(since), datetime.fromtimestamp(until - 1)
+    if not is_month_start(since) or not is_month_start(until):
+        if first.date() == last.date():
+            return '{0.year} 年 {0.month} 月 {0.day} 日'.format(first)
+        if first.year == last.year:
+            return '{0.year} 年 {0.month} 月 {0.day} 日 - {1.month} 月 {1.day} 日'.format(first, last)
+        return '{0.year} 年 {0.month} 月 {0.day} 日 - {1.year} 年 {1.month} 月 {1.day} 日'.format(
+            first, last)
+    if first.month == 1 and last.month == 12:
+        if first.year == last.year:
+            return '{0} 年'.format(first.year)
+        return '{0} - {1} 年'.format(first.year, last.year)
+    if first.year != last.year:
+        return '{0.year} 年 {0.month} 月 - {1.year} 年 {1.month} 月'.format(first, last)
+    if first.month == last.month:
+        return '{0.year} 年 {0.month} 月'.format(first)
+    return '{0.year} 年 {0.month} - {1.month} 月'.format(first, last)
+
+
+def get_next_period(since: int, until: int) -> Tuple[int, int]:
+    """ The time range as long as the given one right after it, in months if it's in months. """
+    if is_month_start(since) and is_month_start(until):
+        first, last = datetime.fromtimestamp(since), datetime.fromtimestamp(until)
+        months = (last.year - first.year) * 12 + last.month - first.month
+        return until, add_months(until, months)
+    return until, until + until - since
+
+
 def is_ascii(s: str) -> bool:
     return all(ord(c) < 128 for c in s)
 
@@ -117,5 +254,4 @@ def is_git_dir(dir_path: str) -> bool:
     """ Check if the given directory is a git repository. """
     if not os.path.isdir(dir_path):
         return False
-    os.chdir(dir_path)
-    return run_with_check(const.CHECK_GIT_DIR_CMD)
+    return run_with_check(const.CHECK_GIT_DIR_CMD, cwd=dir_path)